@@ -2,273 +2,2266 @@
 #include <stdint.h>
 #include <stdlib.h>
 #include <string.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 #include <openssl/sha.h>
+#if defined(__x86_64__) || defined(__i386__)
+#include <cpuid.h>
+#include <immintrin.h>
+#endif
 #include "merkle.h"
 
 #define LEAF_LENGTH 32
+#define MAX_WORKERS 256
+/* deepest tree accepted, its level sizes and snapshot keys fit in 64 bits with room to spare */
+#define MAX_BRANCHES 56
+/* parents per level below which a level is hashed on the calling thread only */
+#define PARALLEL_THRESHOLD 4096
+/* smallest leaf lookup, lookups are kept at most half full */
+#define LOOKUP_CAPACITY 64
 
-char* side(int index);
+/* a share of a level or of a batch of raw leaves for one worker to hash */
+typedef struct {
+    const uint8_t* in;
+    const uint64_t* offsets;
+    uint8_t* out;
+    int64_t start_index;
+    int64_t end_index;
+    int hash_id;
+} Slice;
 
-int get_parent_index(int index);
-int get_sibling_index(int index);
+char* side(int64_t index);
+
+int64_t get_parent_index(int64_t index);
+int64_t get_sibling_index(int64_t index);
 
 uint8_t* get_leaves(Tree* tree, int branch);
-uint8_t* hash_siblings(const uint8_t* left, const uint8_t* right);
+void hash(int hash_id, const uint8_t* in, size_t len, uint8_t* out);
+void hash_siblings(int hash_id, const uint8_t* in, uint8_t* out, int64_t count);
+void hash_pair(int hash_id, const uint8_t* left, const uint8_t* right, uint8_t* out);
+
+int64_t level_count(Tree* tree, int branch_index);
+void hash_level(Tree* tree, int branch_index, int64_t start_index, int64_t end_index);
+void run_parallel(int workers, void* (*work)(void*), Slice slice);
+void* hash_slice(void* slice);
+void* hash_leaf_slice(void* slice);
+int hash_raw_leaves(int hash_id, int workers, uint8_t* data, size_t length, uint64_t* offsets, int64_t count, uint8_t* out);
+
+void update_parent(Tree* tree, int branch_index, int64_t leaf_index, _Bool recurse);
+void rebuild_branch(Tree* tree, int branch_index, int64_t start_index, int64_t end_index);
+
+int check_index(Tree* tree, int64_t index);
+void write_proof(Tree* tree, int64_t index, uint8_t* siblings);
+
+void diff_subtree(Tree* tree, Tree* other, int branch_index, int64_t index, int64_t* indexes, int64_t capacity, int64_t* count);
+const uint8_t* diff_node(Tree* tree, int branch_index, int64_t index);
+
+int branches_for(int64_t leaf_count);
+int grow_tree(Tree* tree, int branch_count);
+int widen_branches(Tree* tree, int branch_count);
+void shrink_tree(Tree* tree);
+void release_tree(Tree* tree);
+
+int check_header(const uint8_t* data, size_t length);
+size_t branch_offset(int branch_count, int branch_index);
+int resize_file(Tree* tree, int branch_count);
+void map_branches(Tree* tree);
+void write_header(uint8_t* out, uint64_t leaf_count, int branch_count, int hash_id, const uint8_t* root);
+void store_header(Tree* tree);
+
+uint64_t node_key(int branch_index, int64_t index);
+void save_nodes(Tree* tree, int branch_index, int64_t start_index, int64_t end_index);
+uint8_t* find_saved(Snapshot* snapshot, uint64_t key);
+void put_saved(Snapshot* snapshot, uint64_t key, const uint8_t* node);
+int snapshot_reserve(Snapshot* snapshot, int64_t count);
+int reserve_saves(Tree* tree, int64_t count);
+int64_t write_saves(Tree* tree, int branch_count, int64_t start_index, int64_t end_index, int64_t count);
+int64_t shrink_saves(Tree* tree);
+const uint8_t* snapshot_node(Snapshot* snapshot, int branch_index, int64_t index);
+
+int64_t lookup_home(Tree* tree, const uint8_t* leaf);
+int64_t lookup_size(int64_t leaf_count);
+int lookup_reserve(Tree* tree, int64_t leaf_count);
+int lookup_resize(Tree* tree, int64_t capacity);
+void lookup_insert(Tree* tree, int64_t index);
+void lookup_remove(Tree* tree, int64_t index);
+void lookup_shift(Tree* tree, int64_t index);
+
+void put_uint(uint8_t* out, uint64_t value, int size);
+uint64_t get_uint(const uint8_t* in, int size);
+
+int64_t push_nodes(Stream* stream, int level, const uint8_t* nodes, int64_t count, uint8_t* parents);
+
+int alloc_bitmaps(int branch_count, uint64_t** bitmaps);
+int reserve_dirty(Tree* tree);
+void mark_dirty(Tree* tree, int branch_index, int64_t index);
+void mark_range(Tree* tree, int branch_index, int64_t start_index, int64_t end_index);
+void flush(Tree* tree);
+
+void replace(uint8_t* leaves, const uint8_t* leaf, int64_t index);
+void delete(uint8_t* leaves, int64_t size, int64_t index);
+
+const uint8_t empty[LEAF_LENGTH] = { 0 };
+
+enum status {SUCCESS = 0, INDEX_ERROR = 1, EMPTY = 2, FORMAT_ERROR = 3, ROOT_MISMATCH = 4, IO_ERROR = 5, HASH_MISMATCH = 6, MEMORY_ERROR = 7};
+
+/* marshalled trees: magic, version, leaf count, branch count, flags, root, then every branch in order */
+#define MARSHAL_MAGIC "MRKL"
+#define MARSHAL_VERSION 1
+#define MARSHAL_HEADER_LENGTH (24 + LEAF_LENGTH)
+
+/* branches of a tree holding leaf_count leaves, whose bottom branch is the next power of two and at least two */
+int branches_for(int64_t leaf_count) {
+    int branch_count = 1;
+    while (branch_count <= MAX_BRANCHES && ((int64_t) 1 << branch_count) < leaf_count) {
+        branch_count++;
+    }
+    return branch_count;
+}
+
+void remove_branch(Tree* tree) {
+    memcpy(tree->root, tree->branches[tree->branch_count - 1].leaves, LEAF_LENGTH);
+    free(tree->branches[tree->branch_count - 1].leaves);
+    free(tree->branches[tree->branch_count - 1].dirty);
+    tree->branch_count--;
+    if (tree->branch_count == 0) {
+        free(tree->branches);
+        tree->branches = NULL;
+        return;
+    }
+    // Shrinking a block can't really fail, the larger block is kept if it does.
+    Branch* branches = realloc(tree->branches, tree->branch_count * sizeof(Branch));
+    if (branches != NULL) {
+        tree->branches = branches;
+    }
+}
+
+void prune_branch(Branch* branch) {
+    uint8_t* leaves = realloc(branch->leaves, branch->leaf_count / 2 * LEAF_LENGTH);
+    if (leaves != NULL) {
+        branch->leaves = leaves;
+    }
+    branch->leaf_count = branch->leaf_count / 2;
+    free(branch->dirty);
+    branch->dirty = NULL;
+}
+
+/* widen every branch and add branches above them until there are branch_count, the old root becoming the first
+   node of the first new branch; every block is allocated before anything changes, so a failure leaves the tree
+   as it was */
+int grow_tree(Tree* tree, int branch_count) {
+    if (branch_count <= tree->branch_count) {
+        return SUCCESS;
+    }
+    if (branch_count > MAX_BRANCHES) {
+        return MEMORY_ERROR;
+    }
+
+    // A deferred write marks the leaves it adds straight after growing, so their bitmaps come with the growth.
+    uint64_t* bitmaps[MAX_BRANCHES] = { NULL };
+    if (tree->deferred && alloc_bitmaps(branch_count, bitmaps) != SUCCESS) {
+        return MEMORY_ERROR;
+    }
+
+    int status = tree->mapping != NULL ? resize_file(tree, branch_count) : widen_branches(tree, branch_count);
+    for (int i = 0; i < branch_count; i++) {
+        if (status == SUCCESS) {
+            tree->branches[i].dirty = bitmaps[i];
+        } else {
+            free(bitmaps[i]);
+        }
+    }
+
+    return status;
+}
+
+/* grow_tree for a tree on the heap */
+int widen_branches(Tree* tree, int branch_count) {
+    int old_count = tree->branch_count;
+    Branch* branches = realloc(tree->branches, branch_count * sizeof(Branch));
+    if (branches == NULL) {
+        return MEMORY_ERROR;
+    }
+    tree->branches = branches;
+
+    for (int i = 0; i < branch_count; i++) {
+        size_t size = ((size_t) 2 << (branch_count - 1 - i)) * LEAF_LENGTH;
+        uint8_t* leaves = realloc(i < old_count ? branches[i].leaves : NULL, size);
+        if (leaves == NULL) {
+            // Branches already widened keep their larger blocks, only the new ones are dropped.
+            for (int j = old_count; j < i; j++) {
+                free(branches[j].leaves);
+            }
+            return MEMORY_ERROR;
+        }
+        branches[i].leaves = leaves;
+    }
+
+    for (int i = 0; i < branch_count; i++) {
+        int64_t old_size = i < old_count ? branches[i].leaf_count : 0;
+        branches[i].leaf_count = (int64_t) 2 << (branch_count - 1 - i);
+        memset(branches[i].leaves + old_size * LEAF_LENGTH, 0, (branches[i].leaf_count - old_size) * LEAF_LENGTH);
+        // Dirty state is flushed before any resize, so the bitmap is allocated again by the next write marking it.
+        if (i < old_count) {
+            free(branches[i].dirty);
+        }
+        branches[i].dirty = NULL;
+        branches[i].dirty_start = 0;
+        branches[i].dirty_end = 0;
+    }
+
+    memcpy(branches[old_count].leaves, tree->root, LEAF_LENGTH);
+    memcpy(tree->root, empty, LEAF_LENGTH);
+    tree->branch_count = branch_count;
+
+    return SUCCESS;
+}
+
+/* halve the capacity of every branch and drop the top branch */
+void shrink_tree(Tree* tree) {
+    for (int i = 0; i < tree->branch_count; i++) {
+        int64_t leaf_count = tree->branches[i].leaf_count;
+        save_nodes(tree, i, i + 1 == tree->branch_count ? 0 : leaf_count / 2, leaf_count);
+    }
+
+    if (tree->mapping != NULL) {
+        resize_file(tree, tree->branch_count - 1);
+        return;
+    }
+
+    for (int i = 0; i < tree->branch_count; i++) {
+        prune_branch(&tree->branches[i]);
+    }
+    remove_branch(tree);
+}
+
+/* sibling hashing backends, every internal node is the sha256 of exactly 64 bytes */
+const uint32_t sha256_k[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+};
+
+/* the second block of a 64 byte message is all padding, so its schedule plus round constants is fixed */
+uint32_t padding_schedule[64];
+
+void hash_pairs_openssl(const uint8_t* in, uint8_t* out, int64_t count) {
+    for (int64_t i = 0; i < count; i++) {
+        SHA256(in + i * 2 * LEAF_LENGTH, 2 * LEAF_LENGTH, out + i * LEAF_LENGTH);
+    }
+}
+
+#if defined(__x86_64__) || defined(__i386__)
+#define SHA_LANES 2
+
+/* sha256 of count 64 byte messages with the SHA extensions, two messages in flight to hide round latency */
+__attribute__((target("sha,sse4.1")))
+void hash_pairs_shani(const uint8_t* in, uint8_t* out, int64_t count) {
+    const __m128i mask = _mm_set_epi64x(0x0c0d0e0f08090a0bULL, 0x0405060700010203ULL);
+    // The initial state packed as ABEF and CDGH, the layout sha256rnds2 works on.
+    const __m128i initial_abef = _mm_set_epi32(0x6a09e667, 0xbb67ae85, 0x510e527f, 0x9b05688c);
+    const __m128i initial_cdgh = _mm_set_epi32(0x3c6ef372, 0xa54ff53a, 0x1f83d9ab, 0x5be0cd19);
+
+    for (int64_t i = 0; i < count; i += SHA_LANES) {
+        int lanes = count - i < SHA_LANES ? count - i : SHA_LANES;
+        __m128i abef[SHA_LANES], cdgh[SHA_LANES], words[SHA_LANES][4];
+
+        for (int l = 0; l < SHA_LANES; l++) {
+            // A missing last lane rehashes the one before, its output is never stored.
+            const uint8_t* message = in + (i + (l < lanes ? l : 0)) * 2 * LEAF_LENGTH;
+            abef[l] = initial_abef;
+            cdgh[l] = initial_cdgh;
+            for (int w = 0; w < 4; w++) {
+                words[l][w] = _mm_shuffle_epi8(_mm_loadu_si128((const __m128i*) (message + 16 * w)), mask);
+            }
+        }
+
+        for (int group = 0; group < 16; group++) {
+            __m128i k = _mm_loadu_si128((const __m128i*) (sha256_k + 4 * group));
+            for (int l = 0; l < SHA_LANES; l++) {
+                __m128i* w = words[l];
+                if (group >= 4) {
+                    __m128i next = _mm_sha256msg1_epu32(w[group % 4], w[(group + 1) % 4]);
+                    next = _mm_add_epi32(next, _mm_alignr_epi8(w[(group + 3) % 4], w[(group + 2) % 4], 4));
+                    w[group % 4] = _mm_sha256msg2_epu32(next, w[(group + 3) % 4]);
+                }
+                __m128i rounds = _mm_add_epi32(w[group % 4], k);
+                cdgh[l] = _mm_sha256rnds2_epu32(cdgh[l], abef[l], rounds);
+                abef[l] = _mm_sha256rnds2_epu32(abef[l], cdgh[l], _mm_shuffle_epi32(rounds, 0x0e));
+            }
+        }
+
+        __m128i first_abef[SHA_LANES], first_cdgh[SHA_LANES];
+        for (int l = 0; l < SHA_LANES; l++) {
+            abef[l] = first_abef[l] = _mm_add_epi32(abef[l], initial_abef);
+            cdgh[l] = first_cdgh[l] = _mm_add_epi32(cdgh[l], initial_cdgh);
+        }
+
+        for (int group = 0; group < 16; group++) {
+            __m128i rounds = _mm_loadu_si128((const __m128i*) (padding_schedule + 4 * group));
+            for (int l = 0; l < SHA_LANES; l++) {
+                cdgh[l] = _mm_sha256rnds2_epu32(cdgh[l], abef[l], rounds);
+                abef[l] = _mm_sha256rnds2_epu32(abef[l], cdgh[l], _mm_shuffle_epi32(rounds, 0x0e));
+            }
+        }
+
+        for (int l = 0; l < lanes; l++) {
+            abef[l] = _mm_add_epi32(abef[l], first_abef[l]);
+            cdgh[l] = _mm_add_epi32(cdgh[l], first_cdgh[l]);
+
+            // Back from ABEF/CDGH to ABCD/EFGH, big endian.
+            __m128i feba = _mm_shuffle_epi32(abef[l], 0x1b);
+            __m128i dchg = _mm_shuffle_epi32(cdgh[l], 0xb1);
+            __m128i dcba = _mm_blend_epi16(feba, dchg, 0xf0);
+            __m128i hgfe = _mm_alignr_epi8(dchg, feba, 8);
+            uint8_t* digest = out + (i + l) * LEAF_LENGTH;
+            _mm_storeu_si128((__m128i*) digest, _mm_shuffle_epi8(dcba, mask));
+            _mm_storeu_si128((__m128i*) (digest + 16), _mm_shuffle_epi8(hgfe, mask));
+        }
+    }
+}
+
+_Bool cpu_has_sha(void) {
+    unsigned int eax, ebx, ecx, edx;
+    if (!__get_cpuid(1, &eax, &ebx, &ecx, &edx) || !(ecx & bit_SSE4_1) || !(ecx & bit_SSSE3)) {
+        return 0;
+    }
+    if (__get_cpuid_max(0, NULL) < 7) {
+        return 0;
+    }
+    __cpuid_count(7, 0, eax, ebx, ecx, edx);
+    return (ebx & bit_SHA) != 0;
+}
+#else
+_Bool cpu_has_sha(void) {
+    return 0;
+}
+#endif
+
+void (*hash_pairs)(const uint8_t* in, uint8_t* out, int64_t count) = hash_pairs_openssl;
+
+/* pick the fastest backend the cpu supports once, before any tree is used */
+__attribute__((constructor))
+void init_hashing(void) {
+    uint32_t w[64] = {0x80000000};
+    w[15] = 2 * LEAF_LENGTH * 8;
+    for (int i = 16; i < 64; i++) {
+        uint32_t s0 = (w[i - 15] >> 7 | w[i - 15] << 25) ^ (w[i - 15] >> 18 | w[i - 15] << 14) ^ w[i - 15] >> 3;
+        uint32_t s1 = (w[i - 2] >> 17 | w[i - 2] << 15) ^ (w[i - 2] >> 19 | w[i - 2] << 13) ^ w[i - 2] >> 10;
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+    for (int i = 0; i < 64; i++) {
+        padding_schedule[i] = w[i] + sha256_k[i];
+    }
+
+    set_hash_backend(cpu_has_sha() ? "shani" : "openssl");
+}
+
+/* the backend used for sibling hashing, for tests and benchmarks; must not change while trees are hashed */
+int set_hash_backend(char* name) {
+    if (strcmp(name, "openssl") == 0) {
+        hash_pairs = hash_pairs_openssl;
+        return SUCCESS;
+    }
+#if defined(__x86_64__) || defined(__i386__)
+    if (strcmp(name, "shani") == 0 && cpu_has_sha()) {
+        hash_pairs = hash_pairs_shani;
+        return SUCCESS;
+    }
+#endif
+    return FORMAT_ERROR;
+}
+
+const char* get_hash_backend(void) {
+    return hash_pairs == hash_pairs_openssl ? "openssl" : "shani";
+}
+
+/* the hash functions a tree can use, recorded in the flags of the marshalled header */
+enum hash_id {HASH_SHA256 = 0, HASH_SHA256D = 1, HASH_BLAKE2S = 2, HASH_COUNT = 3};
+
+#define ROTR32(x, n) ((x) >> (n) | (x) << (32 - (n)))
+
+const uint32_t sha256_iv[8] = {
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+};
+
+/* replace a sha256 digest with the sha256 of it, the outer round of sha256d */
+void sha256_digest(uint8_t* digest) {
+    uint8_t inner[LEAF_LENGTH];
+    memcpy(inner, digest, LEAF_LENGTH);
+    SHA256(inner, LEAF_LENGTH, digest);
+}
+
+const uint8_t blake2s_sigma[10][16] = {
+    {0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15},
+    {14, 10, 4, 8, 9, 15, 13, 6, 1, 12, 0, 2, 11, 7, 5, 3},
+    {11, 8, 12, 0, 5, 2, 15, 13, 10, 14, 3, 6, 7, 1, 9, 4},
+    {7, 9, 3, 1, 13, 12, 11, 14, 2, 6, 5, 10, 4, 0, 15, 8},
+    {9, 0, 5, 7, 2, 4, 10, 15, 14, 1, 11, 12, 6, 8, 3, 13},
+    {2, 12, 6, 10, 0, 11, 8, 3, 4, 13, 7, 5, 15, 14, 1, 9},
+    {12, 5, 1, 15, 14, 13, 4, 10, 0, 7, 6, 3, 9, 2, 8, 11},
+    {13, 11, 7, 14, 12, 1, 3, 9, 5, 0, 15, 4, 8, 6, 2, 10},
+    {6, 15, 14, 9, 11, 3, 0, 8, 12, 2, 13, 7, 1, 4, 10, 5},
+    {10, 2, 8, 4, 7, 6, 1, 5, 15, 11, 9, 14, 3, 12, 13, 0},
+};
+
+#define BLAKE2S_G(a, b, c, d, x, y) \
+    a += b + x; d = ROTR32(d ^ a, 16); c += d; b = ROTR32(b ^ c, 12); \
+    a += b + y; d = ROTR32(d ^ a, 8); c += d; b = ROTR32(b ^ c, 7);
+
+void blake2s_compress(uint32_t* h, const uint8_t* block, uint64_t counter, _Bool last) {
+    uint32_t m[16];
+    uint32_t v[16];
+    for (int i = 0; i < 16; i++) {
+        m[i] = get_uint(block + 4 * i, 4);
+    }
+    memcpy(v, h, 8 * sizeof(uint32_t));
+    memcpy(v + 8, sha256_iv, 8 * sizeof(uint32_t));
+    v[12] ^= (uint32_t) counter;
+    v[13] ^= (uint32_t) (counter >> 32);
+    if (last) {
+        v[14] = ~v[14];
+    }
+
+    for (int r = 0; r < 10; r++) {
+        const uint8_t* s = blake2s_sigma[r];
+        BLAKE2S_G(v[0], v[4], v[8], v[12], m[s[0]], m[s[1]]);
+        BLAKE2S_G(v[1], v[5], v[9], v[13], m[s[2]], m[s[3]]);
+        BLAKE2S_G(v[2], v[6], v[10], v[14], m[s[4]], m[s[5]]);
+        BLAKE2S_G(v[3], v[7], v[11], v[15], m[s[6]], m[s[7]]);
+        BLAKE2S_G(v[0], v[5], v[10], v[15], m[s[8]], m[s[9]]);
+        BLAKE2S_G(v[1], v[6], v[11], v[12], m[s[10]], m[s[11]]);
+        BLAKE2S_G(v[2], v[7], v[8], v[13], m[s[12]], m[s[13]]);
+        BLAKE2S_G(v[3], v[4], v[9], v[14], m[s[14]], m[s[15]]);
+    }
+
+    for (int i = 0; i < 8; i++) {
+        h[i] ^= v[i] ^ v[i + 8];
+    }
+}
+
+/* unkeyed blake2s with a 32 byte digest, its initial vector is sha256's */
+void blake2s(const uint8_t* in, size_t len, uint8_t* out) {
+    uint32_t h[8];
+    memcpy(h, sha256_iv, sizeof(h));
+    h[0] ^= 0x01010000 | LEAF_LENGTH;
+
+    size_t offset = 0;
+    for (; len - offset > 64; offset += 64) {
+        blake2s_compress(h, in + offset, offset + 64, 0);
+    }
+
+    uint8_t block[64] = {0};
+    memcpy(block, in + offset, len - offset);
+    blake2s_compress(h, block, len, 1);
+
+    for (int i = 0; i < 8; i++) {
+        put_uint(out + 4 * i, h[i], 4);
+    }
+}
+
+/* hash a leaf with the tree's hash function */
+void hash(int hash_id, const uint8_t* in, size_t len, uint8_t* out) {
+    if (hash_id == HASH_BLAKE2S) {
+        blake2s(in, len, out);
+        return;
+    }
+
+    SHA256(in, len, out);
+    if (hash_id == HASH_SHA256D) {
+        sha256_digest(out);
+    }
+}
+
+/* hash count sibling pairs laid out back to back, sha256 going through the fastest backend */
+void hash_siblings(int hash_id, const uint8_t* in, uint8_t* out, int64_t count) {
+    if (hash_id == HASH_BLAKE2S) {
+        for (int64_t i = 0; i < count; i++) {
+            blake2s(in + i * 2 * LEAF_LENGTH, 2 * LEAF_LENGTH, out + i * LEAF_LENGTH);
+        }
+        return;
+    }
+
+    hash_pairs(in, out, count);
+    if (hash_id == HASH_SHA256D) {
+        for (int64_t i = 0; i < count; i++) {
+            sha256_digest(out + i * LEAF_LENGTH);
+        }
+    }
+}
+
+/* hashing writes into caller owned buffers only, so trees can be used from many threads at once */
+void hash_pair(int hash_id, const uint8_t* left, const uint8_t* right, uint8_t* out) {
+    uint8_t in[2 * LEAF_LENGTH];
+    memcpy(in, left, LEAF_LENGTH);
+    memcpy(in + LEAF_LENGTH, right, LEAF_LENGTH);
+
+    hash_siblings(hash_id, in, out, 1);
+}
+
+/* number of populated nodes in a branch, branch_count refers to the root */
+int64_t level_count(Tree* tree, int branch_index) {
+    if (tree->leaf_count == 0) {
+        return 0;
+    }
+    return ((tree->leaf_count - 1) >> branch_index) + 1;
+}
+
+/* hash the parents [start_index, end_index) of a branch into the branch above */
+void hash_level(Tree* tree, int branch_index, int64_t start_index, int64_t end_index) {
+    uint8_t* leaves = tree->branches[branch_index].leaves;
+    uint8_t* parents = branch_index + 1 == tree->branch_count ? tree->root : tree->branches[branch_index + 1].leaves;
+
+    if (branch_index + 1 < tree->branch_count) {
+        save_nodes(tree, branch_index + 1, start_index, end_index);
+    }
+
+    run_parallel(tree->workers, hash_slice, (Slice) {leaves, NULL, parents, start_index, end_index, tree->hash_id});
+}
+
+/* split a slice into one contiguous share per worker, the calling thread taking the first. The other
+   shares run on threads started for this call and joined before it returns, there are no threads kept
+   between calls; below PARALLEL_THRESHOLD that start-up would cost more than it saves. */
+void run_parallel(int workers, void* (*work)(void*), Slice slice) {
+    if (workers < 2 || slice.end_index - slice.start_index < PARALLEL_THRESHOLD) {
+        work(&slice);
+        return;
+    }
+
+    pthread_t threads[MAX_WORKERS];
+    _Bool started[MAX_WORKERS];
+    Slice slices[MAX_WORKERS];
+    int64_t start_index = slice.start_index;
+    int64_t end_index = slice.end_index;
+    int64_t step = (end_index - start_index + workers - 1) / workers;
+
+    for (int w = 0; w < workers; w++) {
+        slices[w] = slice;
+        slices[w].start_index = start_index + w * step < end_index ? start_index + w * step : end_index;
+        slices[w].end_index = slices[w].start_index + step < end_index ? slices[w].start_index + step : end_index;
+        started[w] = w > 0 && pthread_create(&threads[w], NULL, work, &slices[w]) == 0;
+    }
+
+    for (int w = 0; w < workers; w++) {
+        if (started[w]) {
+            pthread_join(threads[w], NULL);
+        } else {
+            // The first share, or one whose thread could not be started.
+            work(&slices[w]);
+        }
+    }
+}
+
+void* hash_slice(void* arg) {
+    Slice* slice = arg;
+    // Siblings sit side by side, so a run of parents is one run of 64 byte messages.
+    int64_t count = slice->end_index - slice->start_index;
+    hash_siblings(slice->hash_id, slice->in + 2 * slice->start_index * LEAF_LENGTH, slice->out + slice->start_index * LEAF_LENGTH, count);
+    return NULL;
+}
+
+void* hash_leaf_slice(void* arg) {
+    Slice* slice = arg;
+    for (int64_t i = slice->start_index; i < slice->end_index; i++) {
+        const uint64_t* offsets = slice->offsets;
+        hash(slice->hash_id, slice->in + offsets[i], offsets[i + 1] - offsets[i], slice->out + i * LEAF_LENGTH);
+    }
+    return NULL;
+}
+
+/* choose the hash function of an empty tree */
+int set_hash(Tree* tree, int hash_id) {
+    if (hash_id < 0 || hash_id >= HASH_COUNT || tree->leaf_count > 0) {
+        return FORMAT_ERROR;
+    }
+    tree->hash_id = hash_id;
+    return SUCCESS;
+}
+
+/* hash wide levels on up to workers threads, started per level, 1 keeps all hashing on the calling thread */
+void set_workers(Tree* tree, int workers) {
+    tree->workers = workers < 1 ? 1 : workers > MAX_WORKERS ? MAX_WORKERS : workers;
+}
+
+/* create and return a new tree, hashing each level once from the bottom up, or NULL when out of memory */
+Tree* new_tree(unsigned char* leaves[], int64_t count) {
+    Tree* tree = malloc(sizeof(Tree));
+    if (tree == NULL) {
+        return NULL;
+    }
+
+    tree->root = calloc(1, LEAF_LENGTH);
+    tree->branches = NULL;
+    tree->branch_count = 0;
+    tree->leaf_count = 0;
+    tree->deferred = 0;
+    tree->dirty = 0;
+    tree->dirty_count = 0;
+    tree->fd = -1;
+    tree->mapping = NULL;
+    tree->mapping_length = 0;
+    tree->snapshots = NULL;
+    tree->workers = 1;
+    tree->hash_id = HASH_SHA256;
+    tree->lookup = NULL;
+    tree->lookup_capacity = 0;
+    tree->lookup_count = 0;
+
+    if (tree->root == NULL) {
+        free(tree);
+        return NULL;
+    }
+    if (count == 0) {
+        return tree;
+    }
+    if (grow_tree(tree, branches_for(count)) != SUCCESS) {
+        free_tree(tree);
+        return NULL;
+    }
+
+    tree->leaf_count = count;
+    for (int64_t i = 0; i < count; i++) {
+        memcpy(tree->branches[0].leaves + i * LEAF_LENGTH, leaves[i], LEAF_LENGTH);
+    }
+
+    for (int i = 0; i < tree->branch_count; i++) {
+        hash_level(tree, i, 0, level_count(tree, i + 1));
+    }
+
+    return tree;
+}
+
+unsigned char* get_root(Tree *tree) {
+    flush(tree);
+    return tree->root;
+}
+
+/* in deferred mode writes only mark nodes dirty, the root is recomputed on the next read */
+void set_deferred(Tree* tree, _Bool deferred) {
+    tree->deferred = deferred;
+    if (!deferred) {
+        flush(tree);
+    }
+}
+
+/* a zeroed bitmap for each branch of a tree with branch_count branches, all or none of them */
+int alloc_bitmaps(int branch_count, uint64_t** bitmaps) {
+    for (int i = 0; i < branch_count; i++) {
+        bitmaps[i] = calloc((((int64_t) 2 << (branch_count - 1 - i)) + 63) / 64, sizeof(uint64_t));
+        if (bitmaps[i] == NULL) {
+            for (int j = 0; j < i; j++) {
+                free(bitmaps[j]);
+                bitmaps[j] = NULL;
+            }
+            return MEMORY_ERROR;
+        }
+    }
+    return SUCCESS;
+}
+
+/* allocate the bitmap of every branch that has none, called by a write that marks nodes dirty before it changes
+   anything; marking a node is then only setting its bit, and flush marks parents in every branch above */
+int reserve_dirty(Tree* tree) {
+    for (int i = 0; i < tree->branch_count; i++) {
+        Branch* branch = &tree->branches[i];
+        if (branch->dirty == NULL) {
+            branch->dirty = calloc((branch->leaf_count + 63) / 64, sizeof(uint64_t));
+            if (branch->dirty == NULL) {
+                return MEMORY_ERROR;
+            }
+            branch->dirty_start = 0;
+            branch->dirty_end = 0;
+        }
+    }
+    return SUCCESS;
+}
+
+void mark_dirty(Tree* tree, int branch_index, int64_t index) {
+    Branch* branch = &tree->branches[branch_index];
+
+    if (branch->dirty_start == branch->dirty_end) {
+        branch->dirty_start = index;
+        branch->dirty_end = index + 1;
+    } else if (index < branch->dirty_start) {
+        branch->dirty_start = index;
+    } else if (index >= branch->dirty_end) {
+        branch->dirty_end = index + 1;
+    }
+
+    branch->dirty[index / 64] |= (uint64_t) 1 << (index % 64);
+    tree->dirty = 1;
+    if (branch_index == 0) {
+        tree->dirty_count++;
+    }
+}
+
+void mark_range(Tree* tree, int branch_index, int64_t start_index, int64_t end_index) {
+    for (int64_t i = start_index; i < end_index; i++) {
+        mark_dirty(tree, branch_index, i);
+    }
+}
+
+/* rehash the parents of every dirty node, one level at a time from the leaves up */
+void flush(Tree* tree) {
+    if (!tree->dirty) {
+        return;
+    }
+
+    for (int i = 0; i < tree->branch_count; i++) {
+        Branch* branch = &tree->branches[i];
+        if (branch->dirty == NULL || branch->dirty_start == branch->dirty_end) {
+            continue;
+        }
+
+        int64_t parent_count = level_count(tree, i + 1);
+        uint8_t* parents = i + 1 == tree->branch_count ? tree->root : tree->branches[i + 1].leaves;
+        // Consecutive dirty parents are hashed as one run, so wide updates can be split across workers.
+        int64_t run_start = 0;
+        int64_t run_end = 0;
+
+        for (int64_t word = branch->dirty_start / 64; word <= (branch->dirty_end - 1) / 64; word++) {
+            uint64_t bits = branch->dirty[word];
+            branch->dirty[word] = 0;
+
+            while (bits) {
+                int bit = __builtin_ctzll(bits);
+                // Both children share a parent, hash it once.
+                bits &= ~((uint64_t) 3 << (bit & ~1));
+
+                int64_t parent_index = get_parent_index(word * 64 + bit);
+                if (parent_index < parent_count) {
+                    if (parent_index != run_end) {
+                        hash_level(tree, i, run_start, run_end);
+                        run_start = parent_index;
+                    }
+                    run_end = parent_index + 1;
+                } else {
+                    if (i + 1 < tree->branch_count) {
+                        save_nodes(tree, i + 1, parent_index, parent_index + 1);
+                    }
+                    memcpy(parents + parent_index * LEAF_LENGTH, empty, LEAF_LENGTH);
+                }
+
+                if (i + 1 < tree->branch_count) {
+                    mark_dirty(tree, i + 1, parent_index);
+                }
+            }
+        }
+
+        hash_level(tree, i, run_start, run_end);
+
+        branch->dirty_start = 0;
+        branch->dirty_end = 0;
+    }
+
+    tree->dirty = 0;
+    tree->dirty_count = 0;
+}
+
+void update_parent(Tree* tree, int branch_index, int64_t leaf_index, _Bool recurse) {
+    uint8_t leaf[LEAF_LENGTH];
+    uint8_t sibling[LEAF_LENGTH];
+    memcpy(leaf, tree->branches[branch_index].leaves + leaf_index * LEAF_LENGTH, LEAF_LENGTH);
+    int64_t sibling_index = get_sibling_index(leaf_index);
+    memcpy(sibling, tree->branches[branch_index].leaves + sibling_index * LEAF_LENGTH, LEAF_LENGTH);
+
+    uint8_t parent[LEAF_LENGTH];
+    if (strcmp(side(leaf_index), "L") == 0) {
+        hash_pair(tree->hash_id, leaf, sibling, parent);
+    } else {
+        hash_pair(tree->hash_id, sibling, leaf, parent);
+    }
+
+    if (branch_index + 1 == tree->branch_count) {
+        memcpy(tree->root, parent, LEAF_LENGTH);
+    } else {
+        int64_t parent_index = get_parent_index(leaf_index);
+        save_nodes(tree, branch_index + 1, parent_index, parent_index + 1);
+        replace(tree->branches[branch_index + 1].leaves, parent, parent_index);
+        if (recurse) {
+            update_parent(tree, branch_index + 1, parent_index, 1);
+        }
+    }
+}
+
+void rebuild_branch(Tree* tree, int branch_index, int64_t start_index, int64_t end_index) {
+    if (end_index + 1 < tree->branches[branch_index].leaf_count) {
+        save_nodes(tree, branch_index, end_index + 1, end_index + 2);
+        replace(tree->branches[branch_index].leaves, empty, end_index + 1);
+    }
+    start_index = strcmp(side(start_index), "L") == 0 ? start_index : start_index - 1;
+    end_index = strcmp(side(end_index), "L") == 0 ? end_index + 1: end_index;
+
+    hash_level(tree, branch_index, start_index / 2, (end_index + 1) / 2);
+    
+    start_index = get_parent_index(start_index);
+    end_index = get_parent_index(end_index);
+
+    if (branch_index + 1 < tree->branch_count) {
+        rebuild_branch(tree, branch_index + 1, start_index, end_index);
+    }
+}
+
+int add_leaf(Tree* tree, uint8_t* leaf, size_t len, _Bool hashed) {
+    uint8_t digest[LEAF_LENGTH];
+    if (!hashed) {
+        hash(tree->hash_id, leaf, len, digest);
+        leaf = digest;
+    }
+
+    // Everything the write allocates is reserved before the tree grows, so a failure leaves the tree as it was.
+    int status = lookup_reserve(tree, tree->leaf_count + 1);
+    _Bool grow = tree->branch_count == 0 || tree->leaf_count + 1 > tree->branches[0].leaf_count;
+    int branch_count = grow ? tree->branch_count + 1 : tree->branch_count;
+    if (status == SUCCESS && tree->deferred) {
+        status = reserve_dirty(tree);
+    }
+    if (status == SUCCESS) {
+        status = reserve_saves(tree, write_saves(tree, branch_count, tree->leaf_count, tree->leaf_count + 1, 1));
+    }
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    if (grow) {
+        flush(tree);
+        status = grow_tree(tree, branch_count);
+        if (status != SUCCESS) {
+            return status;
+        }
+    }
+
+    int64_t index = tree->leaf_count;
+
+    save_nodes(tree, 0, index, index + 1);
+    replace(tree->branches[0].leaves, leaf, tree->leaf_count);
+
+    tree->leaf_count++;
+    store_header(tree);
+    lookup_insert(tree, index);
+
+    if (tree->deferred) {
+        mark_dirty(tree, 0, index);
+    } else {
+        update_parent(tree, 0, index, 1);
+    }
+
+    return SUCCESS;
+}
+
+/* append count hashed leaves, then rehash each level across the appended range once */
+int add_leaves(Tree* tree, uint8_t* leaves, int64_t count) {
+    if (count == 0) {
+        return SUCCESS;
+    }
+
+    int status = lookup_reserve(tree, tree->leaf_count + count);
+    _Bool grow = tree->branch_count == 0 || tree->leaf_count + count > tree->branches[0].leaf_count;
+    int branch_count = grow ? branches_for(tree->leaf_count + count) : tree->branch_count;
+    if (status == SUCCESS && tree->deferred) {
+        status = reserve_dirty(tree);
+    }
+    if (status == SUCCESS) {
+        int64_t saves = write_saves(tree, branch_count, tree->leaf_count, tree->leaf_count + count, count);
+        status = reserve_saves(tree, saves);
+    }
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    if (grow) {
+        flush(tree);
+        status = grow_tree(tree, branch_count);
+        if (status != SUCCESS) {
+            return status;
+        }
+    }
+
+    int64_t start_index = tree->leaf_count;
+    int64_t end_index = tree->leaf_count + count;
+
+    save_nodes(tree, 0, start_index, end_index);
+    memcpy(tree->branches[0].leaves + start_index * LEAF_LENGTH, leaves, count * LEAF_LENGTH);
+    tree->leaf_count = end_index;
+    store_header(tree);
+    for (int64_t i = start_index; i < end_index; i++) {
+        lookup_insert(tree, i);
+    }
+
+    if (tree->deferred) {
+        mark_range(tree, 0, start_index, end_index);
+        return SUCCESS;
+    }
+
+    for (int i = 0; i < tree->branch_count; i++) {
+        start_index = get_parent_index(start_index);
+        end_index = get_parent_index(end_index - 1) + 1;
+        hash_level(tree, i, start_index, end_index);
+    }
+
+    return SUCCESS;
+}
+
+/* hash count raw leaves, leaf i being data[offsets[i]:offsets[i + 1]], into out */
+int hash_raw_leaves(int hash_id, int workers, uint8_t* data, size_t length, uint64_t* offsets, int64_t count, uint8_t* out) {
+    for (int64_t i = 0; i < count; i++) {
+        if (offsets[i] > offsets[i + 1] || offsets[i + 1] > length) {
+            return FORMAT_ERROR;
+        }
+    }
+
+    run_parallel(workers, hash_leaf_slice, (Slice) {data, offsets, out, 0, count, hash_id});
+    return SUCCESS;
+}
+
+/* hash count raw leaves into out with the tree's hash and workers */
+int hash_leaves(Tree* tree, uint8_t* data, size_t length, uint64_t* offsets, int64_t count, uint8_t* out) {
+    return hash_raw_leaves(tree->hash_id, tree->workers, data, length, offsets, count, out);
+}
+
+/* hash count raw leaves as hash_leaves does and append them */
+int add_raw_leaves(Tree* tree, uint8_t* data, size_t length, uint64_t* offsets, int64_t count) {
+    uint8_t* leaves = malloc((size_t) count * LEAF_LENGTH + 1);
+    if (leaves == NULL) {
+        return MEMORY_ERROR;
+    }
+
+    int status = hash_leaves(tree, data, length, offsets, count, leaves);
+    if (status == SUCCESS) {
+        status = add_leaves(tree, leaves, count);
+    }
+    free(leaves);
+
+    return status;
+}
+
+/* write count hashed leaves at indexes, then rehash only the dirty parents once per level */
+int update_leaves(Tree* tree, uint8_t* leaves, int64_t* indexes, int64_t count) {
+    int64_t start_index = tree->leaf_count;
+    int64_t end_index = 0;
+    for (int64_t i = 0; i < count; i++) {
+        if (indexes[i] >= tree->leaf_count || indexes[i] < 0) {
+            if (indexes[i] < 0) {
+                return EMPTY;
+            }
+            return INDEX_ERROR;
+        }
+        start_index = indexes[i] < start_index ? indexes[i] : start_index;
+        end_index = indexes[i] + 1 > end_index ? indexes[i] + 1 : end_index;
+    }
+
+    if (count == 0) {
+        return SUCCESS;
+    }
+
+    int status = reserve_dirty(tree);
+    if (status == SUCCESS) {
+        status = reserve_saves(tree, write_saves(tree, tree->branch_count, start_index, end_index, count));
+    }
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    for (int64_t i = 0; i < count; i++) {
+        save_nodes(tree, 0, indexes[i], indexes[i] + 1);
+        lookup_remove(tree, indexes[i]);
+        memcpy(tree->branches[0].leaves + indexes[i] * LEAF_LENGTH, leaves + i * LEAF_LENGTH, LEAF_LENGTH);
+        lookup_insert(tree, indexes[i]);
+        mark_dirty(tree, 0, indexes[i]);
+    }
+
+    if (!tree->deferred) {
+        flush(tree);
+    }
+
+    return SUCCESS;
+}
+
+int update_leaf(Tree *tree, uint8_t *leaf, int64_t index, size_t len, _Bool hashed) {
+    if (index >= tree->leaf_count || index < 0) {
+        if (index < 0) {
+            return EMPTY;
+        }
+        return INDEX_ERROR;
+    }
+
+    int status = tree->deferred ? reserve_dirty(tree) : SUCCESS;
+    if (status == SUCCESS) {
+        status = reserve_saves(tree, write_saves(tree, tree->branch_count, index, index + 1, 1));
+    }
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    uint8_t digest[LEAF_LENGTH];
+    if (!hashed) {
+        hash(tree->hash_id, leaf, len, digest);
+        leaf = digest;
+    }
+
+    save_nodes(tree, 0, index, index + 1);
+    lookup_remove(tree, index);
+    replace(tree->branches[0].leaves, leaf, index);
+    lookup_insert(tree, index);
+
+    if (tree->deferred) {
+        mark_dirty(tree, 0, index);
+    } else {
+        update_parent(tree, 0, index, 1);
+    }
+
+    return SUCCESS;
+}
+
+int remove_leaf(Tree *tree, int64_t index) {
+    if (index >= tree->leaf_count || index < 0) {
+        if (index < 0) {
+            return EMPTY;
+        }
+        return INDEX_ERROR;
+    }
+
+    // Rebuilding clears one node past the end at every level, and removing down to half the capacity shrinks the
+    // tree.
+    int64_t left = tree->leaf_count - 1;
+    _Bool shrink = left == 0 || (left > 1 && left <= tree->branches[0].leaf_count / 2);
+    int64_t saves = write_saves(tree, tree->branch_count, index, tree->leaf_count, tree->leaf_count - index);
+    int status = tree->deferred ? reserve_dirty(tree) : SUCCESS;
+    if (status == SUCCESS) {
+        status = reserve_saves(tree, saves + tree->branch_count + (shrink ? shrink_saves(tree) : 0));
+    }
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    save_nodes(tree, 0, index, tree->leaf_count);
+    lookup_remove(tree, index);
+    lookup_shift(tree, index);
+    delete(tree->branches[0].leaves, tree->branches[0].leaf_count, index);
+
+    tree->leaf_count--;
+    store_header(tree);
+
+    if (tree->deferred) {
+        mark_range(tree, 0, index, tree->leaf_count + 1);
+    }
+
+    if (tree->leaf_count == 0) {
+        shrink_tree(tree);
+        memcpy(tree->root, empty, LEAF_LENGTH);
+        tree->dirty = 0;
+        tree->dirty_count = 0;
+    } else if (tree->leaf_count > 1 && tree->leaf_count <= tree->branches[0].leaf_count / 2) {
+        flush(tree);
+        shrink_tree(tree);
+    }
+
+    if (!tree->deferred && tree->branch_count > 0) {
+        index = index == tree->branches[0].leaf_count ? index - 1 : index;
+
+        rebuild_branch(tree, 0, index, tree->leaf_count - 1);
+    }
+
+    return SUCCESS;
+}
+
+/* remove a leaf by moving the last leaf into its place, so only the two paths to the root are rehashed */
+int swap_remove_leaf(Tree* tree, int64_t index) {
+    if (index >= tree->leaf_count || index < 0) {
+        if (index < 0) {
+            return EMPTY;
+        }
+        return INDEX_ERROR;
+    }
+
+    int64_t last = tree->leaf_count - 1;
+    uint8_t* leaves = tree->branches[0].leaves;
+
+    _Bool shrink = last == 0 || (last > 1 && last <= tree->branches[0].leaf_count / 2);
+    int64_t saves = write_saves(tree, tree->branch_count, index, last + 1, 2);
+    int status = reserve_dirty(tree);
+    if (status == SUCCESS) {
+        status = reserve_saves(tree, saves + (shrink ? shrink_saves(tree) : 0));
+    }
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    save_nodes(tree, 0, index, index + 1);
+    save_nodes(tree, 0, last, last + 1);
+    lookup_remove(tree, index);
+    if (index != last) {
+        lookup_remove(tree, last);
+    }
+    memmove(leaves + index * LEAF_LENGTH, leaves + last * LEAF_LENGTH, LEAF_LENGTH);
+    memcpy(leaves + last * LEAF_LENGTH, empty, LEAF_LENGTH);
+    if (index != last) {
+        lookup_insert(tree, index);
+    }
+
+    tree->leaf_count--;
+    store_header(tree);
+
+    if (tree->leaf_count == 0) {
+        shrink_tree(tree);
+        memcpy(tree->root, empty, LEAF_LENGTH);
+        tree->dirty = 0;
+        tree->dirty_count = 0;
+        return SUCCESS;
+    }
+
+    // flush zeroes the parents left without leaves as it rehashes both paths.
+    mark_dirty(tree, 0, index);
+    mark_dirty(tree, 0, last);
+
+    if (tree->leaf_count > 1 && tree->leaf_count <= tree->branches[0].leaf_count / 2) {
+        flush(tree);
+        shrink_tree(tree);
+    }
+
+    if (!tree->deferred) {
+        flush(tree);
+    }
+
+    return SUCCESS;
+}
+
+int check_index(Tree* tree, int64_t index) {
+    if (index >= tree->leaf_count || index < 0) {
+        if (index < 0) {
+            return EMPTY;
+        }
+        return INDEX_ERROR;
+    }
+    return SUCCESS;
+}
+
+void write_proof(Tree* tree, int64_t index, uint8_t* siblings) {
+    for (int i = 0; i < tree->branch_count; i++) {
+        memcpy(siblings + i * LEAF_LENGTH, tree->branches[i].leaves + get_sibling_index(index) * LEAF_LENGTH, LEAF_LENGTH);
+        index = get_parent_index(index);
+    }
+}
+
+/* write the sibling of every node on the path from a leaf to the root, followed by the root */
+int get_proof(Tree* tree, int64_t index, uint8_t* siblings) {
+    int status = check_index(tree, index);
+    if (status != SUCCESS) {
+        return status;
+    }
+
+    flush(tree);
+
+    write_proof(tree, index, siblings);
+    memcpy(siblings + tree->branch_count * LEAF_LENGTH, tree->root, LEAF_LENGTH);
+
+    return SUCCESS;
+}
+
+/* write the siblings of count proofs back to back, followed by the shared root */
+int get_proofs(Tree* tree, int64_t* indexes, int64_t count, uint8_t* siblings) {
+    for (int64_t i = 0; i < count; i++) {
+        int status = check_index(tree, indexes[i]);
+        if (status != SUCCESS) {
+            return status;
+        }
+    }
+
+    flush(tree);
+
+    int64_t proof_length = tree->branch_count * LEAF_LENGTH;
+    for (int64_t i = 0; i < count; i++) {
+        write_proof(tree, indexes[i], siblings + i * proof_length);
+    }
+    memcpy(siblings + count * proof_length, tree->root, LEAF_LENGTH);
+
+    return SUCCESS;
+}
+
+/* copy count nodes given by level and index, the level above the top branch holding only the root */
+int get_nodes(Tree* tree, int* levels, int64_t* indexes, int64_t count, uint8_t* nodes) {
+    for (int64_t i = 0; i < count; i++) {
+        if (levels[i] < 0 || levels[i] > tree->branch_count || indexes[i] < 0) {
+            return INDEX_ERROR;
+        }
+        int64_t size = levels[i] == tree->branch_count ? 1 : tree->branches[levels[i]].leaf_count;
+        if (indexes[i] >= size) {
+            return INDEX_ERROR;
+        }
+    }
+
+    flush(tree);
+
+    for (int64_t i = 0; i < count; i++) {
+        if (levels[i] == tree->branch_count) {
+            memcpy(nodes + i * LEAF_LENGTH, tree->root, LEAF_LENGTH);
+        } else {
+            memcpy(nodes + i * LEAF_LENGTH, tree->branches[levels[i]].leaves + indexes[i] * LEAF_LENGTH, LEAF_LENGTH);
+        }
+    }
+
+    return SUCCESS;
+}
+
+/* write the minimal set of nodes needed to rebuild the root from the leaves at sorted, unique indexes */
+int get_multiproof(Tree* tree, int64_t* indexes, int64_t count, uint8_t* nodes, int64_t* node_count) {
+    for (int64_t i = 0; i < count; i++) {
+        int status = check_index(tree, indexes[i]);
+        if (status != SUCCESS) {
+            return status;
+        }
+    }
+
+    int64_t* known = malloc(count * sizeof(int64_t) + 1);
+    if (known == NULL) {
+        return MEMORY_ERROR;
+    }
+    memcpy(known, indexes, count * sizeof(int64_t));
+
+    flush(tree);
+
+    *node_count = 0;
+    for (int i = 0; i < tree->branch_count; i++) {
+        int64_t parent_count = 0;
+        for (int64_t j = 0; j < count; j++) {
+            if (strcmp(side(known[j]), "L") == 0 && j + 1 < count && known[j + 1] == known[j] + 1) {
+                j++;
+            } else {
+                memcpy(nodes + *node_count * LEAF_LENGTH, tree->branches[i].leaves + get_sibling_index(known[j]) * LEAF_LENGTH, LEAF_LENGTH);
+                (*node_count)++;
+            }
+            known[parent_count++] = get_parent_index(known[j]);
+        }
+        count = parent_count;
+    }
+    free(known);
+
+    return SUCCESS;
+}
+
+/* rebuild the root from the leaves at sorted, unique indexes and the nodes of a multiproof */
+_Bool verify_multiproof(uint8_t* leaves, int64_t* indexes, int64_t count, int depth, uint8_t* nodes, int64_t node_count, uint8_t* root, int hash_id) {
+    if (count == 0 || depth < 1 || depth > MAX_BRANCHES || hash_id < 0 || hash_id >= HASH_COUNT) {
+        return 0;
+    }
+    for (int64_t i = 0; i < count; i++) {
+        if (indexes[i] < 0 || indexes[i] >= (int64_t) 1 << depth || (i > 0 && indexes[i] <= indexes[i - 1])) {
+            return 0;
+        }
+    }
+
+    // A proof that can't be checked is not a valid one, failing here must not take the caller down.
+    int64_t* known = malloc(count * sizeof(int64_t));
+    uint8_t* values = malloc(count * LEAF_LENGTH);
+    if (known == NULL || values == NULL) {
+        free(known);
+        free(values);
+        return 0;
+    }
+    memcpy(known, indexes, count * sizeof(int64_t));
+    memcpy(values, leaves, count * LEAF_LENGTH);
+
+    int64_t used = 0;
+    _Bool valid = 1;
+    for (int i = 0; i < depth && valid; i++) {
+        int64_t parent_count = 0;
+        for (int64_t j = 0; j < count; j++) {
+            uint8_t* parent = values + parent_count * LEAF_LENGTH;
+            if (strcmp(side(known[j]), "L") == 0 && j + 1 < count && known[j + 1] == known[j] + 1) {
+                hash_pair(hash_id, values + j * LEAF_LENGTH, values + (j + 1) * LEAF_LENGTH, parent);
+                j++;
+            } else if (used == node_count) {
+                valid = 0;
+                break;
+            } else if (strcmp(side(known[j]), "L") == 0) {
+                hash_pair(hash_id, values + j * LEAF_LENGTH, nodes + used++ * LEAF_LENGTH, parent);
+            } else {
+                hash_pair(hash_id, nodes + used++ * LEAF_LENGTH, values + j * LEAF_LENGTH, parent);
+            }
+            known[parent_count++] = get_parent_index(known[j]);
+        }
+        count = parent_count;
+    }
+
+    valid = valid && used == node_count && memcmp(values, root, LEAF_LENGTH) == 0;
+
+    free(known);
+    free(values);
+
+    return valid;
+}
+
+/* hash a leaf up through its siblings, sides mark the siblings to the left with 'L' */
+_Bool verify_proof(uint8_t* leaf, uint8_t* siblings, char* sides, int depth, uint8_t* root, int hash_id) {
+    if (hash_id < 0 || hash_id >= HASH_COUNT) {
+        return 0;
+    }
+
+    uint8_t node[LEAF_LENGTH];
+    memcpy(node, leaf, LEAF_LENGTH);
+
+    for (int i = 0; i < depth; i++) {
+        if (sides[i] == 'L') {
+            hash_pair(hash_id, siblings + i * LEAF_LENGTH, node, node);
+        } else {
+            hash_pair(hash_id, node, siblings + i * LEAF_LENGTH, node);
+        }
+    }
+
+    return memcmp(node, root, LEAF_LENGTH) == 0;
+}
+
+/* verify count proofs laid out back to back, depths gives the length of each */
+void verify_proofs(uint8_t* leaves, uint8_t* siblings, char* sides, int* depths, uint8_t* roots, int64_t count, _Bool* results, int hash_id) {
+    int64_t offset = 0;
+    for (int64_t i = 0; i < count; i++) {
+        results[i] = verify_proof(leaves + i * LEAF_LENGTH, siblings + offset * LEAF_LENGTH, sides + offset, depths[i], roots + i * LEAF_LENGTH, hash_id);
+        offset += depths[i];
+    }
+}
+
+int64_t get_sibling_index(int64_t index) {
+    return strcmp(side(index), "L") == 0 ? index + 1 : index - 1;
+}
+
+int64_t get_parent_index(int64_t index) {
+    return index / 2;
+}
+
+char* side(int64_t index) {
+    return (index % 2 == 0) ? "L" : "R";
+}
+
+/* both write the level in place, a single write costs the same whatever the size of the level */
+void replace(uint8_t* leaves, const uint8_t* leaf, int64_t index) {
+    memcpy(leaves + index * LEAF_LENGTH, leaf, LEAF_LENGTH);
+}
+
+void delete(uint8_t *leaves, int64_t size, int64_t index) {
+    memmove(leaves + index * LEAF_LENGTH, leaves + (index + 1) * LEAF_LENGTH, (size - index - 1) * LEAF_LENGTH);
+    memcpy(leaves + (size - 1) * LEAF_LENGTH, empty, LEAF_LENGTH);
+}
+
+int compare(Tree* tree, Tree* other) {
+    int result;
+    flush(tree);
+    flush(other);
+
+    if (tree->hash_id != other->hash_id) {
+        return 1;
+    }
+
+    // Two empty trees match...
+    if (tree->branch_count == 0 && other->branch_count == 0) {
+        return 0;
+    }
+
+    result = memcmp(tree->root, other->root, LEAF_LENGTH);
+
+    // Roots don't match
+    if (result != 0) {
+        return 1;
+    }
+
+    // Some how root match but with different leaves.
+    if (tree->leaf_count != other->leaf_count) {
+        return 1;
+    }
+
+    // Some how root matches with different leaves.
+    result = memcmp(tree->branches[0].leaves, other->branches[0].leaves, tree->leaf_count * LEAF_LENGTH);
+    if (result != 0) {
+        return 1;
+    }
+
+    return 0;
+}
+
+/* write the indexes of leaves that differ between two trees, in order, descending only into differing subtrees */
+int64_t diff_trees(Tree* tree, Tree* other, int64_t* indexes, int64_t capacity) {
+    flush(tree);
+    flush(other);
+
+    int64_t count = 0;
+    int branch_index = tree->branch_count > other->branch_count ? tree->branch_count : other->branch_count;
+    diff_subtree(tree, other, branch_index, 0, indexes, capacity, &count);
+
+    // The count is returned even when it overflows capacity, so the caller can retry with enough room.
+    return count;
+}
+
+void diff_subtree(Tree* tree, Tree* other, int branch_index, int64_t index, int64_t* indexes, int64_t capacity, int64_t* count) {
+    const uint8_t* node = diff_node(tree, branch_index, index);
+    const uint8_t* other_node = diff_node(other, branch_index, index);
+
+    // Hashes can't tell a missing leaf from an all zero one, so subtrees spanning leaves held by only one tree
+    // are always descended.
+    int64_t start_index = index << branch_index;
+    int64_t end_index = (index + 1) << branch_index;
+    int64_t min_count = tree->leaf_count < other->leaf_count ? tree->leaf_count : other->leaf_count;
+    int64_t max_count = tree->leaf_count > other->leaf_count ? tree->leaf_count : other->leaf_count;
+    _Bool uneven = start_index < max_count && end_index > min_count;
+
+    if (!uneven && node != NULL && other_node != NULL && memcmp(node, other_node, LEAF_LENGTH) == 0) {
+        return;
+    }
+
+    if (branch_index == 0) {
+        if (*count < capacity) {
+            indexes[*count] = index;
+        }
+        (*count)++;
+        return;
+    }
+
+    diff_subtree(tree, other, branch_index - 1, 2 * index, indexes, capacity, count);
+    diff_subtree(tree, other, branch_index - 1, 2 * index + 1, indexes, capacity, count);
+}
+
+/* a node at any level, levels above the tree hold its root then nothing, NULL where a node would span the root */
+const uint8_t* diff_node(Tree* tree, int branch_index, int64_t index) {
+    if (branch_index < tree->branch_count) {
+        if (index >= tree->branches[branch_index].leaf_count) {
+            return empty;
+        }
+        return tree->branches[branch_index].leaves + index * LEAF_LENGTH;
+    }
+
+    if (index > 0) {
+        return empty;
+    }
+    return branch_index == tree->branch_count ? tree->root : NULL;
+}
+
+size_t marshal_size(Tree* tree) {
+    size_t size = MARSHAL_HEADER_LENGTH;
+    for (int i = 0; i < tree->branch_count; i++) {
+        size += (size_t) tree->branches[i].leaf_count * LEAF_LENGTH;
+    }
+    return size;
+}
+
+/* dump the tree into out, which must hold marshal_size bytes */
+void marshal_tree(Tree* tree, uint8_t* out) {
+    flush(tree);
+
+    write_header(out, tree->leaf_count, tree->branch_count, tree->hash_id, tree->root);
+
+    out += MARSHAL_HEADER_LENGTH;
+    for (int i = 0; i < tree->branch_count; i++) {
+        memcpy(out, tree->branches[i].leaves, tree->branches[i].leaf_count * LEAF_LENGTH);
+        out += tree->branches[i].leaf_count * LEAF_LENGTH;
+    }
+}
+
+/* recompute every branch from the leaves, the padding past the last leaf must be empty */
+int verify_tree(Tree* tree) {
+    uint8_t root[LEAF_LENGTH];
+    memcpy(root, tree->root, LEAF_LENGTH);
+
+    for (int64_t i = tree->leaf_count; i < (tree->branch_count ? tree->branches[0].leaf_count : 0); i++) {
+        if (memcmp(tree->branches[0].leaves + i * LEAF_LENGTH, empty, LEAF_LENGTH) != 0) {
+            return FORMAT_ERROR;
+        }
+    }
+
+    for (int i = 0; i < tree->branch_count; i++) {
+        int64_t parent_count = level_count(tree, i + 1);
+        hash_level(tree, i, 0, parent_count);
+        if (i + 1 < tree->branch_count) {
+            memset(tree->branches[i + 1].leaves + parent_count * LEAF_LENGTH, 0, (tree->branches[i + 1].leaf_count - parent_count) * LEAF_LENGTH);
+        }
+    }
+
+    return memcmp(root, tree->root, LEAF_LENGTH) == 0 ? SUCCESS : ROOT_MISMATCH;
+}
+
+/* check a marshalled header and that length matches the branches it declares */
+int check_header(const uint8_t* data, size_t length) {
+    if (length < MARSHAL_HEADER_LENGTH || memcmp(data, MARSHAL_MAGIC, 4) != 0 || get_uint(data + 4, 4) != MARSHAL_VERSION) {
+        return FORMAT_ERROR;
+    }
+
+    uint64_t leaf_count = get_uint(data + 8, 8);
+    uint64_t branch_count = get_uint(data + 16, 4);
+    if (branch_count > MAX_BRANCHES || (leaf_count == 0) != (branch_count == 0) || get_uint(data + 20, 4) >= HASH_COUNT) {
+        return FORMAT_ERROR;
+    }
+    // Only the canonical shape is accepted, the smallest power of two (at least two) holding every leaf.
+    if (branch_count > 0 && (leaf_count > (uint64_t) 1 << branch_count || (branch_count > 1 && leaf_count <= (uint64_t) 1 << (branch_count - 1)))) {
+        return FORMAT_ERROR;
+    }
+
+    if (MARSHAL_HEADER_LENGTH + branch_offset(branch_count, branch_count) != length) {
+        return FORMAT_ERROR;
+    }
+
+    return SUCCESS;
+}
+
+/* byte offset of a branch from the end of the header, branch_index == branch_count gives the total size */
+size_t branch_offset(int branch_count, int branch_index) {
+    size_t offset = 0;
+    for (int i = 0; i < branch_index; i++) {
+        offset += ((size_t) 2 << (branch_count - 1 - i)) * LEAF_LENGTH;
+    }
+    return offset;
+}
+
+/* load a marshalled tree with one copy per branch, rehashing only when verify is set */
+Tree* unmarshal_tree(uint8_t* data, size_t length, _Bool verify, int* status) {
+    *status = check_header(data, length);
+    if (*status != SUCCESS) {
+        return NULL;
+    }
+
+    uint64_t leaf_count = get_uint(data + 8, 8);
+    uint64_t branch_count = get_uint(data + 16, 4);
+
+    Tree* tree = new_tree(NULL, 0);
+    *status = MEMORY_ERROR;
+    if (tree == NULL || grow_tree(tree, branch_count) != SUCCESS) {
+        if (tree != NULL) {
+            free_tree(tree);
+        }
+        return NULL;
+    }
+    tree->hash_id = get_uint(data + 20, 4);
+    memcpy(tree->root, data + 24, LEAF_LENGTH);
+    tree->leaf_count = leaf_count;
 
-void update_parent(Tree* tree, int branch_index, int leaf_index, _Bool recurse);
-void rebuild_branch(Tree* tree, int branch_index, int start_index, int end_index);
+    data += MARSHAL_HEADER_LENGTH;
+    for (int i = 0; i < tree->branch_count; i++) {
+        Branch* branch = &tree->branches[i];
+        memcpy(branch->leaves, data, branch->leaf_count * LEAF_LENGTH);
+        data += branch->leaf_count * LEAF_LENGTH;
+    }
 
-void replace(uint8_t* leaves, const uint8_t* leaf, int size, int index);
-void delete(uint8_t* leaves, int size, int index);
+    *status = verify ? verify_tree(tree) : SUCCESS;
+    if (*status != SUCCESS) {
+        free_tree(tree);
+        return NULL;
+    }
 
-const uint8_t empty[LEAF_LENGTH] = { 0 };
+    return tree;
+}
+
+/* open a tree whose branches are mapped from a file in the marshalled format, creating it if empty;
+   a file must use hash_id unless it is negative, which accepts any */
+Tree* open_tree_file(char* path, int hash_id, int* status) {
+    *status = IO_ERROR;
+    int fd = open(path, O_RDWR | O_CREAT, 0644);
+    if (fd < 0) {
+        return NULL;
+    }
 
-enum status {SUCCESS = 0, INDEX_ERROR = 1, EMPTY = 2};
+    struct stat st;
+    if (fstat(fd, &st) != 0) {
+        close(fd);
+        return NULL;
+    }
 
-void add_branch(Tree* tree) {
-    Branch branch;
+    if (st.st_size == 0) {
+        uint8_t header[MARSHAL_HEADER_LENGTH];
+        write_header(header, 0, 0, hash_id < 0 ? HASH_SHA256 : hash_id, empty);
+        if (pwrite(fd, header, MARSHAL_HEADER_LENGTH, 0) != MARSHAL_HEADER_LENGTH) {
+            close(fd);
+            return NULL;
+        }
+        st.st_size = MARSHAL_HEADER_LENGTH;
+    }
 
-    branch.leaves = malloc(LEAF_LENGTH * 2);
-    memcpy(branch.leaves, tree->root, LEAF_LENGTH);
-    memcpy(branch.leaves + LEAF_LENGTH, empty, LEAF_LENGTH);
-    memcpy(tree->root, empty, LEAF_LENGTH);
-    branch.leaf_count = 2;
-    
-    tree->branches = realloc(tree->branches, (tree->branch_count + 1) * sizeof(Branch));
-    tree->branches[tree->branch_count] = branch;
-    tree->branch_count++;
+    uint8_t* mapping = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if (mapping == MAP_FAILED) {
+        close(fd);
+        return NULL;
+    }
+
+    *status = check_header(mapping, st.st_size);
+    if (*status == SUCCESS && hash_id >= 0 && get_uint(mapping + 20, 4) != (uint64_t) hash_id) {
+        *status = HASH_MISMATCH;
+    }
+    if (*status != SUCCESS) {
+        munmap(mapping, st.st_size);
+        close(fd);
+        return NULL;
+    }
+
+    int branch_count = get_uint(mapping + 16, 4);
+    Tree* tree = new_tree(NULL, 0);
+    Branch* branches = tree == NULL ? NULL : calloc(branch_count + 1, sizeof(Branch));
+    if (branches == NULL) {
+        if (tree != NULL) {
+            free_tree(tree);
+        }
+        munmap(mapping, st.st_size);
+        close(fd);
+        *status = MEMORY_ERROR;
+        return NULL;
+    }
+
+    free(tree->root);
+    tree->fd = fd;
+    tree->mapping = mapping;
+    tree->mapping_length = st.st_size;
+    tree->leaf_count = get_uint(mapping + 8, 8);
+    tree->branch_count = branch_count;
+    tree->hash_id = get_uint(mapping + 20, 4);
+    tree->branches = branches;
+    for (int i = 0; i < tree->branch_count; i++) {
+        tree->branches[i].dirty = NULL;
+        tree->branches[i].dirty_start = 0;
+        tree->branches[i].dirty_end = 0;
+    }
+    map_branches(tree);
+
+    return tree;
 }
 
-void expand_branch(Branch* branch) {
-    branch->leaves = realloc(branch->leaves, branch->leaf_count * 2 * LEAF_LENGTH);
-    for (int i = branch->leaf_count * LEAF_LENGTH; i < branch->leaf_count * 2 * LEAF_LENGTH; i += 32) {
-        memcpy(branch->leaves + i, empty, LEAF_LENGTH);
+/* write the header and flush the mapping of a file backed tree to disk */
+int sync_tree(Tree* tree) {
+    if (tree->mapping == NULL) {
+        return SUCCESS;
     }
-    branch->leaf_count += branch->leaf_count;
+
+    flush(tree);
+    store_header(tree);
+    return msync(tree->mapping, tree->mapping_length, MS_SYNC) == 0 ? SUCCESS : IO_ERROR;
 }
 
-void remove_branch(Tree* tree) {
-    memcpy(tree->root, tree->branches[tree->branch_count - 1].leaves, LEAF_LENGTH);
-    tree->branches = realloc(tree->branches, (tree->branch_count - 1) * sizeof(Branch));
-    tree->branch_count--;
+/* release every branch, syncing and unmapping a file backed tree first, whose root goes with the mapping */
+void release_tree(Tree* tree) {
+    if (tree->mapping != NULL) {
+        sync_tree(tree);
+    }
+    // Live snapshots read through to the branches, keep what they still need.
+    for (int i = 0; i < tree->branch_count; i++) {
+        save_nodes(tree, i, 0, tree->branches[i].leaf_count);
+    }
+
+    for (int i = 0; i < tree->branch_count; i++) {
+        if (tree->mapping == NULL) {
+            free(tree->branches[i].leaves);
+        }
+        free(tree->branches[i].dirty);
+    }
+    free(tree->branches);
+    tree->branches = NULL;
+
+    if (tree->mapping != NULL) {
+        munmap(tree->mapping, tree->mapping_length);
+        tree->root = NULL;
+        tree->mapping = NULL;
+        tree->mapping_length = 0;
+    }
+
+    if (tree->fd >= 0) {
+        close(tree->fd);
+        tree->fd = -1;
+    }
 }
 
-void prune_branch(Branch* branch) {
-    branch->leaves = realloc(branch->leaves, branch->leaf_count / 2 * LEAF_LENGTH);
-    branch->leaf_count = branch->leaf_count / 2;
+/* release every branch, the root and the lookup; a closed tree can only be freed. Live snapshots first make room for
+   every node, without it the tree stays open */
+int close_tree(Tree* tree) {
+    int64_t saves = 0;
+    for (int i = 0; i < tree->branch_count; i++) {
+        saves += tree->branches[i].leaf_count;
+    }
+    if (reserve_saves(tree, saves) != SUCCESS) {
+        return MEMORY_ERROR;
+    }
+
+    release_tree(tree);
+
+    free(tree->root);
+    tree->root = NULL;
+    free(tree->lookup);
+    tree->lookup = NULL;
+    tree->lookup_capacity = 0;
+    tree->lookup_count = 0;
+    tree->branch_count = 0;
+    tree->leaf_count = 0;
+    tree->dirty = 0;
+    tree->dirty_count = 0;
+
+    return SUCCESS;
 }
 
-uint8_t* hash(uint8_t* in, int len) {
-    static uint8_t hash[LEAF_LENGTH];
-    SHA256(in, len, hash);
+/* release a tree and free it along with every snapshot still taken of it, allocating nothing on the way */
+void free_tree(Tree* tree) {
+    // The snapshots go first, so releasing the branches has no nodes to save for them.
+    Snapshot* snapshot = tree->snapshots;
+    while (snapshot != NULL) {
+        Snapshot* older = snapshot->older;
+        free(snapshot->keys);
+        free(snapshot->nodes);
+        free(snapshot);
+        snapshot = older;
+    }
+    tree->snapshots = NULL;
+    release_tree(tree);
 
-    return hash;
+    free(tree->root);
+    free(tree->lookup);
+    free(tree);
 }
 
-uint8_t* hash_siblings(const uint8_t* left, const uint8_t* right) {
-    uint8_t* in = malloc(2 * LEAF_LENGTH);
-    memcpy(in, left, LEAF_LENGTH);
-    memcpy(in + LEAF_LENGTH, right, LEAF_LENGTH);
+/* drop capacity beyond the next power of two of the leaf count, the bitmaps of flushed writes and lookup slots
+   beyond twice the leaf count */
+void shrink_to_fit(Tree* tree) {
+    flush(tree);
+    // Live snapshots keep the nodes dropped, a tree is left wider when there isn't room to save them.
+    while (tree->branch_count > 1 && tree->leaf_count <= tree->branches[0].leaf_count / 2) {
+        if (reserve_saves(tree, shrink_saves(tree)) != SUCCESS) {
+            break;
+        }
+        shrink_tree(tree);
+    }
 
-    return hash(in, LEAF_LENGTH * 2);
+    for (int i = 0; i < tree->branch_count; i++) {
+        free(tree->branches[i].dirty);
+        tree->branches[i].dirty = NULL;
+        tree->branches[i].dirty_start = 0;
+        tree->branches[i].dirty_end = 0;
+    }
+
+    // Nothing is lost if there isn't memory for the smaller lookup.
+    if (tree->lookup != NULL && lookup_size(tree->leaf_count) < tree->lookup_capacity) {
+        lookup_resize(tree, lookup_size(tree->leaf_count));
+    }
 }
 
-/* create and return a new tree */
-Tree* new_tree(unsigned char* leaves[], int count) {
-    Tree* tree = malloc(sizeof(Tree));
+/* bytes held by a tree: its nodes on the heap, write bitmaps, snapshots, its file mapping and leaf lookup */
+void memory_usage(Tree* tree, uint64_t* usage) {
+    memset(usage, 0, 5 * sizeof(uint64_t));
+    usage[0] = sizeof(Tree) + tree->branch_count * sizeof(Branch);
+    if (tree->mapping == NULL) {
+        usage[0] += tree->root != NULL ? LEAF_LENGTH : 0;
+        for (int i = 0; i < tree->branch_count; i++) {
+            usage[0] += (uint64_t) tree->branches[i].leaf_count * LEAF_LENGTH;
+        }
+    }
 
-    tree->root = malloc(32);
-    memcpy(tree->root, empty, 32);
+    for (int i = 0; i < tree->branch_count; i++) {
+        if (tree->branches[i].dirty != NULL) {
+            usage[1] += (tree->branches[i].leaf_count + 63) / 64 * sizeof(uint64_t);
+        }
+    }
 
-    tree->branches = malloc(0);
+    for (Snapshot* snapshot = tree->snapshots; snapshot != NULL; snapshot = snapshot->older) {
+        usage[2] += sizeof(Snapshot) + (uint64_t) snapshot->capacity * (sizeof(uint64_t) + LEAF_LENGTH);
+    }
 
-    tree->branch_count = 0;
-    tree->leaf_count = 0;
+    usage[3] = tree->mapping_length;
+    usage[4] = tree->lookup_capacity * sizeof(int64_t);
+}
 
-    for (int i = 0; i < count; i++) {
-        add_leaf(tree, leaves[i], LEAF_LENGTH, 1);    
+/* point the root and every branch into the mapping */
+void map_branches(Tree* tree) {
+    tree->root = tree->mapping + 24;
+    for (int i = 0; i < tree->branch_count; i++) {
+        tree->branches[i].leaf_count = (int64_t) 2 << (tree->branch_count - 1 - i);
+        tree->branches[i].leaves = tree->mapping + MARSHAL_HEADER_LENGTH + branch_offset(tree->branch_count, i);
     }
+}
 
-    return tree;
+void write_header(uint8_t* out, uint64_t leaf_count, int branch_count, int hash_id, const uint8_t* root) {
+    memcpy(out, MARSHAL_MAGIC, 4);
+    put_uint(out + 4, MARSHAL_VERSION, 4);
+    put_uint(out + 8, leaf_count, 8);
+    put_uint(out + 16, branch_count, 4);
+    put_uint(out + 20, hash_id, 4);
+    memcpy(out + 24, root, LEAF_LENGTH);
 }
 
-unsigned char* get_root(Tree *tree) {
-    return tree->root;
+/* keep the counts in the header of a file backed tree current, the root already lives there */
+void store_header(Tree* tree) {
+    if (tree->mapping != NULL) {
+        put_uint(tree->mapping + 8, tree->leaf_count, 8);
+        put_uint(tree->mapping + 16, tree->branch_count, 4);
+    }
 }
 
-void update_parent(Tree* tree, int branch_index, int leaf_index, _Bool recurse) {
-    uint8_t leaf[LEAF_LENGTH];
-    uint8_t sibling[LEAF_LENGTH];
-    memcpy(leaf, tree->branches[branch_index].leaves + leaf_index * LEAF_LENGTH, LEAF_LENGTH);
-    int sibling_index = get_sibling_index(leaf_index);
-    memcpy(sibling, tree->branches[branch_index].leaves + sibling_index * LEAF_LENGTH, LEAF_LENGTH);
+/* grow a file backed tree to branch_count branches or shrink it by one, moving each branch to its offset in the
+   new layout; the new mapping is made before anything moves, so a failure leaves the tree as it was */
+int resize_file(Tree* tree, int branch_count) {
+    int old_count = tree->branch_count;
+    size_t length = MARSHAL_HEADER_LENGTH + branch_offset(branch_count, branch_count);
+    int status = SUCCESS;
 
-    uint8_t* hash;
-    if (strcmp(side(leaf_index), "L") == 0) {
-        hash = hash_siblings(leaf, sibling);
+    if (branch_count > old_count) {
+        Branch* branches = realloc(tree->branches, branch_count * sizeof(Branch));
+        if (branches == NULL) {
+            return MEMORY_ERROR;
+        }
+        tree->branches = branches;
+
+        // Mapped before the file is extended, mapping past its end is allowed until the pages are touched.
+        uint8_t* mapping = mmap(NULL, length, PROT_READ | PROT_WRITE, MAP_SHARED, tree->fd, 0);
+        if (mapping == MAP_FAILED) {
+            return IO_ERROR;
+        }
+        if (ftruncate(tree->fd, length) != 0) {
+            munmap(mapping, length);
+            return IO_ERROR;
+        }
+        munmap(tree->mapping, tree->mapping_length);
+        tree->mapping = mapping;
+        tree->mapping_length = length;
+        uint8_t* data = tree->mapping + MARSHAL_HEADER_LENGTH;
+
+        // Branches only move up, so walk down from the top to avoid overwriting one not yet moved.
+        for (int i = old_count - 1; i >= 0; i--) {
+            size_t size = branch_offset(old_count, i + 1) - branch_offset(old_count, i);
+            size_t new_size = branch_offset(branch_count, i + 1) - branch_offset(branch_count, i);
+            memmove(data + branch_offset(branch_count, i), data + branch_offset(old_count, i), size);
+            memset(data + branch_offset(branch_count, i) + size, 0, new_size - size);
+        }
+
+        // The branches above the old ones lie past the old end of the file, which was extended with zeroes.
+        uint8_t* top = data + branch_offset(branch_count, old_count);
+        memcpy(top, tree->mapping + 24, LEAF_LENGTH);
+        memcpy(tree->mapping + 24, empty, LEAF_LENGTH);
     } else {
-        hash = hash_siblings(sibling, leaf);
+        uint8_t* mapping = mmap(NULL, length, PROT_READ | PROT_WRITE, MAP_SHARED, tree->fd, 0);
+        if (mapping == MAP_FAILED) {
+            return IO_ERROR;
+        }
+        uint8_t* data = tree->mapping + MARSHAL_HEADER_LENGTH;
+        memcpy(tree->mapping + 24, data + branch_offset(old_count, old_count - 1), LEAF_LENGTH);
+
+        // Branches only move down, so walk up from the bottom.
+        for (int i = 0; i < branch_count; i++) {
+            size_t size = branch_offset(branch_count, i + 1) - branch_offset(branch_count, i);
+            memmove(data + branch_offset(branch_count, i), data + branch_offset(old_count, i), size);
+        }
+
+        munmap(tree->mapping, tree->mapping_length);
+        tree->mapping = mapping;
+        tree->mapping_length = length;
+        // The tree in memory is already consistent, a file left too long is reported but not undone.
+        if (ftruncate(tree->fd, length) != 0) {
+            status = IO_ERROR;
+        }
     }
 
-    if (branch_index + 1 == tree->branch_count) {
-        memcpy(tree->root, hash, LEAF_LENGTH);
-    } else {
-        int parent_index = get_parent_index(leaf_index);
-        replace(tree->branches[branch_index + 1].leaves, hash, tree->branches[branch_index + 1].leaf_count, parent_index);
-        if (recurse) {
-            update_parent(tree, branch_index + 1, parent_index, 1);
+    for (int i = branch_count; i < old_count; i++) {
+        free(tree->branches[i].dirty);
+    }
+    for (int i = 0; i < branch_count; i++) {
+        if (i < old_count) {
+            free(tree->branches[i].dirty);
         }
+        tree->branches[i].dirty = NULL;
+        tree->branches[i].dirty_start = 0;
+        tree->branches[i].dirty_end = 0;
     }
+    tree->branch_count = branch_count;
+    map_branches(tree);
+    store_header(tree);
+
+    return status;
 }
 
-void rebuild_branch(Tree* tree, int branch_index, int start_index, int end_index) {
-    if (end_index + 1 < tree->branches[branch_index].leaf_count) {
-        replace(tree->branches[branch_index].leaves, empty, tree->branches[branch_index].leaf_count, end_index + 1);
+/* take a read-only view of the tree as it is now, later writes save the nodes they overwrite into it */
+Snapshot* snapshot_tree(Tree* tree) {
+    Snapshot* snapshot = malloc(sizeof(Snapshot));
+    if (snapshot == NULL) {
+        return NULL;
     }
-    start_index = strcmp(side(start_index), "L") == 0 ? start_index : start_index - 1;
-    end_index = strcmp(side(end_index), "L") == 0 ? end_index + 1: end_index;
 
-    for (int i = start_index; i < end_index; i += 2) {
-        update_parent(tree, branch_index, i, 0);
-    }
-    
-    start_index = get_parent_index(start_index);
-    end_index = get_parent_index(end_index);
+    flush(tree);
+    snapshot->tree = tree;
+    snapshot->leaf_count = tree->leaf_count;
+    snapshot->branch_count = tree->branch_count;
+    memcpy(snapshot->root, tree->root, LEAF_LENGTH);
+    snapshot->keys = NULL;
+    snapshot->nodes = NULL;
+    snapshot->node_count = 0;
+    snapshot->capacity = 0;
 
-    if (branch_index + 1 < tree->branch_count) {
-        rebuild_branch(tree, branch_index + 1, start_index, end_index);
+    snapshot->newer = NULL;
+    snapshot->older = tree->snapshots;
+    if (snapshot->older != NULL) {
+        snapshot->older->newer = snapshot;
     }
+    tree->snapshots = snapshot;
+
+    return snapshot;
 }
 
-void add_leaf(Tree* tree, uint8_t* leaf, int len, _Bool hashed) {
-    if (!hashed) {
-        leaf = hash(leaf, len);
+/* drop a snapshot, handing the nodes it saved to the next older snapshot, whose view still needs them; the older
+   snapshot makes room for them first, and without memory for it nothing is dropped */
+int free_snapshot(Snapshot* snapshot) {
+    if (snapshot->newer == NULL) {
+        // A flush saves into the newest snapshot, which holds the room its deferred writes reserved for it.
+        flush(snapshot->tree);
     }
 
-    if (tree->branch_count == 0 || tree->leaf_count + 1 > tree->branches[0].leaf_count) {
-        for (int i = 0; i < tree->branch_count; i++) {
-            expand_branch(&tree->branches[i]);
+    if (snapshot->older != NULL) {
+        int64_t count = 0;
+        for (int64_t i = 0; i < snapshot->capacity; i++) {
+            if (snapshot->keys[i] != 0 && find_saved(snapshot->older, snapshot->keys[i]) == NULL) {
+                count++;
+            }
+        }
+        if (snapshot_reserve(snapshot->older, count) != SUCCESS) {
+            return MEMORY_ERROR;
+        }
+
+        for (int64_t i = 0; i < snapshot->capacity; i++) {
+            if (snapshot->keys[i] != 0 && find_saved(snapshot->older, snapshot->keys[i]) == NULL) {
+                put_saved(snapshot->older, snapshot->keys[i], snapshot->nodes + i * LEAF_LENGTH);
+            }
         }
-        add_branch(tree);
+        snapshot->older->newer = snapshot->newer;
     }
 
-    int index = tree->leaf_count;
+    if (snapshot->newer != NULL) {
+        snapshot->newer->older = snapshot->older;
+    } else {
+        snapshot->tree->snapshots = snapshot->older;
+    }
 
-    replace(tree->branches[0].leaves, leaf, tree->branches[0].leaf_count, tree->leaf_count);
+    free(snapshot->keys);
+    free(snapshot->nodes);
+    free(snapshot);
 
-    tree->leaf_count++;
+    return SUCCESS;
+}
 
-    update_parent(tree, 0, index, 1);
+/* saved nodes are keyed by branch in the top bits and index below, never zero so zero marks a free slot */
+uint64_t node_key(int branch_index, int64_t index) {
+    return ((uint64_t) branch_index << 58 | (uint64_t) index) + 1;
 }
 
-int update_leaf(Tree *tree, uint8_t *leaf, int index, int len, _Bool hashed) {
-    if (index >= tree->leaf_count || index < 0) {
-        if (index < 0) {
-            return EMPTY;
+/* called before nodes are overwritten or dropped, only the newest snapshot needs their old value */
+void save_nodes(Tree* tree, int branch_index, int64_t start_index, int64_t end_index) {
+    Snapshot* snapshot = tree->snapshots;
+    if (snapshot == NULL) {
+        return;
+    }
+
+    for (int64_t i = start_index; i < end_index; i++) {
+        uint64_t key = node_key(branch_index, i);
+        if (find_saved(snapshot, key) == NULL) {
+            put_saved(snapshot, key, tree->branches[branch_index].leaves + i * LEAF_LENGTH);
         }
-        return INDEX_ERROR;
+    }
+}
+
+uint8_t* find_saved(Snapshot* snapshot, uint64_t key) {
+    if (snapshot->capacity == 0) {
+        return NULL;
     }
 
-    if (!hashed) {
-        leaf = hash(leaf, len);
+    int64_t slot = (key * 0x9E3779B97F4A7C15ull) >> 32 & (snapshot->capacity - 1);
+    while (snapshot->keys[slot] != 0) {
+        if (snapshot->keys[slot] == key) {
+            return snapshot->nodes + slot * LEAF_LENGTH;
+        }
+        slot = (slot + 1) & (snapshot->capacity - 1);
+    }
+    return NULL;
+}
+
+/* store a node in room made by snapshot_reserve, so the table never passes half full */
+void put_saved(Snapshot* snapshot, uint64_t key, const uint8_t* node) {
+    int64_t slot = (key * 0x9E3779B97F4A7C15ull) >> 32 & (snapshot->capacity - 1);
+    while (snapshot->keys[slot] != 0) {
+        slot = (slot + 1) & (snapshot->capacity - 1);
+    }
+    snapshot->keys[slot] = key;
+    memcpy(snapshot->nodes + slot * LEAF_LENGTH, node, LEAF_LENGTH);
+    snapshot->node_count++;
+}
+
+/* double the open addressing table until count more nodes fit in half of it, reinserting what it holds; the old
+   table is kept when there isn't memory for the new one */
+int snapshot_reserve(Snapshot* snapshot, int64_t count) {
+    if (2 * (snapshot->node_count + count) <= snapshot->capacity) {
+        return SUCCESS;
+    }
+
+    int64_t capacity = snapshot->capacity ? snapshot->capacity : 64;
+    while (2 * (snapshot->node_count + count) > capacity) {
+        capacity *= 2;
+    }
+    uint64_t* keys = calloc(capacity, sizeof(uint64_t));
+    uint8_t* nodes = malloc(capacity * LEAF_LENGTH);
+    if (keys == NULL || nodes == NULL) {
+        free(keys);
+        free(nodes);
+        return MEMORY_ERROR;
     }
 
-    replace(tree->branches[0].leaves, leaf, tree->branches[0].leaf_count, index);
+    uint64_t* old_keys = snapshot->keys;
+    uint8_t* old_nodes = snapshot->nodes;
+    int64_t old_capacity = snapshot->capacity;
+    snapshot->keys = keys;
+    snapshot->nodes = nodes;
+    snapshot->capacity = capacity;
+    snapshot->node_count = 0;
 
-    update_parent(tree, 0, index, 1);
+    for (int64_t i = 0; i < old_capacity; i++) {
+        if (old_keys[i] != 0) {
+            put_saved(snapshot, old_keys[i], old_nodes + i * LEAF_LENGTH);
+        }
+    }
+    free(old_keys);
+    free(old_nodes);
 
     return SUCCESS;
 }
 
-int remove_leaf(Tree *tree, int index) {
-    if (index >= tree->leaf_count || index < 0) {
-        if (index < 0) {
-            return EMPTY;
-        }
-        return INDEX_ERROR;
+/* make room in the newest snapshot for count more saved nodes, before a write changes anything, so saving them as
+   the write goes can't fail */
+int reserve_saves(Tree* tree, int64_t count) {
+    return tree->snapshots == NULL ? SUCCESS : snapshot_reserve(tree->snapshots, count);
+}
+
+/* at most the nodes saved by a write of count leaves in [start_index, end_index) to a tree of branch_count
+   branches: the leaves, then at every level above one parent per leaf, no more than the range has there. The
+   dirty leaves of earlier deferred writes count too, the flush hashing them may come in this write or later */
+int64_t write_saves(Tree* tree, int branch_count, int64_t start_index, int64_t end_index, int64_t count) {
+    int64_t saves = count;
+
+    if (tree->dirty_count > 0) {
+        Branch* branch = &tree->branches[0];
+        start_index = branch->dirty_start < start_index ? branch->dirty_start : start_index;
+        end_index = branch->dirty_end > end_index ? branch->dirty_end : end_index;
+        count += tree->dirty_count;
     }
 
-    delete(tree->branches[0].leaves, tree->branches[0].leaf_count, index);
+    for (int i = 1; i < branch_count; i++) {
+        int64_t span = ((end_index - 1) >> i) - (start_index >> i) + 1;
+        saves += span < count ? span : count;
+    }
+    return saves;
+}
 
-    tree->leaf_count--;
+/* the nodes shrink_tree saves, the upper half of every branch and all of the top one */
+int64_t shrink_saves(Tree* tree) {
+    int64_t saves = 0;
+    for (int i = 0; i < tree->branch_count; i++) {
+        saves += tree->branches[i].leaf_count / 2;
+    }
+    return saves + 1;
+}
 
-    if (tree->leaf_count == 0) {
-        remove_branch(tree);
-        memcpy(tree->root, empty, LEAF_LENGTH);
-    } else if (tree->leaf_count > 1 && tree->leaf_count <= tree->branches[0].leaf_count / 2) {
-        for (int i = 0; i < tree->branch_count; i++) {
-            prune_branch(&tree->branches[i]);
+/* a node as it was when the snapshot was taken, from the first snapshot since that saved it or the tree */
+const uint8_t* snapshot_node(Snapshot* snapshot, int branch_index, int64_t index) {
+    uint64_t key = node_key(branch_index, index);
+    for (Snapshot* newer = snapshot; newer != NULL; newer = newer->newer) {
+        uint8_t* node = find_saved(newer, key);
+        if (node != NULL) {
+            return node;
         }
-        remove_branch(tree);
     }
 
-    if (tree->branch_count > 0) {
-        index = index == tree->branches[0].leaf_count ? index - 1 : index;
+    Tree* tree = snapshot->tree;
+    if (branch_index < tree->branch_count && index < tree->branches[branch_index].leaf_count) {
+        return tree->branches[branch_index].leaves + index * LEAF_LENGTH;
+    }
+    return empty;
+}
 
-        rebuild_branch(tree, 0, index, tree->leaf_count - 1);
+/* as get_proofs, against the tree as it was when the snapshot was taken */
+int snapshot_proofs(Snapshot* snapshot, int64_t* indexes, int64_t count, uint8_t* siblings) {
+    for (int64_t i = 0; i < count; i++) {
+        if (indexes[i] >= snapshot->leaf_count || indexes[i] < 0) {
+            return indexes[i] < 0 ? EMPTY : INDEX_ERROR;
+        }
+    }
+
+    for (int64_t i = 0; i < count; i++) {
+        int64_t index = indexes[i];
+        for (int j = 0; j < snapshot->branch_count; j++) {
+            memcpy(siblings, snapshot_node(snapshot, j, get_sibling_index(index)), LEAF_LENGTH);
+            siblings += LEAF_LENGTH;
+            index = get_parent_index(index);
+        }
     }
+    memcpy(siblings, snapshot->root, LEAF_LENGTH);
 
     return SUCCESS;
 }
 
-int get_sibling_index(int index) {
-    return strcmp(side(index), "L") == 0 ? index + 1 : index - 1;
+/* keep a lookup from leaf to index, or drop it; the lookup holds indexes only and compares against the leaves */
+int set_indexed(Tree* tree, _Bool indexed) {
+    if (!indexed) {
+        free(tree->lookup);
+        tree->lookup = NULL;
+        tree->lookup_capacity = 0;
+        tree->lookup_count = 0;
+        return SUCCESS;
+    }
+    if (tree->lookup != NULL) {
+        return SUCCESS;
+    }
+
+    int status = lookup_resize(tree, lookup_size(tree->leaf_count));
+    for (int64_t i = 0; status == SUCCESS && i < tree->leaf_count; i++) {
+        lookup_insert(tree, i);
+    }
+    return status;
 }
 
-int get_parent_index(int index) {
-    return index / 2;
+/* the lowest index holding leaf, -1 if none does, through the lookup when the tree keeps one */
+int64_t find_leaf(Tree* tree, uint8_t* leaf) {
+    uint8_t* leaves = tree->branch_count ? tree->branches[0].leaves : NULL;
+    int64_t found = -1;
+
+    if (tree->lookup == NULL) {
+        for (int64_t i = 0; i < tree->leaf_count && found < 0; i++) {
+            if (memcmp(leaves + i * LEAF_LENGTH, leaf, LEAF_LENGTH) == 0) {
+                found = i;
+            }
+        }
+        return found;
+    }
+
+    // Equal leaves share a home slot, so every copy sits in the run of slots that starts there.
+    int64_t mask = tree->lookup_capacity - 1;
+    for (int64_t slot = lookup_home(tree, leaf); tree->lookup[slot] != 0; slot = (slot + 1) & mask) {
+        int64_t index = tree->lookup[slot] - 1;
+        if ((found < 0 || index < found) && memcmp(leaves + index * LEAF_LENGTH, leaf, LEAF_LENGTH) == 0) {
+            found = index;
+        }
+    }
+    return found;
 }
 
-char* side(int index) {
-    return (index % 2 == 0) ? "L" : "R";
+/* first slot probed for a leaf, mixing all of it so leaves that aren't digests spread too */
+int64_t lookup_home(Tree* tree, const uint8_t* leaf) {
+    uint64_t words[4];
+    memcpy(words, leaf, LEAF_LENGTH);
+
+    uint64_t key = 0;
+    for (int i = 0; i < 4; i++) {
+        key = (key ^ words[i]) * 0x9E3779B97F4A7C15ull;
+    }
+    return key >> (64 - __builtin_ctzll(tree->lookup_capacity));
 }
 
-void replace(uint8_t* leaves, const uint8_t* leaf, int size, int index) {
-    uint8_t* result = malloc(size * LEAF_LENGTH);
-    // in real code you would check for errors in malloc here
-    memcpy(result, leaves, size * LEAF_LENGTH);
-    memcpy(result + index * LEAF_LENGTH, leaf, 1 * LEAF_LENGTH);
-    memcpy(leaves, result, size * LEAF_LENGTH);
-    free(result);
+/* slots for leaf_count leaves, a power of two at least twice the leaf count */
+int64_t lookup_size(int64_t leaf_count) {
+    int64_t capacity = LOOKUP_CAPACITY;
+    while (capacity < 2 * leaf_count) {
+        capacity *= 2;
+    }
+    return capacity;
 }
 
-void delete(uint8_t *leaves, int size, int index) {
-    uint8_t* result = malloc((size) * LEAF_LENGTH);
-    // in real code you would check for errors in malloc here
-    memcpy(result, leaves, index * LEAF_LENGTH);
-    memcpy(result + index * LEAF_LENGTH, leaves + (index + 1) * LEAF_LENGTH, (size - index - 1) * LEAF_LENGTH);
-    memcpy(result + (size - 1) * LEAF_LENGTH, empty, LEAF_LENGTH);
-    memcpy(leaves, result, size * LEAF_LENGTH);
-    free(result);
+/* make room for leaf_count leaves before a write changes anything */
+int lookup_reserve(Tree* tree, int64_t leaf_count) {
+    if (tree->lookup == NULL || 2 * leaf_count <= tree->lookup_capacity) {
+        return SUCCESS;
+    }
+    return lookup_resize(tree, lookup_size(leaf_count));
 }
 
-int compare(Tree* tree, Tree* other) {
-    int result;
-    // Two empty trees match...
-    if (tree->branch_count == 0 && other->branch_count == 0) {
-        return 0;
+int lookup_resize(Tree* tree, int64_t capacity) {
+    int64_t* lookup = calloc(capacity, sizeof(int64_t));
+    if (lookup == NULL) {
+        return MEMORY_ERROR;
     }
 
-    result = memcmp(tree->root, other->root, LEAF_LENGTH);
+    int64_t* old = tree->lookup;
+    int64_t old_capacity = tree->lookup_capacity;
+    tree->lookup = lookup;
+    tree->lookup_capacity = capacity;
+    tree->lookup_count = 0;
 
-    // Roots don't match
-    if (result != 0) {
-        return 1;
+    for (int64_t i = 0; i < old_capacity; i++) {
+        if (old[i] != 0) {
+            lookup_insert(tree, old[i] - 1);
+        }
     }
+    free(old);
 
-    // Some how root match but with different leaves.
-    if (tree->leaf_count != other->leaf_count) {
-        return 1;
+    return SUCCESS;
+}
+
+/* slots hold index + 1, zero marks a free slot */
+void lookup_insert(Tree* tree, int64_t index) {
+    if (tree->lookup == NULL) {
+        return;
     }
 
-    // Some how root matches with different leaves.
-    result = memcmp(tree->branches[0].leaves, other->branches[0].leaves, tree->leaf_count * LEAF_LENGTH);
-    if (result != 0) {
-        return 1;
+    int64_t mask = tree->lookup_capacity - 1;
+    int64_t slot = lookup_home(tree, tree->branches[0].leaves + index * LEAF_LENGTH);
+    while (tree->lookup[slot] != 0) {
+        slot = (slot + 1) & mask;
     }
+    tree->lookup[slot] = index + 1;
+    tree->lookup_count++;
+}
 
-    return 0;
+/* called while the leaf is still at index; later slots of the run are shifted back so no probe stops early */
+void lookup_remove(Tree* tree, int64_t index) {
+    if (tree->lookup == NULL) {
+        return;
+    }
+
+    int64_t mask = tree->lookup_capacity - 1;
+    int64_t slot = lookup_home(tree, tree->branches[0].leaves + index * LEAF_LENGTH);
+    while (tree->lookup[slot] != index + 1) {
+        slot = (slot + 1) & mask;
+    }
+
+    for (int64_t next = (slot + 1) & mask; tree->lookup[next] != 0; next = (next + 1) & mask) {
+        int64_t home = lookup_home(tree, tree->branches[0].leaves + (tree->lookup[next] - 1) * LEAF_LENGTH);
+        // An entry can fill the gap unless its home lies after the gap and at or before where it sits.
+        if (((next - home) & mask) >= ((next - slot) & mask)) {
+            tree->lookup[slot] = tree->lookup[next];
+            slot = next;
+        }
+    }
+    tree->lookup[slot] = 0;
+    tree->lookup_count--;
+}
+
+/* the leaves after index are about to move down one; each is found from its own home slot while it is still in
+   place, so renumbering costs a probe per moved leaf */
+void lookup_shift(Tree* tree, int64_t index) {
+    if (tree->lookup == NULL) {
+        return;
+    }
+
+    int64_t mask = tree->lookup_capacity - 1;
+    for (int64_t i = index + 1; i < tree->leaf_count; i++) {
+        int64_t slot = lookup_home(tree, tree->branches[0].leaves + i * LEAF_LENGTH);
+        while (tree->lookup[slot] != i + 1) {
+            slot = (slot + 1) & mask;
+        }
+        tree->lookup[slot] = i;
+    }
+}
+
+void put_uint(uint8_t* out, uint64_t value, int size) {
+    for (int i = 0; i < size; i++) {
+        out[i] = (value >> (8 * i)) & 0xff;
+    }
+}
+
+uint64_t get_uint(const uint8_t* in, int size) {
+    uint64_t value = 0;
+    for (int i = 0; i < size; i++) {
+        value |= (uint64_t) in[i] << (8 * i);
+    }
+    return value;
 }
+
 /* unsigned char* get_leaves(Tree *tree, int branch) { */
 /*     return tree->branches[branch].leaves; */
 /* } */
@@ -365,3 +2358,111 @@ int compare(Tree* tree, Tree* other) {
 /*  */
 /*     return 0; */
 /* } */
+
+/* a root built from leaves fed in order, keeping only the last unpaired node of each level */
+Stream* new_stream(int hash_id, int workers) {
+    if (hash_id < 0 || hash_id >= HASH_COUNT) {
+        return NULL;
+    }
+
+    Stream* stream = calloc(1, sizeof(Stream));
+    if (stream == NULL) {
+        return NULL;
+    }
+    stream->hash_id = hash_id;
+    stream->workers = workers < 1 ? 1 : workers > MAX_WORKERS ? MAX_WORKERS : workers;
+    return stream;
+}
+
+void free_stream(Stream* stream) {
+    free(stream);
+}
+
+/* append count nodes to a level, pairing them with each other and with the level's unpaired node, and write
+   their parents, returning how many */
+int64_t push_nodes(Stream* stream, int level, const uint8_t* nodes, int64_t count, uint8_t* parents) {
+    uint8_t* frontier = stream->frontier + level * LEAF_LENGTH;
+    int64_t parent_count = 0;
+
+    if (stream->held[level]) {
+        hash_pair(stream->hash_id, frontier, nodes, parents);
+        stream->held[level] = 0;
+        parent_count++;
+        nodes += LEAF_LENGTH;
+        count--;
+    }
+
+    int64_t pairs = count / 2;
+    run_parallel(stream->workers, hash_slice, (Slice) {nodes, NULL, parents + parent_count * LEAF_LENGTH, 0, pairs, stream->hash_id});
+    parent_count += pairs;
+
+    if (count % 2) {
+        memcpy(frontier, nodes + (count - 1) * LEAF_LENGTH, LEAF_LENGTH);
+        stream->held[level] = 1;
+    }
+
+    return parent_count;
+}
+
+int stream_leaves(Stream* stream, uint8_t* leaves, int64_t count) {
+    // Each level's parents go into one half of the scratch space while the other half holds their children.
+    size_t half = (count / 2 + 1) * LEAF_LENGTH;
+    uint8_t* scratch = malloc(2 * half);
+    if (scratch == NULL) {
+        return MEMORY_ERROR;
+    }
+
+    stream->leaf_count += count;
+    const uint8_t* nodes = leaves;
+    for (int level = 0; count > 0; level++) {
+        uint8_t* parents = scratch + level % 2 * half;
+        count = push_nodes(stream, level, nodes, count, parents);
+        nodes = parents;
+    }
+    free(scratch);
+
+    return SUCCESS;
+}
+
+int stream_raw_leaves(Stream* stream, uint8_t* data, size_t length, uint64_t* offsets, int64_t count) {
+    uint8_t* leaves = malloc((size_t) count * LEAF_LENGTH + 1);
+    if (leaves == NULL) {
+        return MEMORY_ERROR;
+    }
+
+    int status = hash_raw_leaves(stream->hash_id, stream->workers, data, length, offsets, count, leaves);
+    if (status == SUCCESS) {
+        status = stream_leaves(stream, leaves, count);
+    }
+    free(leaves);
+
+    return status;
+}
+
+/* the root of the leaves so far, as if padded with empty leaves to the next power of two and at least two */
+void stream_root(Stream* stream, uint8_t* out) {
+    if (stream->leaf_count == 0) {
+        memcpy(out, empty, LEAF_LENGTH);
+        return;
+    }
+
+    int depth = 1;
+    while (((uint64_t) 1 << depth) < stream->leaf_count) {
+        depth++;
+    }
+
+    // Fold the unpaired nodes from the bottom up; a node with nothing to its right pairs with an empty one.
+    uint8_t node[LEAF_LENGTH];
+    _Bool carried = 0;
+    for (int i = 0; i < depth; i++) {
+        const uint8_t* frontier = stream->frontier + i * LEAF_LENGTH;
+        if (stream->held[i]) {
+            hash_pair(stream->hash_id, frontier, carried ? node : empty, node);
+            carried = 1;
+        } else if (carried) {
+            hash_pair(stream->hash_id, node, empty, node);
+        }
+    }
+
+    memcpy(out, carried ? node : stream->frontier + depth * LEAF_LENGTH, LEAF_LENGTH);
+}
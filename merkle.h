@@ -1,19 +1,94 @@
 // merkle.h
 typedef struct {
-    int leaf_count;
+    int64_t leaf_count;
     unsigned char* leaves;
+    uint64_t* dirty;
+    int64_t dirty_start;
+    int64_t dirty_end;
 } Branch;
 
+typedef struct Snapshot Snapshot;
+
 typedef struct {
     uint8_t* root;
     int branch_count;
-    int leaf_count;
+    int64_t leaf_count;
     Branch* branches;
+    _Bool deferred;
+    _Bool dirty;
+    int64_t dirty_count;
+    int fd;
+    uint8_t* mapping;
+    size_t mapping_length;
+    Snapshot* snapshots;
+    int workers;
+    int hash_id;
+    int64_t* lookup;
+    int64_t lookup_capacity;
+    int64_t lookup_count;
 } Tree;
 
-Tree* new_tree(unsigned char* leaves[], int count);
+struct Snapshot {
+    Tree* tree;
+    int64_t leaf_count;
+    int branch_count;
+    uint8_t root[32];
+    uint64_t* keys;
+    uint8_t* nodes;
+    int64_t node_count;
+    int64_t capacity;
+    Snapshot* older;
+    Snapshot* newer;
+};
+
+typedef struct {
+    uint64_t leaf_count;
+    int hash_id;
+    int workers;
+    _Bool held[64];
+    uint8_t frontier[64 * 32];
+} Stream;
+
+Tree* new_tree(unsigned char* leaves[], int64_t count);
 uint8_t* get_root(Tree* tree);
-void add_leaf(Tree *tree, uint8_t* leaf, int len, _Bool hashed);
-int update_leaf(Tree *tree, uint8_t* leaf, int index, int len, _Bool hashed);
-int remove_leaf(Tree *tree, int index);
+void set_deferred(Tree* tree, _Bool deferred);
+void set_workers(Tree* tree, int workers);
+int set_hash(Tree* tree, int hash_id);
+int set_hash_backend(char* name);
+const char* get_hash_backend(void);
+int add_leaf(Tree *tree, uint8_t* leaf, size_t len, _Bool hashed);
+int add_leaves(Tree *tree, uint8_t* leaves, int64_t count);
+int hash_leaves(Tree* tree, uint8_t* data, size_t length, uint64_t* offsets, int64_t count, uint8_t* out);
+int add_raw_leaves(Tree *tree, uint8_t* data, size_t length, uint64_t* offsets, int64_t count);
+int update_leaf(Tree *tree, uint8_t* leaf, int64_t index, size_t len, _Bool hashed);
+int update_leaves(Tree *tree, uint8_t* leaves, int64_t* indexes, int64_t count);
+int remove_leaf(Tree *tree, int64_t index);
+int swap_remove_leaf(Tree *tree, int64_t index);
+int get_proof(Tree* tree, int64_t index, uint8_t* siblings);
+int get_proofs(Tree* tree, int64_t* indexes, int64_t count, uint8_t* siblings);
+int get_nodes(Tree* tree, int* levels, int64_t* indexes, int64_t count, uint8_t* nodes);
+int get_multiproof(Tree* tree, int64_t* indexes, int64_t count, uint8_t* nodes, int64_t* node_count);
+_Bool verify_multiproof(uint8_t* leaves, int64_t* indexes, int64_t count, int depth, uint8_t* nodes, int64_t node_count, uint8_t* root, int hash_id);
+_Bool verify_proof(uint8_t* leaf, uint8_t* siblings, char* sides, int depth, uint8_t* root, int hash_id);
+void verify_proofs(uint8_t* leaves, uint8_t* siblings, char* sides, int* depths, uint8_t* roots, int64_t count, _Bool* results, int hash_id);
 int compare(Tree* tree, Tree* other);
+int64_t diff_trees(Tree* tree, Tree* other, int64_t* indexes, int64_t capacity);
+size_t marshal_size(Tree* tree);
+void marshal_tree(Tree* tree, uint8_t* out);
+Tree* unmarshal_tree(uint8_t* data, size_t length, _Bool verify, int* status);
+Tree* open_tree_file(char* path, int hash_id, int* status);
+int sync_tree(Tree* tree);
+int close_tree(Tree* tree);
+void free_tree(Tree* tree);
+void shrink_to_fit(Tree* tree);
+void memory_usage(Tree* tree, uint64_t* usage);
+int set_indexed(Tree* tree, _Bool indexed);
+int64_t find_leaf(Tree* tree, uint8_t* leaf);
+Snapshot* snapshot_tree(Tree* tree);
+int free_snapshot(Snapshot* snapshot);
+int snapshot_proofs(Snapshot* snapshot, int64_t* indexes, int64_t count, uint8_t* siblings);
+Stream* new_stream(int hash_id, int workers);
+void free_stream(Stream* stream);
+int stream_leaves(Stream* stream, uint8_t* leaves, int64_t count);
+int stream_raw_leaves(Stream* stream, uint8_t* data, size_t length, uint64_t* offsets, int64_t count);
+void stream_root(Stream* stream, uint8_t* out);
@@ -1,2 +1,8 @@
 __version__ = "0.0.2"
 VERSION = __version__
+
+from . import aio  # noqa: E402,F401
+from . import sync  # noqa: E402,F401
+from . import tree  # noqa: E402,F401
+from . import util  # noqa: E402,F401
+from .tree import stream_root  # noqa: E402,F401
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Trees for asyncio. The C core drops the GIL while it hashes, so large operations run on an executor
+# without holding up the event loop; small ones are cheaper inline than the hop to a thread.
+import asyncio
+from functools import partial
+
+from .tree import MerkleTree
+
+# Operations on at most this many leaves or indexes run inline on the loop.
+INLINE_LIMIT = 1024
+
+
+class AsyncMerkleTree:
+    # Wraps a MerkleTree, whose lock keeps offloaded operations and inline ones from interleaving. An
+    # inline call must never wait on that lock, so while any offloaded call is in flight every call is
+    # offloaded behind it. Reads of a deferred tree with pending writes are always offloaded, the flush
+    # before them rehashes the dirty nodes. Concurrent awaiters of root share one computation.
+    def __init__(self, tree, executor=None):
+        self.tree = tree
+        self.executor = executor
+        self._root = None
+        self._offloaded = 0
+
+    @classmethod
+    async def new(cls, leaves=None, executor=None, **kwargs):
+        # Same arguments as MerkleTree.new; executor defaults to the loop's.
+        leaves = leaves or []
+        if hasattr(leaves, "__len__") and len(leaves) <= INLINE_LIMIT:
+            return cls(MerkleTree.new(leaves, **kwargs), executor)
+        return cls(await _run(executor, partial(MerkleTree.new, leaves, **kwargs)), executor)
+
+    def _inline(self, size):
+        return size <= INLINE_LIMIT and not self._offloaded and not self.tree._tree.dirty
+
+    def _offload(self, function):
+        # Counted until the executor is done with it, even if every awaiter is cancelled first, since the
+        # lock stays held until then.
+        self._offloaded += 1
+        future = _run(self.executor, function)
+        future.add_done_callback(self._offload_done)
+        return future
+
+    def _offload_done(self, future):
+        self._offloaded -= 1
+
+    async def _call(self, size, method, *args, **kwargs):
+        if self._inline(size):
+            return method(*args, **kwargs)
+        return await asyncio.shield(self._offload(partial(method, *args, **kwargs)))
+
+    async def _write(self, size, method, *args, **kwargs):
+        # A root still being computed predates this write, later awaiters must not share it.
+        self._root = None
+        return await self._call(size, method, *args, **kwargs)
+
+    async def add(self, leaf, hashed=True):
+        await self._write(1, self.tree.add, leaf, hashed)
+
+    async def add_many(self, leaves, hashed=True):
+        leaves = list(leaves)
+        await self._write(len(leaves), self.tree.add_many, leaves, hashed)
+
+    async def update(self, leaf, index, hashed=True):
+        await self._write(1, self.tree.update, leaf, index, hashed)
+
+    async def update_many(self, leaves, hashed=True):
+        await self._write(len(leaves), self.tree.update_many, leaves, hashed)
+
+    async def remove(self, index):
+        await self._write(1, self.tree.remove, index)
+
+    async def get_proof(self, index):
+        return await self._call(1, self.tree.get_proof, index)
+
+    async def get_proofs(self, indexes):
+        indexes = list(indexes)
+        return await self._call(len(indexes), self.tree.get_proofs, indexes)
+
+    async def get_multiproof(self, indexes):
+        indexes = list(indexes)
+        return await self._call(len(indexes), self.tree.get_multiproof, indexes)
+
+    async def index_of(self, leaf_hash):
+        return await self._call(1 if self.tree.indexed else self.tree.leaf_count, self.tree.index_of, leaf_hash)
+
+    async def prove_leaf(self, leaf_hash):
+        return await self._call(1 if self.tree.indexed else self.tree.leaf_count, self.tree.prove_leaf, leaf_hash)
+
+    async def root(self):
+        if self._root is None:
+            if self._inline(1):
+                return self.tree.root
+            self._root = self._offload(lambda: self.tree.root)
+            self._root.add_done_callback(self._root_done)
+        # Shielded so one awaiter being cancelled doesn't cancel the computation the others share.
+        return await asyncio.shield(self._root)
+
+    def _root_done(self, future):
+        if self._root is future:
+            self._root = None
+
+    @property
+    def leaf_count(self):
+        return self.tree.leaf_count
+
+
+def _run(executor, function):
+    return asyncio.get_running_loop().run_in_executor(executor, function)
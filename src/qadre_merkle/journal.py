@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+import os
+import struct
+import time
+import zlib
+from pathlib import Path
+
+
+ADD = b"A"
+UPDATE = b"U"
+REMOVE = b"R"
+SWAP_REMOVE = b"S"
+
+# op, leaf index, leaf hash, crc32 of the preceding fields
+RECORD = struct.Struct("<cQ32sI")
+EMPTY_LEAF = bytes(32)
+
+
+def encode(op, index, leaf=EMPTY_LEAF):
+    record = RECORD.pack(op, index, leaf, 0)
+    return record[:-4] + struct.pack("<I", zlib.crc32(record[:-4]))
+
+
+def decode(data):
+    # Yield (op, index, leaf) for each record, stopping at the first torn or corrupt one.
+    for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+        op, index, leaf, crc = RECORD.unpack_from(data, offset)
+        if zlib.crc32(data[offset:offset + RECORD.size - 4]) != crc or op not in (ADD, UPDATE, REMOVE, SWAP_REMOVE):
+            return
+        yield op, index, leaf
+
+
+class Journal:
+    # An append-only log of tree operations alongside checkpoints of the whole tree, all in one
+    # directory. checkpoint.N holds the tree with every journal before journal.N applied, so recovery
+    # loads the newest checkpoint and replays journal.N onwards.
+    #
+    # fsync is "always" (after every write), "never" (left to the OS) or a number of seconds between
+    # syncs.
+    def __init__(self, directory, fsync="always"):
+        if fsync not in ("always", "never") and not isinstance(fsync, (int, float)):
+            raise ValueError("fsync must be 'always', 'never' or an interval in seconds")
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.sequence = None
+        self._file = None
+        self._synced = time.monotonic()
+        self._broken = None
+
+    def _sequences(self, prefix):
+        sequences = []
+        for path in self.directory.glob(prefix + ".*"):
+            suffix = path.name[len(prefix) + 1:]
+            if suffix.isdigit():
+                sequences.append(int(suffix))
+        return sorted(sequences)
+
+    def _path(self, prefix, sequence):
+        return self.directory / "{}.{}".format(prefix, sequence)
+
+    def checkpoints(self):
+        # Newest first, as (sequence, payload).
+        for sequence in reversed(self._sequences("checkpoint")):
+            yield sequence, self._path("checkpoint", sequence).read_bytes()
+
+    def replay(self, sequence):
+        # Yield every journalled operation from sequence onwards and reopen the newest journal for
+        # appending, dropping any torn record at its end.
+        sequences = [s for s in self._sequences("journal") if s >= sequence] or [sequence]
+        for s in sequences:
+            path = self._path("journal", s)
+            data = path.read_bytes() if path.exists() else b""
+            valid = 0
+            for record in decode(data):
+                valid += RECORD.size
+                yield record
+            if valid != len(data):
+                with open(path, "r+b") as f:
+                    f.truncate(valid)
+        self._open(sequences[-1])
+
+    def _open(self, sequence):
+        if self._file is not None:
+            self._sync(force=True)
+            self._file.close()
+        self.sequence = sequence
+        # Unbuffered, so a failed write leaves nothing behind to be flushed later.
+        self._file = open(self._path("journal", sequence), "ab", buffering=0)
+        self._sync_directory()
+
+    def append(self, records):
+        # Returns the offset the records start at, for discard. A failed append is cut off again; if even
+        # that fails every later append is refused, since replay stops at the torn record.
+        if self._broken is not None:
+            raise OSError("journal unusable after an earlier failed write") from self._broken
+        position = os.fstat(self._file.fileno()).st_size
+        try:
+            records = memoryview(records)
+            while records:
+                records = records[self._file.write(records):]
+            self._sync()
+        except OSError:
+            self.discard(position)
+            raise
+        return position
+
+    def discard(self, position):
+        # Drop everything appended from position on, the records of a write that did not happen. Called
+        # while another error is raised, so a failure here only marks the journal broken.
+        try:
+            self._file.truncate(position)
+            self._sync(force=self.fsync != "never")
+        except OSError as e:
+            self._broken = e
+
+    def _sync(self, force=False):
+        if self.fsync == "never" and not force:
+            return
+        if force or self.fsync == "always" or time.monotonic() - self._synced >= self.fsync:
+            os.fsync(self._file.fileno())
+            self._synced = time.monotonic()
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def rotate(self):
+        # Start the next journal; a checkpoint taken now belongs to the returned sequence.
+        self._open(self.sequence + 1)
+        return self.sequence
+
+    def write_checkpoint(self, sequence, payload):
+        # Safe to run in the background, the journal keeps appending to journal.<sequence> meanwhile.
+        temporary = self._path("checkpoint.tmp", sequence)
+        with open(temporary, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self._path("checkpoint", sequence))
+        self._sync_directory()
+
+        for s in self._sequences("checkpoint"):
+            if s < sequence:
+                self._path("checkpoint", s).unlink()
+        for s in self._sequences("journal"):
+            if s < sequence:
+                self._path("journal", s).unlink()
+
+    def close(self):
+        if self._file is not None:
+            self._sync(force=self.fsync != "never")
+            self._file.close()
+            self._file = None
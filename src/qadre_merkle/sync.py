@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Anti-entropy between replicas. sync() brings a local tree in line with a remote one by descending
+# from the root level by level, asking only for the hashes of subtrees whose parents mismatched, then
+# fetching just the differing leaves.
+#
+# The remote is reached through a transport, any callable taking a request tuple and returning its
+# reply, so requests can be carried over whatever channel the replicas share. serve(tree) answers
+# requests against a tree and doubles as an in-process transport.
+
+SHAPE = "shape"
+NODES = "nodes"
+LEAVES = "leaves"
+
+
+def serve(tree):
+    def transport(request):
+        op, *args = request
+        if op == SHAPE:
+            return tree.leaf_count, tree.depth, tree.hash
+        if op == NODES:
+            return tree.get_nodes(args[0])
+        if op == LEAVES:
+            return [tree.get_leaves(index, index + 1)[0] for index in args[0]]
+        raise ValueError("unknown sync request {!r}".format(op))
+
+    return transport
+
+
+def _resize(tree, transport, leaf_count):
+    # Drop the local leaves beyond leaf_count or fetch the missing ones, returning the indexes added.
+    while tree.leaf_count > leaf_count:
+        tree.remove(tree.leaf_count - 1)
+
+    changed = []
+    if tree.leaf_count < leaf_count:
+        changed = list(range(tree.leaf_count, leaf_count))
+        tree.add_many(transport((LEAVES, changed)), hashed=True)
+    return changed
+
+
+def sync(tree, transport):
+    # Returns the indexes of the leaves that were replaced or added.
+    leaf_count, depth, hash = transport((SHAPE,))
+    if hash != tree.hash:
+        raise ValueError("remote tree uses {} but the local tree uses {}".format(hash, tree.hash))
+
+    changed = _resize(tree, transport, leaf_count)
+    if tree.depth != depth:
+        raise ValueError("remote tree shape does not match its leaf count")
+
+    # Both trees now share a shape, walk it from the root comparing one level at a time.
+    nodes = [(depth, 0)] if leaf_count else []
+    mismatched = []
+    while nodes:
+        remote = transport((NODES, nodes))
+        local = tree.get_nodes(nodes)
+        mismatched = [node for node, theirs, ours in zip(nodes, remote, local) if theirs != ours]
+
+        if not mismatched or mismatched[0][0] == 0:
+            break
+
+        nodes = []
+        for level, index in mismatched:
+            for child in (2 * index, 2 * index + 1):
+                if child << (level - 1) < leaf_count:
+                    nodes.append((level - 1, child))
+
+    indexes = [index for level, index in mismatched if level == 0]
+    if indexes:
+        tree.update_many(dict(zip(indexes, transport((LEAVES, indexes)))))
+
+    return sorted(indexes + changed)
@@ -1,55 +1,760 @@
 #!/usr/bin/env python
-from hashlib import sha256
+import os
+import threading
+from array import array
+from collections.abc import Sequence
+from contextlib import contextmanager
+from functools import partial
+from itertools import accumulate
+from itertools import islice
 
 from _merkle import ffi
 from _merkle import lib
 
+from . import journal as journal_
+
+
+def get_hash_backend():
+    return ffi.string(lib.get_hash_backend()).decode()
+
+
+def set_hash_backend(name):
+    # Sibling hashing uses the SHA extensions ("shani") where the cpu has them and OpenSSL ("openssl")
+    # otherwise, picked when the library loads. Both give identical hashes; switching is for tests and
+    # benchmarks and must not happen while any tree is being hashed.
+    if lib.set_hash_backend(name.encode()) != 0:
+        raise ValueError("hash backend {!r} is not available".format(name))
+
+
+# Tree hash functions, by id. sha256d hashes every leaf and node twice with SHA-256, as Bitcoin does.
+HASHES = ("sha256", "sha256d", "blake2s")
+
+
+def _hash_id(name):
+    if name not in HASHES:
+        raise ValueError("unknown hash {!r}, expected one of {}".format(name, ", ".join(HASHES)))
+    return HASHES.index(name)
+
+
+# How remove fills the gap: "shift" moves every later leaf down one index and rehashes them all, "swap"
+# moves the last leaf into the gap and rehashes only two paths to the root.
+REMOVALS = ("shift", "swap")
+
+# Leaves handed to C at a time by stream_root.
+STREAM_BATCH = 1 << 14
+
+
+def _check_growth(status, path=None):
+    # A write either completes or leaves the tree as it was: out of memory for the tree to grow or for the
+    # bitmaps and snapshot room it reserves up front, or for a file backed tree unable to resize its file.
+    if status == 5:
+        raise OSError(ffi.errno, os.strerror(ffi.errno), *([path] if path else []))
+    if status == 7:
+        raise MemoryError("not enough memory to write to the tree")
+
+
+def stream_root(leaves, hashed=True, hash="sha256", chunk_size=32, workers=1):
+    # The root MerkleTree.new(leaves, hashed, hash=hash) would have, without building the tree: memory holds
+    # one batch of leaves and one node per level. leaves is any iterable, or a binary file read as leaves of
+    # chunk_size bytes, the last possibly shorter.
+    stream = lib.new_stream(_hash_id(hash), workers)
+    if stream == ffi.NULL:
+        raise MemoryError("not enough memory for a stream")
+    stream = ffi.gc(stream, lib.free_stream)
+    if hasattr(leaves, "read"):
+        leaves = iter(partial(leaves.read, chunk_size), b"")
+
+    leaves = iter(leaves)
+    while True:
+        batch = list(islice(leaves, STREAM_BATCH))
+        if not batch:
+            break
+
+        if hashed:
+            packed = b"".join(batch)
+            if len(packed) != len(batch) * 32:
+                raise ValueError("hashed leaves must be 32 bytes")
+            status = lib.stream_leaves(stream, ffi.from_buffer(packed), len(batch))
+        else:
+            data, offsets = MerkleTree._pack_raw(batch)
+            status = lib.stream_raw_leaves(
+                stream, ffi.from_buffer(data), len(data), ffi.from_buffer("uint64_t[]", offsets), len(batch),
+            )
+        if status == 7:
+            raise MemoryError("not enough memory to hash a batch of leaves")
+
+    root = ffi.new("uint8_t[]", 32)
+    lib.stream_root(stream, root)
+    return ffi.buffer(root)[:]
+
 
 class MerkleTree:
     @classmethod
-    def new(cls, leaves=None, hashed=False):
-        if leaves is None:
-            leaves = []
+    def new(cls, leaves=None, hashed=True, lazy=False, workers=1, hash="sha256", removal="shift", indexed=False):
+        # workers > 1 splits the hashing of wide levels across that many native threads, here and in every
+        # later bulk write. The threads are started for each wide level and joined when it is done, none
+        # are kept alive between writes. hash picks the function for raw leaves and nodes, one of HASHES,
+        # and removal the strategy of remove, one of REMOVALS. indexed keeps a native lookup from leaf to
+        # index, see index_of.
+        tree = lib.new_tree(ffi.NULL, 0)
+        if tree == ffi.NULL:
+            raise MemoryError("not enough memory for a tree")
+        lib.set_hash(tree, _hash_id(hash))
+        lib.set_workers(tree, workers)
+        tree = cls(tree)
+        tree.removal = removal
 
-        if not hashed:
-            leaves = [sha256(leaf).digest() for leaf in leaves]
+        if hashed:
+            packed = tree._pack(leaves or [], hashed)
+            _check_growth(lib.add_leaves(tree._tree, ffi.from_buffer(packed), len(packed) // 32))
+        else:
+            tree.add_packed(*cls._pack_raw(leaves or []))
+
+        tree.indexed = indexed
+        if lazy:
+            lib.set_deferred(tree._tree, True)
+        return tree
+
+    @classmethod
+    def unmarshal(cls, data, verify=False):
+        data = ffi.from_buffer(data)
+        status = ffi.new("int *")
+        tree = lib.unmarshal_tree(data, len(data), verify, status)
+
+        if status[0] == 4:
+            raise ValueError("marshalled tree root does not match its leaves")
+        if status[0] == 7:
+            raise MemoryError("not enough memory to unmarshal the tree")
+        if tree == ffi.NULL:
+            raise ValueError("invalid marshalled tree")
+
+        return cls(tree)
+
+    @classmethod
+    def open(cls, path, hash=None):
+        # The tree is mapped from the file, which is created empty if missing. Writes go straight to the
+        # mapping; sync() flushes them to disk and close() releases the file. A new file uses hash, sha256
+        # by default; an existing one keeps its own and must match hash when given.
+        status = ffi.new("int *")
+        tree = lib.open_tree_file(os.fsencode(path), -1 if hash is None else _hash_id(hash), status)
+
+        if tree == ffi.NULL:
+            if status[0] == 5:
+                raise OSError(ffi.errno, os.strerror(ffi.errno), path)
+            if status[0] == 6:
+                raise ValueError("tree file does not use hash {!r}".format(hash))
+            if status[0] == 7:
+                raise MemoryError("not enough memory to open the tree")
+            raise ValueError("invalid tree file")
 
-        leaf_count = len(leaves)
-        leaves = [ffi.new("char[]", leaf) for leaf in leaves]
-        tree = lib.new_tree(leaves, leaf_count)
         return cls(tree)
 
+    @classmethod
+    def recover(cls, directory, fsync="always", hash=None, removal="shift"):
+        # Load the newest readable checkpoint in directory, replay the journal written since and keep
+        # journalling every add, update and remove. An empty directory starts a new tree using hash, sha256
+        # by default; a checkpoint must match hash when given. An older checkpoint only survives next to
+        # the journals written since, so falling back to it loses nothing, but with none readable the
+        # journals alone can't rebuild the tree.
+        journal = journal_.Journal(directory, fsync)
+        tree, sequence = cls._load_checkpoint(journal, hash)
+
+        with tree.deferred():
+            added = []
+            for op, index, leaf in journal.replay(sequence):
+                if op == journal_.ADD:
+                    added.append(leaf)
+                    continue
+                if added:
+                    tree.add_many(added, hashed=True)
+                    added = []
+                if op == journal_.UPDATE:
+                    tree.update(leaf, index)
+                else:
+                    tree.removal = "swap" if op == journal_.SWAP_REMOVE else "shift"
+                    tree.remove(index)
+            tree.add_many(added, hashed=True)
+
+        tree.removal = removal
+        tree._journal = journal
+        return tree
+
+    @classmethod
+    def _load_checkpoint(cls, journal, hash):
+        checkpoints = 0
+        for sequence, payload in journal.checkpoints():
+            checkpoints += 1
+            try:
+                tree = cls.unmarshal(payload)
+            except ValueError:
+                continue
+            if hash is not None and tree.hash != hash:
+                raise ValueError("checkpoint does not use hash {!r}".format(hash))
+            return tree, sequence
+
+        if checkpoints:
+            raise ValueError("no readable checkpoint in {}".format(journal.directory))
+        return cls.new(hash=hash or "sha256"), 0
+
     def __init__(self, tree):
-        self._tree = tree
+        # The native tree is freed with this object, or released early by close().
+        self._tree = ffi.gc(tree, lib.free_tree)
+        self._journal = None
+        self._lock = RWLock()
+        self._released = []
+        self._removal = "shift"
+        self._closed = False
+
+    def _check_open(self):
+        if self._closed:
+            raise ValueError("operation on closed tree")
+
+    @contextmanager
+    def _writing(self):
+        with self._lock.write():
+            self._check_open()
+            # Snapshots dropped since the last write are unlinked from the tree here, under the lock,
+            # rather than from the garbage collector.
+            while self._released:
+                # Left queued when the older snapshot has no room for its nodes, and retried by the next write.
+                _check_growth(lib.free_snapshot(self._released[-1]))
+                self._released.pop()
+            yield
+
+    @contextmanager
+    def _reading(self):
+        # Reads flush deferred writes first, which only a writer may do.
+        while True:
+            with self._lock.read():
+                self._check_open()
+                if not self._tree.dirty:
+                    yield
+                    return
+            with self._writing():
+                lib.get_root(self._tree)
+
+    @contextmanager
+    def _reading_with(self, other):
+        # Both locks are taken in a fixed order so two threads comparing the same trees can't deadlock.
+        if other is self:
+            with self._reading():
+                yield
+            return
+        first, second = sorted((self, other), key=id)
+        with first._reading(), second._reading():
+            yield
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
-        # Success == 0
-        return not lib.compare(self._tree, other._tree)
+        with self._reading_with(other):
+            # Success == 0
+            return not lib.compare(self._tree, other._tree)
 
-    def add(self, leaf, hashed=False):
-        length = len(leaf)
-        leaf = ffi.new("char[]", leaf)
-        return lib.add_leaf(self._tree, leaf, length, hashed)
+    def diff(self, other):
+        # Indexes of the leaves that differ, found by descending only into subtrees whose hashes differ.
+        # Leaves held by only one of the trees differ too.
+        if self.hash != other.hash:
+            raise ValueError("cannot diff a {} tree against a {} tree".format(self.hash, other.hash))
 
-    def update(self, leaf, index, hashed=False):
-        length = len(leaf)
-        leaf = ffi.new("char[]", leaf)
-        status = lib.update_leaf(self._tree, leaf, index, length, hashed)
+        capacity = 64
+        while True:
+            indexes = ffi.new("int64_t[]", capacity)
+            with self._reading_with(other):
+                count = lib.diff_trees(self._tree, other._tree, indexes, capacity)
+            if count <= capacity:
+                return list(indexes[0:count])
+            capacity = count
 
-        if status != 0:
-            raise IndexError("assignment index out of range")
+    @contextmanager
+    def deferred(self):
+        # Writes inside the block only mark nodes dirty, the root is recomputed on the next read.
+        with self._writing():
+            previous = self._tree.deferred
+            lib.set_deferred(self._tree, True)
+        try:
+            yield self
+        finally:
+            # A tree closed inside the block has nothing left to restore.
+            with self._lock.write():
+                if not self._closed:
+                    lib.set_deferred(self._tree, previous)
+
+    def add(self, leaf, hashed=True):
+        # Like every write, leaf is a 32 byte digest stored as is unless hashed is False, when it is hashed first.
+        if hashed and len(leaf) != 32:
+            raise ValueError("hashed leaves must be 32 bytes")
+        if self._journal is not None and not hashed:
+            # The journal records the digest, so it is computed before the tree changes.
+            leaf, hashed = self._pack([leaf], False), True
+        data = ffi.new("char[]", leaf)
+        with self._writing():
+            with self._journalled(journal_.ADD, [self._tree.leaf_count], leaf):
+                _check_growth(lib.add_leaf(self._tree, data, len(leaf), hashed))
+
+    def add_many(self, leaves, hashed=True):
+        if not hashed:
+            self.add_packed(*self._pack_raw(leaves))
+            return
+
+        self._add_hashed(self._pack(leaves, hashed))
+
+    def _add_hashed(self, leaves):
+        with self._writing():
+            start = self._tree.leaf_count
+            with self._journalled(journal_.ADD, range(start, start + len(leaves) // 32), leaves):
+                _check_growth(lib.add_leaves(self._tree, ffi.from_buffer(leaves), len(leaves) // 32))
+
+    def add_packed(self, data, offsets):
+        # Append raw leaves stored back to back in one buffer, leaf i being data[offsets[i]:offsets[i + 1]].
+        # offsets is a buffer of native uint64, such as array("Q"), one longer than the leaf count. The
+        # leaves are hashed in C, on the tree's workers.
+        if self._journal is not None:
+            # The journal records digests, so the leaves are hashed before the tree changes.
+            self._add_hashed(self._hash_packed(data, offsets))
+            return
+
+        data = ffi.from_buffer(data)
+        offsets = ffi.from_buffer("uint64_t[]", offsets)
+        count = max(len(offsets) - 1, 0)
+        with self._writing():
+            status = lib.add_raw_leaves(self._tree, data, len(data), offsets, count)
+
+            _check_growth(status)
+            if status != 0:
+                raise ValueError("leaf offsets out of order or beyond the data")
+
+    def update(self, leaf, index, hashed=True):
+        if hashed and len(leaf) != 32:
+            raise ValueError("hashed leaves must be 32 bytes")
+        if self._journal is not None and not hashed:
+            leaf, hashed = self._pack([leaf], False), True
+        data = ffi.new("char[]", leaf)
+        with self._writing():
+            with self._journalled(journal_.UPDATE, [index], leaf):
+                status = lib.update_leaf(self._tree, data, index, len(leaf), hashed)
+
+                _check_growth(status)
+                if status != 0:
+                    raise IndexError("assignment index out of range")
+
+    def update_many(self, leaves, hashed=True):
+        indexes = list(leaves.keys())
+        leaves = self._pack(leaves.values(), hashed)
+        with self._writing():
+            with self._journalled(journal_.UPDATE, indexes, leaves):
+                status = lib.update_leaves(self._tree, ffi.from_buffer(leaves), indexes, len(indexes))
+
+                _check_growth(status)
+                if status != 0:
+                    raise IndexError("assignment index out of range")
 
     def remove(self, index):
-        status = lib.remove_leaf(self._tree, index)
+        # With the "swap" removal the last leaf takes index, other leaves keep theirs.
+        swap = self._removal == "swap"
+        with self._writing():
+            with self._journalled(journal_.SWAP_REMOVE if swap else journal_.REMOVE, [index]):
+                status = (lib.swap_remove_leaf if swap else lib.remove_leaf)(self._tree, index)
+
+                _check_growth(status)
+                if status == 1:
+                    raise IndexError("pop index out of range")
 
-        if status == 1:
-            raise IndexError("pop index out of range")
+                if status == 2:
+                    raise IndexError("pop from empty list")
+
+    @contextmanager
+    def _journalled(self, op, indexes, leaves=None):
+        # Write ahead: the records of a write reach the journal before the tree changes, and are cut off
+        # again if the write then fails, so replay never holds a change the tree doesn't or misses one it
+        # does. A failed append leaves the tree untouched.
+        if self._journal is None or not indexes:
+            yield
+            return
+        if op != journal_.ADD and not all(0 <= index < self._tree.leaf_count for index in indexes):
+            # The tree rejects the write, there is nothing to journal.
+            yield
+            return
+
+        records = b"".join(
+            journal_.encode(op, index, journal_.EMPTY_LEAF if leaves is None else leaves[i * 32:(i + 1) * 32])
+            for i, index in enumerate(indexes)
+        )
+        position = self._journal.append(records)
+        try:
+            yield
+        except BaseException:
+            self._journal.discard(position)
+            raise
+
+    def compact(self, wait=False):
+        # Fold the journal into a new checkpoint. Only the copy of the tree happens here, the checkpoint
+        # is written and the old journal dropped on a background thread, which is returned.
+        with self._writing():
+            if self._journal is None:
+                raise ValueError("tree has no journal, open it with recover()")
+            payload = self._marshal()
+            sequence = self._journal.rotate()
+        thread = threading.Thread(target=self._journal.write_checkpoint, args=(sequence, payload))
+        thread.start()
+
+        if wait:
+            thread.join()
+        return thread
+
+    def sync(self):
+        with self._writing():
+            if lib.sync_tree(self._tree) != 0:
+                raise OSError(ffi.errno, os.strerror(ffi.errno))
+
+    def close(self):
+        # Release the tree's nodes now rather than when it is collected. A file backed tree is synced and
+        # unmapped first. Like a closed file, the tree refuses every later operation with ValueError, and
+        # closing it again does nothing. Snapshots stay readable, they copy the nodes they still need.
+        with self._lock.write():
+            if self._closed:
+                return
+            while self._released:
+                _check_growth(lib.free_snapshot(self._released[-1]))
+                self._released.pop()
+            # Live snapshots copy every node first, without memory for that the tree stays open.
+            _check_growth(lib.close_tree(self._tree))
+            self._closed = True
+
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def shrink(self):
+        # Release capacity beyond the next power of two of the leaf count and the bitmaps kept for deferred
+        # writes, flushing them first.
+        with self._writing():
+            lib.shrink_to_fit(self._tree)
+
+    def memory_usage(self):
+        # Bytes held natively: "nodes" on the heap, "dirty" bitmaps of deferred writes, "snapshots" for the
+        # nodes saved into live snapshots, "mapped" for the file mapping of a file backed tree and "index" for
+        # the leaf lookup of an indexed tree.
+        usage = ffi.new("uint64_t[]", 5)
+        with self._lock.read():
+            self._check_open()
+            lib.memory_usage(self._tree, usage)
+        return dict(zip(("nodes", "dirty", "snapshots", "mapped", "index"), usage))
+
+    def marshal(self):
+        with self._reading():
+            return self._marshal()
+
+    def _marshal(self):
+        payload = bytearray(lib.marshal_size(self._tree))
+        lib.marshal_tree(self._tree, ffi.from_buffer(payload))
+        return payload
+
+    def get_proof(self, index):
+        with self._reading():
+            return self._get_proof(index)
+
+    def _get_proof(self, index):
+        depth = self._tree.branch_count
+        siblings = ffi.new("uint8_t[]", (depth + 1) * 32)
+        status = lib.get_proof(self._tree, index, siblings)
+
+        if status != 0:
+            raise IndexError("proof index out of range")
 
-        if status == 2:
-            raise IndexError("pop from empty list")
+        return Proofs([index], depth, siblings, self.hash)[0]
+
+    def index_of(self, leaf_hash):
+        # The lowest index holding the hashed leaf, in O(1) expected time on an indexed tree and by a native
+        # scan otherwise. Raises ValueError when no leaf matches.
+        with self._lock.read():
+            return self._index_of(leaf_hash)
+
+    def _index_of(self, leaf_hash):
+        if len(leaf_hash) != 32:
+            raise ValueError("hashed leaves must be 32 bytes")
+
+        index = lib.find_leaf(self._tree, leaf_hash)
+        if index < 0:
+            raise ValueError("leaf is not in the tree")
+        return index
+
+    def prove_leaf(self, leaf_hash):
+        # get_proof(index_of(leaf_hash)), with no write in between.
+        with self._reading():
+            return self._get_proof(self._index_of(leaf_hash))
+
+    def get_proofs(self, indexes):
+        indexes = list(indexes)
+        with self._reading():
+            depth = self._tree.branch_count
+            siblings = ffi.new("uint8_t[]", (len(indexes) * depth + 1) * 32)
+            status = lib.get_proofs(self._tree, indexes, len(indexes), siblings)
+
+        if status != 0:
+            raise IndexError("proof index out of range")
+
+        return Proofs(indexes, depth, siblings, self.hash)
+
+    def get_multiproof(self, indexes):
+        indexes = sorted(set(indexes))
+        with self._reading():
+            depth = self._tree.branch_count
+            nodes = ffi.new("uint8_t[]", max(len(indexes) * depth, 1) * 32)
+            node_count = ffi.new("int64_t *")
+            status = lib.get_multiproof(self._tree, indexes, len(indexes), nodes, node_count)
+            root = ffi.buffer(self._tree.root, 32)[:]
+
+        if status == 7:
+            raise MemoryError("not enough memory for the multiproof")
+        if status != 0:
+            raise IndexError("proof index out of range")
+
+        return Multiproof(indexes, depth, ffi.buffer(nodes, node_count[0] * 32)[:], root, self.hash)
+
+    def get_nodes(self, nodes):
+        # Hashes of the (level, index) nodes; level 0 holds the leaves and level depth the root, so the node
+        # at (level, index) covers leaves index << level up to (index + 1) << level.
+        nodes = list(nodes)
+        levels = [level for level, _ in nodes]
+        indexes = [index for _, index in nodes]
+        hashes = ffi.new("uint8_t[]", max(len(nodes), 1) * 32)
+        with self._reading():
+            status = lib.get_nodes(self._tree, levels, indexes, len(nodes), hashes)
+
+        if status != 0:
+            raise IndexError("node out of range")
+
+        hashes = ffi.buffer(hashes)
+        return [hashes[i * 32:(i + 1) * 32] for i in range(len(nodes))]
+
+    def get_node(self, level, index):
+        return self.get_nodes([(level, index)])[0]
+
+    def get_leaves(self, start=0, end=None):
+        with self._lock.read():
+            self._check_open()
+            start, end, _ = slice(start, end).indices(self.leaf_count)
+            leaves = ffi.buffer(self._tree.branches[0].leaves, end * 32) if end > start else b""
+            return [leaves[i * 32:(i + 1) * 32] for i in range(start, end)]
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def depth(self):
+        self._check_open()
+        return self._tree.branch_count
+
+    @property
+    def workers(self):
+        return self._tree.workers
+
+    @workers.setter
+    def workers(self, workers):
+        with self._writing():
+            lib.set_workers(self._tree, workers)
+
+    @property
+    def removal(self):
+        return self._removal
+
+    @removal.setter
+    def removal(self, removal):
+        if removal not in REMOVALS:
+            raise ValueError("unknown removal {!r}, expected one of {}".format(removal, ", ".join(REMOVALS)))
+        self._removal = removal
+
+    @property
+    def indexed(self):
+        return self._tree.lookup != ffi.NULL
+
+    @indexed.setter
+    def indexed(self, indexed):
+        # Turning the lookup on builds it from the leaves, add, update and remove keep it current from then on.
+        with self._writing():
+            if lib.set_indexed(self._tree, indexed) != 0:
+                raise MemoryError("not enough memory to index the tree")
+
+    @property
+    def hash(self):
+        return HASHES[self._tree.hash_id]
+
+    @property
+    def leaf_count(self):
+        self._check_open()
+        return self._tree.leaf_count
+
+    def snapshot(self):
+        with self._writing():
+            return Snapshot(self)
+
+    def _pack(self, leaves, hashed):
+        if not hashed:
+            return self._hash_packed(*self._pack_raw(leaves))
+
+        leaves = list(leaves)
+        packed = b"".join(leaves)
+        if len(packed) != len(leaves) * 32:
+            raise ValueError("hashed leaves must be 32 bytes")
+        return packed
+
+    def _hash_packed(self, data, offsets):
+        count = max(len(offsets) - 1, 0)
+        hashes = bytearray(count * 32)
+        status = lib.hash_leaves(
+            self._tree, ffi.from_buffer(data), len(data), ffi.from_buffer("uint64_t[]", offsets), count,
+            ffi.from_buffer(hashes),
+        )
+        if status != 0:
+            raise ValueError("leaf offsets out of order or beyond the data")
+        return bytes(hashes)
+
+    @staticmethod
+    def _pack_raw(leaves):
+        leaves = list(leaves)
+        offsets = array("Q", [0])
+        offsets.extend(accumulate(map(len, leaves)))
+        return b"".join(leaves), offsets
 
     @property
     def root(self):
-        return ffi.buffer(lib.get_root(self._tree), 32)[:]
+        with self._reading():
+            return ffi.buffer(self._tree.root, 32)[:]
+
+
+class RWLock:
+    # Any number of readers or a single writer. A waiting writer holds off new readers, so a steady stream
+    # of reads can't starve it. Not reentrant.
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writing or self._waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class Snapshot:
+    # A read-only view of a tree as it was when taken. Taking one is O(1); afterwards the tree saves each
+    # node it overwrites into the newest snapshot, so memory grows with the nodes changed since, and is
+    # released when the snapshot is dropped.
+    def __init__(self, tree):
+        # Taken under the tree's write lock; dropping it only queues it for the tree's next writer to free.
+        self.tree = tree
+        snapshot = lib.snapshot_tree(tree._tree)
+        if snapshot == ffi.NULL:
+            raise MemoryError("not enough memory for a snapshot")
+        self._snapshot = ffi.gc(snapshot, tree._released.append)
+        self.root = ffi.buffer(self._snapshot.root, 32)[:]
+
+    def __len__(self):
+        return self._snapshot.leaf_count
+
+    def get_proof(self, index):
+        return self.get_proofs([index])[0]
+
+    def get_proofs(self, indexes):
+        indexes = list(indexes)
+        depth = self._snapshot.branch_count
+        siblings = ffi.new("uint8_t[]", (len(indexes) * depth + 1) * 32)
+        with self.tree._lock.read():
+            status = lib.snapshot_proofs(self._snapshot, indexes, len(indexes), siblings)
+
+        if status != 0:
+            raise IndexError("proof index out of range")
+
+        return Proofs(indexes, depth, siblings, self.tree.hash)
+
+
+class Proofs(Sequence):
+    # Proofs for many leaves in one buffer, each sibling path laid out back to back and followed by the
+    # shared root. The side of the sibling at each level is the matching bit of the leaf index, set when
+    # the sibling is on the left.
+    def __init__(self, indexes, depth, siblings, hash="sha256"):
+        self.indexes = indexes
+        self.depth = depth
+        self.siblings = ffi.buffer(siblings)
+        self.hash = hash
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        sides = self.side_mask(item)
+        offset = (item % len(self)) * self.depth * 32
+        proof = []
+        for level in range(self.depth):
+            sibling = self.siblings[offset + level * 32:offset + (level + 1) * 32]
+            proof.append(["L" if sides >> level & 1 else "R", sibling])
+        proof.append(["ROOT", self.root])
+        return proof
+
+    def side_mask(self, item):
+        return self.indexes[item] & ((1 << self.depth) - 1)
+
+    @property
+    def root(self):
+        return self.siblings[-32:]
+
+
+class Multiproof:
+    # The siblings needed to rebuild the root from a set of leaves, each emitted once. Nodes are ordered
+    # level by level from the leaves up and by index within a level, the order the verifier consumes them.
+    def __init__(self, indexes, depth, nodes, root, hash="sha256"):
+        self.indexes = indexes
+        self.depth = depth
+        self.nodes = nodes
+        self.root = root
+        self.hash = hash
+
+    def __len__(self):
+        return len(self.nodes) // 32
+
+    def verify(self, leaves):
+        # Leaves are hashed and ordered to match indexes.
+        leaves = b"".join(leaves)
+        if len(leaves) != len(self.indexes) * 32 or len(self.nodes) % 32 or len(self.root) != 32:
+            return False
+
+        return lib.verify_multiproof(
+            leaves, self.indexes, len(self.indexes), self.depth, self.nodes, len(self), self.root,
+            _hash_id(self.hash),
+        )
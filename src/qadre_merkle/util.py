@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+from _merkle import ffi
+from _merkle import lib
+
+from .tree import Proofs
+from .tree import _hash_id
+
+
+def _pack(proof):
+    # [[side, sibling], ..., ["ROOT", root]] -> (sides, siblings, root), None if malformed.
+    if not proof or proof[-1][0] != "ROOT" or len(proof[-1][1]) != 32:
+        return None
+
+    sides = "".join(side for side, _ in proof[:-1])
+    siblings = b"".join(sibling for _, sibling in proof[:-1])
+    if len(siblings) != len(sides) * 32 or sides.strip("LR"):
+        return None
+
+    return sides.encode(), siblings, proof[-1][1]
+
+
+def _sides(mask, depth):
+    return format(mask, "0{}b".format(depth))[::-1].replace("0", "R").replace("1", "L").encode()
+
+
+def verify_proof(proof, leaf, hash="sha256"):
+    # hash is the tree's, see tree.HASHES.
+    hash_id = _hash_id(hash)
+    packed = _pack(proof)
+    if packed is None or len(leaf) != 32:
+        return False
+
+    sides, siblings, root = packed
+    return lib.verify_proof(leaf, siblings, sides, len(sides), root, hash_id)
+
+
+def verify_proofs(proofs, leaves, hash="sha256"):
+    # Proofs from get_proofs carry their tree's hash and ignore the argument.
+    hash_id = _hash_id(proofs.hash if isinstance(proofs, Proofs) else hash)
+    leaves = list(leaves)
+    if len(leaves) != len(proofs):
+        raise ValueError("expected one leaf per proof")
+
+    if isinstance(proofs, Proofs):
+        # Proofs from get_proofs already share one sibling buffer, the sides come from the indexes.
+        sides = b"".join(_sides(proofs.side_mask(i), proofs.depth) for i in range(len(proofs)))
+        siblings = ffi.from_buffer(proofs.siblings)
+        depths = [proofs.depth] * len(proofs)
+        roots = proofs.root * len(proofs)
+        valid = [True] * len(proofs)
+    else:
+        packed = [_pack(proof) for proof in proofs]
+        valid = [p is not None for p in packed]
+        packed = [p or (b"", b"", bytes(32)) for p in packed]
+        sides = b"".join(p[0] for p in packed)
+        siblings = b"".join(p[1] for p in packed)
+        depths = [len(p[0]) for p in packed]
+        roots = b"".join(p[2] for p in packed)
+
+    valid = [ok and len(leaf) == 32 for ok, leaf in zip(valid, leaves)]
+    leaves = b"".join(leaf if ok else bytes(32) for ok, leaf in zip(valid, leaves))
+
+    results = ffi.new("_Bool[]", len(proofs))
+    lib.verify_proofs(leaves, siblings, sides, depths, roots, len(proofs), results, hash_id)
+    return [result and ok for result, ok in zip(results, valid)]
+
+
+def combine_proofs(*proofs):
+    # Chain proofs of a leaf in a subtree and of the subtree root in its parent, innermost first.
+    combined = []
+    for proof in proofs[:-1]:
+        combined.extend(proof[:-1])
+    combined.extend(proofs[-1])
+    return combined
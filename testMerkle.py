@@ -13,7 +13,7 @@ if __name__ == "__main__":
 
     print("00:", mt.root.hex(), pmt.root.hex(), mt.root.hex() == pmt.root.hex())
     for i, k in enumerate([b"a", b"b", b"c", b"d", b"e", b"f", b"g", b"h", b"i", b"j", b"k", b"l"]):
-        mt.add(k)
+        mt.add(k, hashed=False)
         pmt.add(sha256(k).digest(), hashed=True)
         print("{}:".format(i+1).zfill(3), mt.root.hex(), pmt.root.hex(), mt.root.hex() == pmt.root.hex())
 
@@ -1,4 +1,6 @@
+import os
 import random
+from array import array
 from hashlib import sha256
 from math import log
 from math import log2
@@ -6,7 +8,12 @@ from uuid import uuid4
 
 import pytest
 
+from mercle.tree import HASHES
 from mercle.tree import MerkleTree
+from mercle.tree import get_hash_backend
+from mercle.tree import set_hash_backend
+from mercle.tree import stream_root
+from mercle.util import verify_proofs
 
 
 BOOL = b"\x01"
@@ -17,6 +24,11 @@ BYTES = b"\x04"
 
 LEAF_COUNTS = [1, 2, 8, 32, 256, 1024, 32768, 65536]
 
+# One past 2^26 leaves, so the tree needs a 27th branch. The file takes about 8GB and the build several
+# minutes, so the stress test only runs when MERCLE_STRESS is set.
+STRESS_LEAF_COUNT = (1 << 26) + 1
+STRESS_BATCH = 1 << 20
+
 
 def digest_primitive(obj):
     if isinstance(obj, bool):
@@ -51,7 +63,39 @@ def test_merkle_add_N_unhashed_leaves(benchmark, count):
     def internal():
         m = MerkleTree.new([])
         for _ in range(count):
-            m.add(digest_primitive(uuid4().hex))
+            m.add(digest_primitive(uuid4().hex), hashed=False)
+
+    benchmark(internal)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_new_with_N_hashed_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+
+    benchmark(MerkleTree.new, leaves, True)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_new_with_N_unhashed_leaves(benchmark, count):
+    leaves = [uuid4().bytes for _ in range(count)]
+
+    benchmark(MerkleTree.new, leaves=leaves, hashed=False)
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4])
+def test_merkle_new_with_65536_hashed_leaves_on_N_workers(benchmark, workers):
+    leaves = [digest(uuid4().hex) for _ in range(65536)]
+
+    benchmark(MerkleTree.new, leaves=leaves, workers=workers)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_add_many_N_hashed_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+
+    def internal():
+        m = MerkleTree.new([])
+        m.add_many(leaves, True)
 
     benchmark(internal)
 
@@ -155,3 +199,154 @@ def test_merkle_update_with_N_starting_leaves(benchmark, count):
 # @pytest.mark.parametrize("count", [2, 8, 32, 256, 1024, 32768, 65536])
 # def test_log_bit_length(benchmark, count):
 #     benchmark(count.bit_length)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_update_many_with_N_starting_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+    updates = {random.randint(0, count - 1): digest(uuid4().hex) for _ in range(count // 8 + 1)}
+
+    benchmark(m.update_many, updates, True)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_deferred_updates_with_N_starting_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+    updates = [(digest(uuid4().hex), random.randint(0, count - 1)) for _ in range(count // 8 + 1)]
+
+    def internal():
+        with m.deferred():
+            for leaf, index in updates:
+                m.update(leaf, index, True)
+        return m.root
+
+    benchmark(internal)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_get_proof_with_N_starting_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+
+    benchmark(m.get_proof, random.randint(0, count - 1))
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_get_proofs_with_N_starting_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+    indexes = [random.randint(0, count - 1) for _ in range(5000)]
+
+    benchmark(m.get_proofs, indexes)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_get_multiproof_with_N_starting_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+    start = random.randint(0, count - 1)
+    indexes = range(start, min(start + 5000, count))
+
+    benchmark(m.get_multiproof, indexes)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_unmarshal_with_N_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    payload = MerkleTree.new(leaves=leaves).marshal()
+
+    benchmark(MerkleTree.unmarshal, payload)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_open_with_N_leaves(benchmark, tmp_path, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    (tmp_path / "tree").write_bytes(MerkleTree.new(leaves=leaves).marshal())
+
+    def internal():
+        MerkleTree.open(tmp_path / "tree").close()
+
+    benchmark(internal)
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_merkle_diff_few_changes_with_N_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m1 = MerkleTree.new(leaves=leaves)
+    m2 = MerkleTree.new(leaves=leaves)
+    for index in random.sample(range(count), min(count, 8)):
+        m2.update(digest(uuid4().hex), index)
+
+    benchmark(m1.diff, m2)
+
+
+@pytest.mark.parametrize("backend", ["openssl", "shani"])
+def test_merkle_new_with_65536_hashed_leaves_on_backend(benchmark, backend):
+    leaves = [digest(uuid4().hex) for _ in range(65536)]
+    previous = get_hash_backend()
+    try:
+        set_hash_backend(backend)
+    except ValueError:
+        pytest.skip("{} not supported on this cpu".format(backend))
+
+    try:
+        benchmark(MerkleTree.new, leaves=leaves)
+    finally:
+        set_hash_backend(previous)
+
+
+@pytest.mark.parametrize("hash", HASHES)
+def test_merkle_new_with_65536_hashed_leaves_by_hash(benchmark, hash):
+    leaves = [digest(uuid4().hex) for _ in range(65536)]
+    benchmark(MerkleTree.new, leaves=leaves, hash=hash)
+
+
+def test_stream_root_with_65536_hashed_leaves(benchmark):
+    leaves = [digest(uuid4().hex) for _ in range(65536)]
+    benchmark(stream_root, leaves)
+
+
+@pytest.mark.parametrize("removal", ["shift", "swap"])
+def test_merkle_remove_first_of_65536_leaves(benchmark, removal):
+    leaves = [digest(uuid4().hex) for _ in range(65536)]
+    m = MerkleTree.new(leaves=leaves, removal=removal)
+
+    benchmark.pedantic(m.remove, args=(0,), rounds=100)
+
+
+@pytest.mark.skipif(not os.environ.get("MERCLE_STRESS"), reason="set MERCLE_STRESS to build a 2^26 + 1 leaf tree")
+def test_merkle_get_proofs_in_file_tree_with_2_26_plus_1_leaves(benchmark, tmp_path):
+    m = MerkleTree.open(tmp_path / "tree")
+    offsets = array("Q", range(0, STRESS_BATCH * 32 + 1, 32))
+    for start in range(0, STRESS_LEAF_COUNT, STRESS_BATCH):
+        count = min(STRESS_BATCH, STRESS_LEAF_COUNT - start)
+        m.add_packed(os.urandom(count * 32), offsets[:count + 1])
+
+    assert m.leaf_count == STRESS_LEAF_COUNT
+    assert m.depth == 27
+
+    indexes = [0, 1 << 25, STRESS_LEAF_COUNT - 1] + random.sample(range(STRESS_LEAF_COUNT), 1000)
+    proofs = benchmark(m.get_proofs, indexes)
+
+    assert all(verify_proofs(proofs, [m.get_leaves(index, index + 1)[0] for index in indexes]))
+    # A root built independently, without the tree's branches.
+    batches = (m.get_leaves(start, start + STRESS_BATCH) for start in range(0, STRESS_LEAF_COUNT, STRESS_BATCH))
+    assert stream_root(leaf for batch in batches for leaf in batch) == m.root
+    m.close()
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_merkle_index_of_last_of_65536_leaves(benchmark, indexed):
+    leaves = [digest(uuid4().hex) for _ in range(65536)]
+    m = MerkleTree.new(leaves=leaves, indexed=indexed)
+
+    benchmark(m.index_of, leaves[-1])
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_merkle_remove_last_of_65536_leaves(benchmark, indexed):
+    m = MerkleTree.new(leaves=[digest(uuid4().hex) for _ in range(65536 + 100)], indexed=indexed)
+
+    benchmark.pedantic(lambda: m.remove(m.leaf_count - 1), rounds=100)
@@ -0,0 +1,35 @@
+import random
+from hashlib import sha256
+from uuid import uuid4
+
+import pytest
+
+from mercle.tree import MerkleTree
+from mercle.util import verify_proof
+from mercle.util import verify_proofs
+
+
+LEAF_COUNTS = [1, 2, 8, 32, 256, 1024, 32768, 65536]
+
+
+def digest(value):
+    return sha256(value.encode()).digest()
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_verify_proof_with_N_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+    index = random.randint(0, count - 1)
+
+    benchmark(verify_proof, m.get_proof(index), leaves[index])
+
+
+@pytest.mark.parametrize("count", LEAF_COUNTS)
+def test_verify_5000_proofs_with_N_leaves(benchmark, count):
+    leaves = [digest(uuid4().hex) for _ in range(count)]
+    m = MerkleTree.new(leaves=leaves)
+    indexes = [random.randint(0, count - 1) for _ in range(5000)]
+    proofs = m.get_proofs(indexes)
+
+    benchmark(verify_proofs, proofs, [leaves[index] for index in indexes])
@@ -0,0 +1,175 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+import pytest
+
+import mercle.aio
+import mercle.tree
+import mercle.util
+
+
+def digest(value):
+    return sha256(str(value).encode()).digest()
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+@pytest.fixture
+def executor():
+    executor = CountingExecutor()
+    yield executor
+    executor.shutdown()
+
+
+def test_small_operations_run_inline(executor):
+    async def run():
+        tree = await mercle.aio.AsyncMerkleTree.new([digest(i) for i in range(10)], executor=executor)
+        await tree.add(b"raw", hashed=False)
+        await tree.update(digest("updated"), 0)
+        await tree.remove(1)
+        proof = await tree.get_proof(2)
+        return tree, proof, await tree.root()
+
+    tree, proof, root = asyncio.run(run())
+
+    assert executor.submitted == 0
+    assert root == tree.tree.root
+    assert mercle.util.verify_proof(proof, digest(3))
+
+
+def test_large_operations_are_offloaded(executor):
+    count = mercle.aio.INLINE_LIMIT + 1
+    leaves = [digest(i) for i in range(count)]
+
+    async def run():
+        tree = await mercle.aio.AsyncMerkleTree.new(leaves, executor=executor)
+        await tree.add_many([str(i).encode() for i in range(count)], hashed=False)
+        await tree.update_many({i: digest(-i) for i in range(count)})
+        proofs = await tree.get_proofs(range(count))
+        multiproof = await tree.get_multiproof(range(count))
+        return tree, proofs, multiproof
+
+    tree, proofs, multiproof = asyncio.run(run())
+
+    assert executor.submitted == 5
+    expected = mercle.tree.MerkleTree.new([digest(-i) for i in range(count)])
+    expected.add_many([str(i).encode() for i in range(count)], hashed=False)
+    assert tree.tree == expected
+    assert tree.leaf_count == 2 * count
+    assert all(mercle.util.verify_proofs(proofs, [digest(-i) for i in range(count)]))
+    assert multiproof.verify([digest(-i) for i in range(count)])
+
+
+def test_index_lookups_run_inline_on_indexed_trees(executor):
+    leaves = [digest(i) for i in range(mercle.aio.INLINE_LIMIT + 1)]
+
+    async def run():
+        indexed = await mercle.aio.AsyncMerkleTree.new(leaves, executor=executor, indexed=True)
+        index, proof = await indexed.index_of(digest(5)), await indexed.prove_leaf(digest(5))
+        scanned = mercle.aio.AsyncMerkleTree(mercle.tree.MerkleTree.new(leaves), executor)
+        return index, proof, await scanned.index_of(digest(5))
+
+    index, proof, scanned = asyncio.run(run())
+
+    assert executor.submitted == 2
+    assert index == scanned == 5
+    assert mercle.util.verify_proof(proof, digest(5))
+
+
+def test_small_operations_wait_behind_offloaded_writes(executor):
+    leaves = [digest(i) for i in range(10)]
+    release = threading.Event()
+    released = []
+
+    def add_many(leaves, hashed):
+        # Holds the write lock until the loop sets release, which it can't do if an inline call blocks it.
+        with tree.tree._writing():
+            released.append(release.wait(5))
+        original(leaves, hashed)
+
+    async def run():
+        pending = asyncio.ensure_future(tree.add_many(leaves[5:] + [digest(i) for i in range(1020)], hashed=True))
+        await asyncio.sleep(0.01)
+        calls = [asyncio.ensure_future(call) for call in (tree.get_proof(0), tree.add(digest("a"), hashed=True))]
+        root = asyncio.ensure_future(tree.root())
+        await asyncio.sleep(0.05)
+        release.set()
+        await pending
+        return await asyncio.gather(*calls), await root
+
+    tree = mercle.aio.AsyncMerkleTree(mercle.tree.MerkleTree.new(leaves[:5]), executor)
+    original = tree.tree.add_many
+    tree.tree.add_many = add_many
+    (proof, _), root = asyncio.run(run())
+
+    assert released == [True]
+    assert executor.submitted == 4
+    assert mercle.util.verify_proof(proof, digest(0))
+    expected = mercle.tree.MerkleTree.new(leaves + [digest(i) for i in range(1020)])
+    assert root in (expected.root, tree.tree.root)
+    expected.add(digest("a"), hashed=True)
+    assert tree.tree == expected
+
+
+def test_concurrent_roots_are_coalesced(executor):
+    leaves = [digest(i) for i in range(5000)]
+
+    async def run():
+        tree = mercle.aio.AsyncMerkleTree(mercle.tree.MerkleTree.new(lazy=True), executor)
+        await tree.add_many(leaves[:10], hashed=True)
+        roots = await asyncio.gather(*[tree.root() for _ in range(10)])
+        return roots, await tree.root()
+
+    roots, root = asyncio.run(run())
+
+    assert executor.submitted == 1
+    assert roots == [mercle.tree.MerkleTree.new(leaves[:10]).root] * 10
+    assert root == roots[0]
+
+
+def test_root_awaited_after_write_is_not_shared(executor):
+    async def run():
+        tree = mercle.aio.AsyncMerkleTree(mercle.tree.MerkleTree.new(lazy=True), executor)
+        await tree.add(digest(0), hashed=True)
+        before = asyncio.ensure_future(tree.root())
+        await asyncio.sleep(0)
+        await tree.add(digest(1), hashed=True)
+        return await before, await tree.root()
+
+    before, after = asyncio.run(run())
+
+    assert before in (
+        mercle.tree.MerkleTree.new([digest(0)]).root, mercle.tree.MerkleTree.new([digest(0), digest(1)]).root,
+    )
+    assert after == mercle.tree.MerkleTree.new([digest(0), digest(1)]).root
+
+
+def test_cancelled_root_awaiter_does_not_cancel_others(executor):
+    async def run():
+        tree = mercle.aio.AsyncMerkleTree(mercle.tree.MerkleTree.new(lazy=True), executor)
+        await tree.add(digest(0), hashed=True)
+        first, second = asyncio.ensure_future(tree.root()), asyncio.ensure_future(tree.root())
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == mercle.tree.MerkleTree.new([digest(0)]).root
+
+
+def test_errors_propagate(executor):
+    async def run():
+        tree = await mercle.aio.AsyncMerkleTree.new(executor=executor)
+        await tree.get_proofs(range(mercle.aio.INLINE_LIMIT + 1))
+
+    with pytest.raises(IndexError):
+        asyncio.run(run())
@@ -0,0 +1,221 @@
+import errno
+import os
+from hashlib import sha256
+
+import pytest
+
+import mercle.journal
+import mercle.tree
+
+
+def digest(value):
+    return sha256(str(value).encode()).digest()
+
+
+def apply(tree):
+    tree.add(b"raw", hashed=False)
+    tree.add_many([digest(value) for value in range(10)], hashed=True)
+    tree.update(digest("x"), 3)
+    tree.update_many({0: digest("y"), 7: digest("z")})
+    tree.remove(5)
+    tree.add(digest("w"), hashed=True)
+
+
+def test_encode_decode():
+    records = mercle.journal.encode(mercle.journal.ADD, 3, digest(3)) + mercle.journal.encode(
+        mercle.journal.REMOVE,
+        1,
+    )
+
+    assert list(mercle.journal.decode(records)) == [
+        (mercle.journal.ADD, 3, digest(3)),
+        (mercle.journal.REMOVE, 1, bytes(32)),
+    ]
+
+
+def test_decode_stops_at_corrupt_record():
+    records = mercle.journal.encode(mercle.journal.ADD, 0, digest(0)) * 2
+    corrupt = bytearray(records)
+    corrupt[-5] ^= 1
+
+    assert len(list(mercle.journal.decode(corrupt))) == 1
+    assert len(list(mercle.journal.decode(records[:-1]))) == 1
+
+
+def test_invalid_fsync_policy(tmp_path):
+    with pytest.raises(ValueError):
+        mercle.journal.Journal(tmp_path, fsync="sometimes")
+
+
+def test_recover_empty_directory(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path / "journal")
+
+    assert tree == mercle.tree.MerkleTree.new()
+    tree.close()
+
+
+@pytest.mark.parametrize("fsync", ("always", "never", 0.5))
+def test_recover_replays_journal(tmp_path, fsync):
+    tree = mercle.tree.MerkleTree.recover(tmp_path, fsync=fsync)
+    expected = mercle.tree.MerkleTree.new()
+    apply(tree)
+    apply(expected)
+    tree.close()
+
+    recovered = mercle.tree.MerkleTree.recover(tmp_path, fsync=fsync)
+
+    assert recovered == expected
+    assert recovered.root == expected.root
+    recovered.close()
+
+
+def test_recover_replays_swap_removal(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    expected = mercle.tree.MerkleTree.new()
+    apply(tree)
+    apply(expected)
+    tree.removal = expected.removal = "swap"
+    tree.remove(2)
+    expected.remove(2)
+    tree.removal = "shift"
+    tree.remove(0)
+    expected.removal = "shift"
+    expected.remove(0)
+    tree.close()
+
+    recovered = mercle.tree.MerkleTree.recover(tmp_path, removal="swap")
+
+    assert recovered == expected
+    assert recovered.removal == "swap"
+    recovered.close()
+
+
+def test_recover_after_compaction(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    expected = mercle.tree.MerkleTree.new()
+    apply(tree)
+    apply(expected)
+    tree.compact().join()
+    tree.remove(0)
+    expected.remove(0)
+    tree.close()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["checkpoint.1", "journal.1"]
+    recovered = mercle.tree.MerkleTree.recover(tmp_path)
+
+    assert recovered.root == expected.root
+    recovered.close()
+
+
+def test_recover_drops_torn_record(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    tree.add(digest("a"), hashed=True)
+    tree.add(digest("b"), hashed=True)
+    tree.close()
+    with open(tmp_path / "journal.0", "r+b") as f:
+        f.truncate(mercle.journal.RECORD.size + 10)
+
+    recovered = mercle.tree.MerkleTree.recover(tmp_path)
+    recovered.add(digest("c"), hashed=True)
+    recovered.close()
+
+    recovered = mercle.tree.MerkleTree.recover(tmp_path)
+    assert recovered.root == mercle.tree.MerkleTree.new([digest("a"), digest("c")]).root
+    recovered.close()
+
+
+def test_recover_unreadable_checkpoint(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    apply(tree)
+    tree.compact(wait=True)
+    tree.add(digest("a"), hashed=True)
+    tree.close()
+    (tmp_path / "checkpoint.1").write_bytes(b"corrupt")
+
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.recover(tmp_path)
+
+
+def test_recover_checkpoint_hash_mismatch(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path, hash="blake2s")
+    apply(tree)
+    tree.compact(wait=True)
+    tree.close()
+
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.recover(tmp_path, hash="sha256")
+    recovered = mercle.tree.MerkleTree.recover(tmp_path)
+    assert recovered.hash == "blake2s"
+    recovered.close()
+
+
+def test_compact_without_journal():
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.new([digest(0)]).compact()
+
+
+class FullFile:
+    # A journal file on a full disk.
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def test_failed_append_leaves_tree_unchanged(tmp_path):
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    apply(tree)
+    expected = mercle.tree.MerkleTree.new()
+    apply(expected)
+
+    file, tree._journal._file = tree._journal._file, FullFile(tree._journal._file)
+    for write in (lambda: tree.add(digest("a")), lambda: tree.add_many([b"b"], hashed=False), lambda: tree.remove(0)):
+        with pytest.raises(OSError):
+            write()
+    tree._journal._file = file
+    assert tree == expected
+
+    tree.update(digest("c"), tree.leaf_count - 1)
+    expected.update(digest("c"), expected.leaf_count - 1)
+    tree.close()
+
+    recovered = mercle.tree.MerkleTree.recover(tmp_path)
+    assert recovered == expected
+    recovered.close()
+
+
+def test_failed_write_drops_its_records(tmp_path, monkeypatch):
+    def fail(status):
+        raise MemoryError("not enough memory to write to the tree")
+
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    apply(tree)
+    size = (tmp_path / "journal.0").stat().st_size
+    with monkeypatch.context() as patch:
+        patch.setattr(mercle.tree, "_check_growth", fail)
+        with pytest.raises(MemoryError):
+            tree.add_many([digest("a"), digest("b")])
+    tree.close()
+
+    assert (tmp_path / "journal.0").stat().st_size == size
+
+
+def test_journal_that_cannot_be_cut_back_refuses_writes(tmp_path, monkeypatch):
+    def fail(fd):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    tree = mercle.tree.MerkleTree.recover(tmp_path)
+    apply(tree)
+    with monkeypatch.context() as patch:
+        patch.setattr(mercle.journal.os, "fsync", fail)
+        with pytest.raises(OSError):
+            tree.add(digest("a"))
+
+    with pytest.raises(OSError):
+        tree.add(digest("b"))
+    assert tree.leaf_count == 11
+    tree.close()
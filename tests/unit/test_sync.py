@@ -0,0 +1,102 @@
+from hashlib import sha256
+
+import pytest
+
+import mercle.sync
+import mercle.tree
+
+
+def digest(value):
+    return sha256(str(value).encode()).digest()
+
+
+def counting(transport):
+    requests = []
+
+    def wrapper(request):
+        requests.append(request)
+        return transport(request)
+
+    return wrapper, requests
+
+
+def test_get_nodes():
+    leaves = [digest(value) for value in range(5)]
+    tree = mercle.tree.MerkleTree.new(leaves)
+
+    assert tree.depth == 3
+    assert tree.get_node(0, 4) == leaves[4]
+    assert tree.get_node(0, 7) == bytes(32)
+    assert tree.get_node(1, 0) == sha256(leaves[0] + leaves[1]).digest()
+    assert tree.get_node(3, 0) == tree.root
+    assert tree.get_nodes([(0, 1), (0, 2)]) == leaves[1:3]
+    assert tree.get_nodes([]) == []
+
+
+@pytest.mark.parametrize("level, index", [(0, 8), (3, 1), (4, 0), (-1, 0), (0, -1)])
+def test_get_node_out_of_range(level, index):
+    tree = mercle.tree.MerkleTree.new([digest(value) for value in range(5)])
+
+    with pytest.raises(IndexError):
+        tree.get_node(level, index)
+
+
+def test_get_leaves():
+    leaves = [digest(value) for value in range(5)]
+    tree = mercle.tree.MerkleTree.new(leaves)
+
+    assert tree.get_leaves() == leaves
+    assert tree.get_leaves(1, 3) == leaves[1:3]
+    assert tree.get_leaves(-2) == leaves[-2:]
+    assert tree.get_leaves(4, 2) == []
+    assert mercle.tree.MerkleTree.new().get_leaves() == []
+
+
+@pytest.mark.parametrize("count, other_count", [(0, 0), (0, 9), (9, 0), (9, 9), (3, 17), (17, 3)])
+def test_sync(count, other_count):
+    local = mercle.tree.MerkleTree.new([digest(value) for value in range(count)])
+    remote = mercle.tree.MerkleTree.new([digest(value) for value in range(other_count)])
+    remote.update_many({0: digest("a")} if other_count else {})
+
+    changed = mercle.sync.sync(local, mercle.sync.serve(remote))
+
+    assert local == remote
+    assert changed == sorted({0} & set(range(other_count)) | set(range(count, other_count)))
+
+
+def test_sync_fetches_only_differing_leaves():
+    leaves = [digest(value) for value in range(1000)]
+    local = mercle.tree.MerkleTree.new(leaves)
+    remote = mercle.tree.MerkleTree.new(leaves)
+    remote.update_many({3: digest("a"), 700: digest("b")})
+
+    transport, requests = counting(mercle.sync.serve(remote))
+    assert mercle.sync.sync(local, transport) == [3, 700]
+
+    assert local == remote
+    assert requests[-1] == (mercle.sync.LEAVES, [3, 700])
+    # One request for the shape, one per level and one for the leaves.
+    assert len(requests) == local.depth + 3
+    assert all(len(request[1]) <= 4 for request in requests[1:])
+
+
+def test_sync_identical_trees():
+    leaves = [digest(value) for value in range(10)]
+    local = mercle.tree.MerkleTree.new(leaves)
+
+    transport, requests = counting(mercle.sync.serve(mercle.tree.MerkleTree.new(leaves)))
+
+    assert mercle.sync.sync(local, transport) == []
+    assert requests == [(mercle.sync.SHAPE,), (mercle.sync.NODES, [(local.depth, 0)])]
+
+
+def test_sync_trees_with_other_hashes():
+    remote = mercle.tree.MerkleTree.new([digest(0)], hash="sha256d")
+
+    with pytest.raises(ValueError):
+        mercle.sync.sync(mercle.tree.MerkleTree.new(), mercle.sync.serve(remote))
+
+
+def test_serve_unknown_request():
+    with pytest.raises(ValueError):
+        mercle.sync.serve(mercle.tree.MerkleTree.new())(("unknown",))
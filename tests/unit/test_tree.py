@@ -1,7 +1,17 @@
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2s
 from hashlib import sha256
 
 import pytest
 
+import mercle
 import mercle.tree
 
 
@@ -98,6 +108,126 @@ def test_elements(data, root_hash, expected_depth):
     # assert len(m.levels) == expected_depth
 
 
+@pytest.mark.parametrize("count", (1, 2, 3, 4, 5, 7, 8, 9, 16, 17, 31, 33))
+def test_new_matches_incremental_adds(count):
+    data = [digest(value) for value in range(count)]
+    m = mercle.tree.MerkleTree.new(leaves=data, hashed=True)
+    m2 = mercle.tree.MerkleTree.new()
+    for leaf in data:
+        m2.add(leaf, hashed=True)
+
+    assert m.root == m2.root
+    assert m == m2
+
+
+def test_add_many_matches_add():
+    m1 = mercle.tree.MerkleTree.new([digest("a")], hashed=True)
+    m2 = mercle.tree.MerkleTree.new([digest("a")], hashed=True)
+
+    values = [digest(value) for value in range(20)]
+    m1.add_many(values, hashed=True)
+    for value in values:
+        m2.add(value, hashed=True)
+
+    assert m1.root == m2.root
+
+
+def test_add_many_unhashed():
+    m1 = mercle.tree.MerkleTree.new()
+    m2 = mercle.tree.MerkleTree.new()
+
+    m1.add_many(iter([b"a", b"b", b"c"]), hashed=False)
+    for value in [b"a", b"b", b"c"]:
+        m2.add(value, hashed=False)
+
+    assert m1.root == m2.root
+
+
+def test_add_many_empty():
+    m = mercle.tree.MerkleTree.new()
+
+    m.add_many([])
+
+    assert m == mercle.tree.MerkleTree.new()
+
+
+def test_add_many_invalid_hashed_leaf():
+    m = mercle.tree.MerkleTree.new()
+
+    with pytest.raises(ValueError):
+        m.add_many([b"short"], hashed=True)
+
+
+def test_update_many_matches_update():
+    data = [digest(value) for value in range(11)]
+    m1 = mercle.tree.MerkleTree.new(data, hashed=True)
+    m2 = mercle.tree.MerkleTree.new(data, hashed=True)
+
+    updates = {0: digest("x"), 7: digest("y"), 8: digest("z"), 10: digest("w")}
+    m1.update_many(updates, hashed=True)
+    for index, value in updates.items():
+        m2.update(value, index, hashed=True)
+
+    assert m1.root == m2.root
+
+
+def test_update_many_out_of_range_leaves_tree_untouched():
+    data = [digest(value) for value in range(5)]
+    m = mercle.tree.MerkleTree.new(data, hashed=True)
+    root = m.root
+
+    with pytest.raises(IndexError):
+        m.update_many({0: digest("x"), 20: digest("y")}, hashed=True)
+
+    assert m.root == root
+
+
+def test_lazy_tree_matches_eager_tree():
+    data = [digest(value) for value in range(9)]
+    m1 = mercle.tree.MerkleTree.new(data, hashed=True, lazy=True)
+    m2 = mercle.tree.MerkleTree.new(data, hashed=True)
+
+    for m in (m1, m2):
+        m.add(digest("x"), hashed=True)
+        m.update(digest("y"), 3, hashed=True)
+        m.update_many({0: digest("z"), 9: digest("w")}, hashed=True)
+        m.add_many([digest(value) for value in range(10, 20)], hashed=True)
+        m.remove(4)
+        m.remove(0)
+
+    assert m1.root == m2.root
+    assert m1 == m2
+
+
+@pytest.mark.parametrize("removals", ([0], [3], [8], [8, 7, 6, 5], [0, 0, 0, 0, 0, 0, 0, 0]))
+def test_deferred_removals_match_eager_removals(removals):
+    data = [digest(value) for value in range(9)]
+    m1 = mercle.tree.MerkleTree.new(data, hashed=True)
+    m2 = mercle.tree.MerkleTree.new(data, hashed=True)
+
+    with m1.deferred():
+        for index in removals:
+            m1.remove(index)
+            m1.update(digest("x"), 0, hashed=True)
+    for index in removals:
+        m2.remove(index)
+        m2.update(digest("x"), 0, hashed=True)
+
+    assert m1.root == m2.root
+
+
+def test_deferred_restores_eager_mode():
+    m = mercle.tree.MerkleTree.new()
+
+    with m.deferred():
+        m.add(digest("a"), hashed=True)
+
+    m.add(digest("b"), hashed=True)
+
+    assert m._tree.deferred is False
+    assert m.root == sha256(digest("a") + digest("b")).digest()
+
+
 def test_equality():
     leaves = [digest(value) for value in ["a", "b", "c"]]
     m = mercle.tree.MerkleTree.new(leaves=leaves)
@@ -182,6 +312,31 @@ def test_update_empty():
         m.update(digest("twenty"), 20)
 
 
+def test_hashed_leaves_must_be_32_bytes():
+    m = mercle.tree.MerkleTree.new([digest("one")])
+
+    with pytest.raises(ValueError):
+        m.add(b"c")
+    with pytest.raises(ValueError):
+        m.update(b"c", 0)
+    with pytest.raises(ValueError):
+        m.update(digest("one") + b"c", 0)
+
+    assert m == mercle.tree.MerkleTree.new([digest("one")])
+
+
+def test_writes_default_to_hashed_leaves():
+    m1 = mercle.tree.MerkleTree.new([digest("one")])
+    m2 = mercle.tree.MerkleTree.new()
+    m2.add(digest("one"))
+    assert m1 == m2
+
+    m1.update(digest("two"), 0)
+    m2.add_many([digest("two")])
+    m2.remove(0)
+    assert m1 == m2
+
+
 def test_remove_out_of_range():
     m = mercle.tree.MerkleTree.new(
         [digest(value) for value in ["one", "two", "three", "five", "six"]],
@@ -224,6 +379,48 @@ def test_removal_of_leaf_matches_tree_not_containing_leaf():
     assert m1.root == m3.root
 
 
+@pytest.mark.parametrize("lazy", [False, True])
+@pytest.mark.parametrize("count", [1, 2, 3, 5, 8, 9, 17, 100])
+def test_swap_removal_matches_new(lazy, count):
+    rng = random.Random(count)
+    leaves = [digest(value) for value in range(count)]
+    m = mercle.tree.MerkleTree.new(leaves, lazy=lazy, removal="swap")
+    snapshot = m.snapshot()
+
+    while leaves:
+        index = rng.randrange(len(leaves))
+        m.remove(index)
+        leaves[index] = leaves[-1]
+        leaves.pop()
+
+        assert m.root == mercle.tree.MerkleTree.new(leaves).root
+        assert m.get_leaves() == leaves
+        if leaves:
+            m.add(digest(len(leaves)), hashed=True)
+            leaves.append(digest(len(leaves)))
+            m.remove(len(leaves) - 1)
+            leaves.pop()
+
+    assert snapshot.root == mercle.tree.MerkleTree.new([digest(value) for value in range(count)]).root
+
+
+def test_swap_removal_out_of_range():
+    m = mercle.tree.MerkleTree.new([digest(0)], removal="swap")
+
+    with pytest.raises(IndexError):
+        m.remove(1)
+
+
+def test_unknown_removal():
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.new(removal="tombstone")
+
+    m = mercle.tree.MerkleTree.new()
+    with pytest.raises(ValueError):
+        m.removal = "tombstone"
+    assert m.removal == "shift"
+
+
 def test_update_after_remove():
     m1 = mercle.tree.MerkleTree.new(
         [digest(value) for value in ["one", "two", "three", "six"]],
@@ -378,6 +575,117 @@ def test_marshal_tree():
     assert mercle.tree.MerkleTree.unmarshal(payload) == mt
 
 
+@pytest.mark.parametrize("count", (1, 2, 3, 4, 5, 8, 9))
+def test_marshal_round_trip(count):
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(count)])
+
+    payload = mt.marshal()
+    loaded = mercle.tree.MerkleTree.unmarshal(memoryview(payload), verify=True)
+
+    assert loaded == mt
+    assert loaded.root == mt.root
+    assert loaded.marshal() == payload
+
+    loaded.add(digest("z"), hashed=True)
+    mt.add(digest("z"), hashed=True)
+    assert loaded.root == mt.root
+
+
+def test_marshal_flushes_deferred_tree():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(5)], lazy=True)
+    mt.update(digest("z"), 1)
+
+    loaded = mercle.tree.MerkleTree.unmarshal(mt.marshal(), verify=True)
+
+    assert loaded.root == mt.root
+
+
+@pytest.mark.parametrize("payload", (
+    b"",
+    b"XXXX" + bytes(52),
+    bytes(mercle.tree.MerkleTree.new([digest("a")]).marshal())[:-1],
+))
+def test_unmarshal_invalid(payload):
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.unmarshal(payload)
+
+
+def test_unmarshal_verify_detects_tampering():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(5)])
+    payload = mt.marshal()
+    payload[len(payload) - 32 * 14] ^= 1
+
+    assert mercle.tree.MerkleTree.unmarshal(bytes(payload)) != mt
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.unmarshal(payload, verify=True)
+
+
+def test_open_creates_empty_tree(tmp_path):
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+
+    assert mt == mercle.tree.MerkleTree.new()
+    assert mt.root == bytes(32)
+
+    mt.close()
+
+
+def test_open_reuses_file(tmp_path):
+    data = [digest(value) for value in range(9)]
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+    mt.add_many(data, hashed=True)
+    mt.close()
+
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+
+    assert mt == mercle.tree.MerkleTree.new(data)
+    assert mt.get_proof(4) == mercle.tree.MerkleTree.new(data).get_proof(4)
+    mt.close()
+
+
+def test_open_file_matches_marshal(tmp_path):
+    data = [digest(value) for value in range(5)]
+    (tmp_path / "tree").write_bytes(mercle.tree.MerkleTree.new(data).marshal())
+
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+    mt.update(digest("z"), 2)
+    mt.sync()
+
+    expected = mercle.tree.MerkleTree.new(data)
+    expected.update(digest("z"), 2)
+    assert (tmp_path / "tree").read_bytes() == expected.marshal()
+    mt.close()
+
+
+def test_open_tree_grows_and_shrinks(tmp_path):
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+    expected = mercle.tree.MerkleTree.new()
+
+    for value in range(20):
+        mt.add(digest(value), hashed=True)
+        expected.add(digest(value), hashed=True)
+        assert mt.root == expected.root
+
+    for index in (19, 0, 5, 5, 10, 0, 3, 2, 1, 0, 0, 0, 0, 0, 0, 0, 2, 1, 0, 0):
+        mt.remove(index)
+        expected.remove(index)
+        assert mt.root == expected.root
+
+    mt.close()
+    assert (tmp_path / "tree").read_bytes() == expected.marshal()
+
+
+def test_open_invalid_file(tmp_path):
+    (tmp_path / "tree").write_bytes(b"not a tree")
+
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.open(tmp_path / "tree")
+
+
+def test_open_missing_directory(tmp_path):
+    with pytest.raises(OSError):
+        mercle.tree.MerkleTree.open(tmp_path / "missing" / "tree")
+
+
 def test_get_proof():
     mt = mercle.tree.MerkleTree.new(
         [digest(value) for value in ["a", "b", "c", "d", "e", "f", "g", "h"]],
@@ -418,6 +726,757 @@ def test_get_proof_after_update():
     ]
 
 
+def test_get_proof_single_leaf():
+    mt = mercle.tree.MerkleTree.new([digest("a")])
+
+    assert mt.get_proof(0) == [["R", bytes(32)], ["ROOT", mt.root]]
+
+
+def test_get_proof_in_deferred_mode():
+    mt = mercle.tree.MerkleTree.new(
+        [digest(value) for value in ["a", "b", "c", "d"]],
+        lazy=True,
+    )
+
+    mt.update(digest("z"), 0)
+
+    left = sha256(digest("z") + digest("b")).digest()
+    right = sha256(digest("c") + digest("d")).digest()
+    assert mt.get_proof(1) == [
+        ["L", digest("z")],
+        ["R", right],
+        ["ROOT", sha256(left + right).digest()],
+    ]
+
+
+@pytest.mark.parametrize("index", (-1, 3))
+def test_get_proof_out_of_range(index):
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in ["a", "b", "c"]])
+
+    with pytest.raises(IndexError):
+        mt.get_proof(index)
+
+
+def test_get_proofs_matches_get_proof():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(11)])
+
+    proofs = mt.get_proofs([10, 0, 5, 5])
+
+    assert len(proofs) == 4
+    assert list(proofs) == [mt.get_proof(index) for index in [10, 0, 5, 5]]
+    assert proofs[-1] == mt.get_proof(5)
+    assert proofs[1:3] == [mt.get_proof(0), mt.get_proof(5)]
+    assert proofs.root == mt.root
+    assert proofs.side_mask(0) == 0b1010
+
+
+def test_get_proofs_empty():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(3)])
+
+    assert list(mt.get_proofs([])) == []
+
+
+def test_get_proofs_out_of_range():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(3)])
+
+    with pytest.raises(IndexError):
+        mt.get_proofs([0, 3])
+
+
+@pytest.mark.parametrize("indexes", ([0], [2], [0, 1], [2, 3, 4], [0, 7], [1, 2, 5, 6, 7], list(range(9))))
+def test_multiproof_validates(indexes):
+    data = [digest(value) for value in range(9)]
+    mt = mercle.tree.MerkleTree.new(data)
+
+    proof = mt.get_multiproof(reversed(indexes))
+
+    assert proof.indexes == sorted(indexes)
+    assert len(proof) <= len(indexes) * proof.depth
+    assert proof.verify([data[i] for i in proof.indexes]) is True
+
+
+def test_multiproof_deduplicates_shared_siblings():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(8)])
+
+    proof = mt.get_multiproof([0, 1, 2, 3])
+
+    assert proof.nodes == sha256(
+        sha256(digest(4) + digest(5)).digest() + sha256(digest(6) + digest(7)).digest(),
+    ).digest()
+
+
+def test_multiproof_invalid():
+    data = [digest(value) for value in range(9)]
+    mt = mercle.tree.MerkleTree.new(data)
+
+    proof = mt.get_multiproof([1, 4])
+
+    assert proof.verify([data[1], digest("z")]) is False
+    assert proof.verify([data[1]]) is False
+    proof.nodes = proof.nodes[:-32]
+    assert proof.verify([data[1], data[4]]) is False
+
+
+def test_multiproof_out_of_range():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(3)])
+
+    with pytest.raises(IndexError):
+        mt.get_multiproof([0, 3])
+
+
+def test_diff_identical_trees():
+    leaves = [digest(value) for value in range(10)]
+
+    assert mercle.tree.MerkleTree.new(leaves).diff(mercle.tree.MerkleTree.new(leaves)) == []
+    assert mercle.tree.MerkleTree.new().diff(mercle.tree.MerkleTree.new()) == []
+
+
+def test_diff_updated_leaves():
+    leaves = [digest(value) for value in range(100)]
+    m1 = mercle.tree.MerkleTree.new(leaves)
+    m2 = mercle.tree.MerkleTree.new(leaves)
+    for index in (3, 64, 99, 17):
+        m2.update(digest("a"), index)
+
+    assert m1.diff(m2) == [3, 17, 64, 99]
+    assert m2.diff(m1) == [3, 17, 64, 99]
+
+
+@pytest.mark.parametrize("count, other_count", [(0, 5), (3, 5), (5, 17), (2, 1), (1, 1)])
+def test_diff_different_lengths(count, other_count):
+    m1 = mercle.tree.MerkleTree.new([digest(value) for value in range(count)])
+    m2 = mercle.tree.MerkleTree.new([digest(value) for value in range(other_count)])
+
+    expected = list(range(min(count, other_count), max(count, other_count)))
+    assert m1.diff(m2) == expected
+    assert m2.diff(m1) == expected
+
+
+def test_diff_zero_leaf_against_missing_leaf():
+    m1 = mercle.tree.MerkleTree.new([digest(0), bytes(32)])
+    m2 = mercle.tree.MerkleTree.new([digest(0)])
+
+    assert m1.diff(m2) == [1]
+
+
+def test_diff_many_leaves():
+    leaves = [digest(value) for value in range(300)]
+    m1 = mercle.tree.MerkleTree.new(leaves)
+    m2 = mercle.tree.MerkleTree.new([digest("a")] * 300, lazy=True)
+
+    assert m1.diff(m2) == list(range(300))
+
+
+def apply_changes(mt, leaves, seed):
+    rng = random.Random(seed)
+    for _ in range(40):
+        op = rng.choice(["add", "update", "remove"])
+        if op == "add" or not leaves:
+            leaves.append(digest(rng.randrange(1 << 32)))
+            mt.add(leaves[-1], hashed=True)
+        elif op == "update":
+            index = rng.randrange(len(leaves))
+            leaves[index] = digest(rng.randrange(1 << 32))
+            mt.update(leaves[index], index)
+        else:
+            index = rng.randrange(len(leaves))
+            del leaves[index]
+            mt.remove(index)
+
+
+def assert_snapshot_matches(snapshot, leaves):
+    expected = mercle.tree.MerkleTree.new(leaves)
+
+    assert len(snapshot) == len(leaves)
+    assert snapshot.root == expected.root
+    assert list(snapshot.get_proofs(range(len(leaves)))) == list(expected.get_proofs(range(len(leaves))))
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_snapshot_unaffected_by_later_changes(lazy):
+    leaves = [digest(value) for value in range(13)]
+    mt = mercle.tree.MerkleTree.new(leaves, lazy=lazy)
+
+    snapshot = mt.snapshot()
+    apply_changes(mt, list(leaves), 0)
+
+    assert_snapshot_matches(snapshot, leaves)
+
+
+def test_snapshots_survive_dropping_newer_and_older():
+    leaves = [digest(value) for value in range(5)]
+    mt = mercle.tree.MerkleTree.new(leaves)
+
+    versions = []
+    snapshots = []
+    for seed in range(4):
+        versions.append(list(leaves))
+        snapshots.append(mt.snapshot())
+        apply_changes(mt, leaves, seed)
+
+    del snapshots[2]
+    del snapshots[0]
+    del versions[2]
+    del versions[0]
+
+    for snapshot, version in zip(snapshots, versions):
+        assert_snapshot_matches(snapshot, version)
+
+
+def test_snapshot_of_shrunk_tree():
+    leaves = [digest(value) for value in range(9)]
+    mt = mercle.tree.MerkleTree.new(leaves)
+
+    snapshot = mt.snapshot()
+    for _ in range(9):
+        mt.remove(0)
+    mt.add(digest("a"), hashed=True)
+
+    assert_snapshot_matches(snapshot, leaves)
+
+
+def test_snapshot_of_closed_file(tmp_path):
+    leaves = [digest(value) for value in range(6)]
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+    mt.add_many(leaves, hashed=True)
+
+    snapshot = mt.snapshot()
+    mt.update(digest("a"), 0)
+    mt.close()
+
+    assert_snapshot_matches(snapshot, leaves)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_snapshot_of_closed_tree(lazy):
+    leaves = [digest(value) for value in range(6)]
+    mt = mercle.tree.MerkleTree.new(leaves, lazy=lazy)
+
+    snapshot = mt.snapshot()
+    mt.update(digest("a"), 0)
+    mt.close()
+
+    assert_snapshot_matches(snapshot, leaves)
+
+
+def test_closed_tree_refuses_operations():
+    leaves = [digest(value) for value in range(6)]
+    with mercle.tree.MerkleTree.new(leaves, indexed=True) as mt:
+        assert mt.leaf_count == 6
+        assert not mt.closed
+
+    assert mt.closed
+    for call in (
+        lambda: mt.add(digest("a")),
+        lambda: mt.add_many(leaves),
+        lambda: mt.update(digest("a"), 0),
+        lambda: mt.remove(0),
+        lambda: mt.root,
+        lambda: mt.leaf_count,
+        lambda: mt.get_proof(0),
+        lambda: mt.get_leaves(),
+        lambda: mt.index_of(leaves[0]),
+        lambda: mt.marshal(),
+        lambda: mt.snapshot(),
+        lambda: mt.memory_usage(),
+        lambda: mt == mercle.tree.MerkleTree.new(),
+    ):
+        with pytest.raises(ValueError):
+            call()
+    mt.close()
+
+
+def test_closed_file_keeps_its_leaves(tmp_path):
+    leaves = [digest(value) for value in range(5)]
+    with mercle.tree.MerkleTree.open(tmp_path / "tree") as mt:
+        mt.add_many(leaves)
+
+    with pytest.raises(ValueError):
+        mt.add(digest("a"))
+    with pytest.raises(ValueError):
+        mt.sync()
+    with mercle.tree.MerkleTree.open(tmp_path / "tree") as mt:
+        assert mt == mercle.tree.MerkleTree.new(leaves)
+
+
+def test_memory_usage():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(1000)], lazy=True)
+    usage = mt.memory_usage()
+
+    assert usage["nodes"] >= 2047 * 32
+    assert usage["dirty"] == usage["snapshots"] == usage["mapped"] == 0
+
+    mt.update(digest("a"), 0)
+    snapshot = mt.snapshot()
+    mt.update(digest("b"), 0)
+    mt.root
+    assert mt.memory_usage()["dirty"] > 0
+    assert mt.memory_usage()["snapshots"] > 0
+
+    del snapshot
+    mt.shrink()
+    assert mt.memory_usage() == usage
+
+    mt.close()
+    released = mercle.tree.ffi.new("uint64_t[]", 5)
+    mercle.tree.lib.memory_usage(mt._tree, released)
+    # Only the closed tree's own struct is left.
+    assert released[0] < 256
+    assert list(released)[1:] == [0] * 4
+
+
+def test_memory_usage_of_file(tmp_path):
+    with mercle.tree.MerkleTree.open(tmp_path / "tree") as mt:
+        mt.add_many([digest(value) for value in range(100)], hashed=True)
+        assert mt.memory_usage()["mapped"] == (tmp_path / "tree").stat().st_size
+
+
+def test_shrink_keeps_tree():
+    leaves = [digest(value) for value in range(5)]
+    mt = mercle.tree.MerkleTree.new(leaves + [digest("a")] * 100)
+    with mt.deferred():
+        for _ in range(100):
+            mt.remove(5)
+
+    mt.shrink()
+    assert mt == mercle.tree.MerkleTree.new(leaves)
+    assert mt.memory_usage() == mercle.tree.MerkleTree.new(leaves).memory_usage()
+
+
+@pytest.mark.parametrize("index", (2 ** 31, 2 ** 40, 2 ** 63 - 1))
+def test_indexes_beyond_32_bits_are_out_of_range(index):
+    leaves = [digest(value) for value in range(3)]
+    mt = mercle.tree.MerkleTree.new(leaves)
+
+    for call in (
+        lambda: mt.update(digest("a"), index),
+        lambda: mt.update_many({index: digest("a")}),
+        lambda: mt.remove(index),
+        lambda: mt.get_proof(index),
+        lambda: mt.get_proofs([0, index]),
+        lambda: mt.get_multiproof([0, index]),
+        lambda: mt.get_node(0, index),
+    ):
+        with pytest.raises(IndexError):
+            call()
+
+    assert mt == mercle.tree.MerkleTree.new(leaves)
+
+
+# Run in a fresh interpreter, where a heap freed by earlier tests can't hand the tree the memory it grows into.
+GROWTH_OUT_OF_MEMORY = """
+import resource
+import mercle.tree
+
+mt = mercle.tree.MerkleTree.new([bytes(32)] * (1 << 20))
+root = mt.root
+with open("/proc/self/statm") as f:
+    size = int(f.read().split()[0]) * resource.getpagesize()
+# Room for the interpreter, not for the branches doubling.
+resource.setrlimit(resource.RLIMIT_AS, (size + (16 << 20), resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+for grow in (lambda: mt.add(bytes(32), hashed=True), lambda: mt.add_many([bytes(32)], hashed=True)):
+    try:
+        grow()
+    except MemoryError:
+        pass
+    else:
+        raise SystemExit("tree grew")
+
+assert mt.leaf_count == 1 << 20
+assert mt.root == root
+"""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="needs /proc to size the address space limit")
+def test_growth_out_of_memory_leaves_tree_unchanged():
+    result = subprocess.run([sys.executable, "-c", GROWTH_OUT_OF_MEMORY], stderr=subprocess.PIPE)
+
+    assert result.returncode == 0, result.stderr.decode()
+
+
+SNAPSHOT_OUT_OF_MEMORY = """
+import resource
+import mercle.tree
+
+mt = mercle.tree.MerkleTree.new([bytes(32)] * (1 << 20))
+root = mt.root
+snapshot = mt.snapshot()
+leaves = {index: bytes([1] * 32) for index in range(0, 1 << 20, 2)}
+with open("/proc/self/statm") as f:
+    size = int(f.read().split()[0]) * resource.getpagesize()
+# Room for the interpreter, not for the snapshot to save every node the writes overwrite.
+resource.setrlimit(resource.RLIMIT_AS, (size + (16 << 20), resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+for write in (
+    lambda: mt.update_many(leaves),
+    lambda: mt.remove(0),
+):
+    try:
+        write()
+    except MemoryError:
+        pass
+    else:
+        raise SystemExit("tree written")
+
+assert mt.leaf_count == 1 << 20
+assert mt.root == root
+assert snapshot.root == root
+"""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="needs /proc to size the address space limit")
+def test_snapshot_out_of_memory_leaves_tree_unchanged():
+    result = subprocess.run([sys.executable, "-c", SNAPSHOT_OUT_OF_MEMORY], stderr=subprocess.PIPE)
+
+    assert result.returncode == 0, result.stderr.decode()
+
+
+VERIFY_OUT_OF_MEMORY = """
+import resource
+from _merkle import ffi
+import mercle.tree
+
+leaves = [bytes(32)] * (1 << 20)
+# Kept alive, freeing it would leave the verifier room in the heap.
+mt = mercle.tree.MerkleTree.new(leaves)
+multiproof = mt.get_multiproof(range(1 << 20))
+multiproof.indexes = ffi.new("int64_t[]", multiproof.indexes)
+leaves = [b"".join(leaves)]
+with open("/proc/self/statm") as f:
+    size = int(f.read().split()[0]) * resource.getpagesize()
+# Too little room for the verifier's copy of the leaves.
+resource.setrlimit(resource.RLIMIT_AS, (size + (16 << 20), resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+assert not multiproof.verify(leaves)
+"""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="needs /proc to size the address space limit")
+def test_multiproof_verify_out_of_memory_fails():
+    result = subprocess.run([sys.executable, "-c", VERIFY_OUT_OF_MEMORY], stderr=subprocess.PIPE)
+
+    assert result.returncode == 0, result.stderr.decode()
+
+
+@pytest.mark.parametrize("indexed", (False, True))
+def test_index_of_follows_writes(indexed):
+    leaves = [digest(value % 7) for value in range(40)]
+    mt = mercle.tree.MerkleTree.new(leaves, indexed=indexed)
+
+    mt.add(digest("a"), hashed=True)
+    mt.add_many([digest("b"), digest(3)], hashed=True)
+    mt.update(digest("c"), 0)
+    mt.update_many({1: digest("d"), 8: digest("e")})
+    mt.remove(2)
+    mt.removal = "swap"
+    mt.remove(3)
+    leaves = mt.get_leaves()
+
+    assert mt.indexed is indexed
+    for leaf in set(leaves):
+        assert mt.index_of(leaf) == leaves.index(leaf)
+    with pytest.raises(ValueError):
+        mt.index_of(digest("missing"))
+
+
+def test_index_of_invalid_leaf():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(3)], indexed=True)
+
+    with pytest.raises(ValueError):
+        mt.index_of(b"short")
+
+
+def test_prove_leaf():
+    leaves = [digest(value) for value in range(11)]
+    mt = mercle.tree.MerkleTree.new(leaves, indexed=True)
+
+    assert mt.prove_leaf(digest(6)) == mt.get_proof(6)
+    assert mercle.util.verify_proof(mt.prove_leaf(digest(6)), digest(6))
+    with pytest.raises(ValueError):
+        mt.prove_leaf(digest("missing"))
+
+
+def test_indexed_is_switchable():
+    leaves = [digest(value) for value in range(100)]
+    mt = mercle.tree.MerkleTree.new(leaves)
+    assert mt.memory_usage()["index"] == 0
+
+    mt.indexed = True
+    assert mt.index_of(digest(99)) == 99
+    assert mt.memory_usage()["index"] >= 2 * len(leaves) * 8
+
+    for _ in range(90):
+        mt.remove(0)
+    mt.shrink()
+    assert mt.memory_usage()["index"] < 2 * len(leaves) * 8
+    assert mt.index_of(digest(99)) == 9
+
+    mt.indexed = False
+    assert mt.memory_usage()["index"] == 0
+    assert mt.index_of(digest(99)) == 9
+
+
+def test_index_of_file(tmp_path):
+    leaves = [digest(value) for value in range(20)]
+    with mercle.tree.MerkleTree.open(tmp_path / "tree") as mt:
+        mt.add_many(leaves, hashed=True)
+
+    with mercle.tree.MerkleTree.open(tmp_path / "tree") as mt:
+        mt.indexed = True
+        mt.add(digest("a"), hashed=True)
+        assert [mt.index_of(leaf) for leaf in leaves + [digest("a")]] == list(range(21))
+
+
+def test_snapshot_proof_out_of_range():
+    mt = mercle.tree.MerkleTree.new([digest(value) for value in range(3)])
+    snapshot = mt.snapshot()
+    mt.add(digest(3), hashed=True)
+
+    with pytest.raises(IndexError):
+        snapshot.get_proof(3)
+
+
+@pytest.mark.parametrize("workers", [2, 3, 8])
+def test_parallel_hashing_matches_serial(workers):
+    leaves = [digest(value) for value in range(20000)]
+    serial = mercle.tree.MerkleTree.new(leaves)
+    parallel = mercle.tree.MerkleTree.new(leaves, workers=workers)
+
+    assert parallel.workers == workers
+    assert parallel.root == serial.root
+
+    updates = {index: digest("a") for index in range(3, 19000, 2)}
+    serial.update_many(updates)
+    parallel.update_many(updates)
+    assert parallel.root == serial.root
+
+    serial.remove(1)
+    parallel.remove(1)
+    assert parallel.root == serial.root
+
+    parallel.add_many(leaves, hashed=True)
+    assert parallel.root == mercle.tree.MerkleTree.new(serial.get_leaves() + leaves).root
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_new_with_unhashed_leaves(workers):
+    values = [str(value).encode() * (value % 7) for value in range(5000)]
+    expected = mercle.tree.MerkleTree.new([sha256(value).digest() for value in values])
+
+    assert mercle.tree.MerkleTree.new(values, hashed=False, workers=workers).root == expected.root
+
+
+def test_add_packed():
+    values = [b"a", b"", b"bcd", b"ef"]
+    mt = mercle.tree.MerkleTree.new([digest(0)])
+
+    mt.add_packed(b"".join(values), array("Q", [0, 1, 1, 4, 6]))
+
+    assert mt.get_leaves(1) == [sha256(value).digest() for value in values]
+    mt.add_packed(b"", array("Q"))
+    mt.add_packed(b"", array("Q", [0]))
+    assert mt.leaf_count == 5
+
+
+@pytest.mark.parametrize("offsets", [[0, 2, 1], [0, 7], [1, 0]])
+def test_add_packed_invalid_offsets(offsets):
+    mt = mercle.tree.MerkleTree.new()
+
+    with pytest.raises(ValueError):
+        mt.add_packed(b"abcdef", array("Q", offsets))
+    assert mt.leaf_count == 0
+
+
+@pytest.fixture
+def hash_backend():
+    backend = mercle.tree.get_hash_backend()
+    yield
+    mercle.tree.set_hash_backend(backend)
+
+
+REFERENCE_HASHES = {
+    "sha256": lambda data: sha256(data).digest(),
+    "sha256d": lambda data: sha256(sha256(data).digest()).digest(),
+    "blake2s": lambda data: blake2s(data).digest(),
+}
+
+
+def reference_root(leaves, hash="sha256"):
+    # Pad to a power of two, nodes over no leaves are zero.
+    hash = REFERENCE_HASHES[hash]
+    level, populated = list(leaves), len(leaves)
+    while len(level) < 2 or len(level) & (len(level) - 1):
+        level.append(bytes(32))
+    while len(level) > 1:
+        populated = (populated + 1) // 2
+        level = [
+            hash(level[2 * i] + level[2 * i + 1]) if i < populated else bytes(32)
+            for i in range(len(level) // 2)
+        ]
+    return level[0]
+
+
+@pytest.mark.parametrize("backend", ["openssl", "shani"])
+def test_hash_backends_match(hash_backend, backend):
+    try:
+        mercle.tree.set_hash_backend(backend)
+    except ValueError:
+        pytest.skip("{} not supported on this cpu".format(backend))
+
+    assert mercle.tree.get_hash_backend() == backend
+    for count in (1, 2, 3, 7, 1000):
+        leaves = [digest(value) for value in range(count)]
+        mt = mercle.tree.MerkleTree.new(leaves)
+
+        assert mt.root == reference_root(leaves)
+        assert mercle.util.verify_proof(mt.get_proof(count - 1), leaves[-1])
+
+
+def test_unknown_hash_backend():
+    with pytest.raises(ValueError):
+        mercle.tree.set_hash_backend("md5")
+
+
+@pytest.mark.parametrize("hash", mercle.tree.HASHES)
+@pytest.mark.parametrize("backend", ["openssl", "shani"])
+def test_tree_hashes(hash_backend, hash, backend):
+    try:
+        mercle.tree.set_hash_backend(backend)
+    except ValueError:
+        pytest.skip("{} not supported on this cpu".format(backend))
+
+    reference = REFERENCE_HASHES[hash]
+    for count in (1, 2, 3, 7, 1000):
+        raw = [str(value).encode() * (value % 70) for value in range(count)]
+        leaves = [reference(leaf) for leaf in raw]
+        mt = mercle.tree.MerkleTree.new(raw, hashed=False, hash=hash, workers=2)
+
+        assert mt.hash == hash
+        assert mt.root == reference_root(leaves, hash)
+        assert mt.get_leaves() == leaves
+
+        mt.add(b"one more", hashed=False)
+        mt.update(b"changed", 0, hashed=False)
+        mt.update_many({count - 1: b"changed too"}, hashed=False)
+        leaves[0] = reference(b"changed")
+        leaves[count - 1] = reference(b"changed too")
+        leaves.append(reference(b"one more"))
+        assert mt.root == reference_root(leaves, hash)
+
+        proof = mt.get_proof(count - 1)
+        assert mercle.util.verify_proof(proof, leaves[count - 1], hash)
+        assert mercle.util.verify_proofs(mt.get_proofs([0, count]), [leaves[0], leaves[count]]) == [True, True]
+        assert mt.get_multiproof([0, count]).verify([leaves[0], leaves[count]])
+        for other in mercle.tree.HASHES:
+            if other != hash:
+                assert not mercle.util.verify_proof(proof, leaves[count - 1], other)
+
+
+@pytest.mark.parametrize("hash", mercle.tree.HASHES)
+def test_tree_hash_is_marshalled(tmp_path, hash):
+    leaves = [digest(value) for value in range(5)]
+    mt = mercle.tree.MerkleTree.new(leaves, hash=hash)
+
+    assert mercle.tree.MerkleTree.unmarshal(mt.marshal(), verify=True).hash == hash
+
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree", hash=hash)
+    mt.add_many(leaves, hashed=True)
+    mt.close()
+    mt = mercle.tree.MerkleTree.open(tmp_path / "tree")
+    assert mt.hash == hash
+    assert mt.root == reference_root(leaves, hash)
+    mt.close()
+
+
+def test_open_with_other_hash(tmp_path):
+    mercle.tree.MerkleTree.open(tmp_path / "tree", hash="blake2s").close()
+
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.open(tmp_path / "tree", hash="sha256")
+
+
+def test_unknown_hash():
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.new(hash="md5")
+
+
+def test_diff_trees_with_other_hashes():
+    with pytest.raises(ValueError):
+        mercle.tree.MerkleTree.new(hash="sha256").diff(mercle.tree.MerkleTree.new(hash="blake2s"))
+
+
+def test_workers_are_clamped():
+    mt = mercle.tree.MerkleTree.new()
+
+    mt.workers = 0
+    assert mt.workers == 1
+    mt.workers = 100000
+    assert mt.workers == 256
+
+
+def test_concurrent_trees_hash_independently():
+    def work(seed):
+        values = [str(seed * 1000 + value).encode() for value in range(200)]
+        mt = mercle.tree.MerkleTree.new()
+        for value in values:
+            mt.add(value, hashed=False)
+        return mt.root == mercle.tree.MerkleTree.new(values, hashed=False).root
+
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(work, range(16)))
+
+
+def test_concurrent_readers_and_writers():
+    leaves = [digest(value) for value in range(64)]
+    mt = mercle.tree.MerkleTree.new(leaves, lazy=True)
+
+    def write():
+        for value in range(500):
+            mt.update(digest(value), value % 64)
+            leaves[value % 64] = digest(value)
+
+    def read(value):
+        return mercle.util.verify_proof(mt.get_proof(value % 64), mt.get_leaves(value % 64, value % 64 + 1)[0])
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    with ThreadPoolExecutor(8) as pool:
+        reads = list(pool.map(read, range(500)))
+    writer.join()
+
+    assert mt.root == mercle.tree.MerkleTree.new(leaves).root
+    assert len(reads) == 500
+
+
+def test_rw_lock_excludes_writers():
+    lock = mercle.tree.RWLock()
+    events = []
+
+    def read():
+        with lock.read():
+            events.append("read")
+            time.sleep(0.01)
+            events.append("done")
+
+    def write():
+        with lock.write():
+            events.append("write")
+            time.sleep(0.01)
+            events.append("done")
+
+    threads = [threading.Thread(target=f) for f in (read, read, write, read, write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # A writer always finishes before anything else starts.
+    for index, event in enumerate(events):
+        if event == "write":
+            assert events[index + 1] == "done"
+
+
 def test_tree_proof_validates():
     mt = mercle.tree.MerkleTree.new(
         [digest(value) for value in ["a", "b", "c", "d", "e", "f", "g", "h"]],
@@ -458,3 +1517,40 @@ def test_combined_proofs_validates():
     combined_proof = mercle.util.combine_proofs(proof_of_e, proof_of_m2)
 
     assert mercle.util.verify_proof(combined_proof, digest("e"))
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 4, 5, 7, 8, 9, 31, 33, 100, 1000, 4097])
+def test_stream_root_matches_new(count):
+    leaves = [digest(value) for value in range(count)]
+
+    assert mercle.stream_root(leaves) == mercle.tree.MerkleTree.new(leaves).root
+    assert mercle.stream_root(iter(leaves)) == mercle.tree.MerkleTree.new(leaves).root
+
+
+@pytest.mark.parametrize("hash", mercle.tree.HASHES)
+def test_stream_root_of_unhashed_leaves(monkeypatch, hash):
+    monkeypatch.setattr(mercle.tree, "STREAM_BATCH", 7)
+    leaves = [str(value).encode() * (value % 5) for value in range(100)]
+
+    expected = mercle.tree.MerkleTree.new(leaves, hashed=False, hash=hash).root
+    assert mercle.stream_root(leaves, hashed=False, hash=hash) == expected
+    assert mercle.stream_root(leaves, hashed=False, hash=hash, workers=4) == expected
+
+
+@pytest.mark.parametrize("size", [0, 1, 100, 1000])
+def test_stream_root_of_file(tmp_path, size):
+    data = bytes(i % 251 for i in range(size))
+    (tmp_path / "data").write_bytes(data)
+    leaves = [data[i:i + 64] for i in range(0, size, 64)]
+
+    with open(tmp_path / "data", "rb") as f:
+        root = mercle.stream_root(f, hashed=False, chunk_size=64)
+    assert root == mercle.tree.MerkleTree.new(leaves, hashed=False).root
+
+
+def test_stream_root_invalid_leaves():
+    with pytest.raises(ValueError):
+        mercle.stream_root([b"short"])
+
+    with pytest.raises(ValueError):
+        mercle.stream_root([], hash="md5")
@@ -0,0 +1,85 @@
+from hashlib import sha256
+
+import pytest
+
+import mercle.tree
+import mercle.util
+
+
+def digest(value):
+    return sha256(str(value).encode()).digest()
+
+
+@pytest.fixture
+def leaves():
+    return [digest(value) for value in range(11)]
+
+
+@pytest.fixture
+def tree(leaves):
+    return mercle.tree.MerkleTree.new(leaves)
+
+
+def test_verify_proof(tree, leaves):
+    for index, leaf in enumerate(leaves):
+        assert mercle.util.verify_proof(tree.get_proof(index), leaf) is True
+
+
+@pytest.mark.parametrize("proof", (
+    [],
+    [["R", bytes(32)]],
+    [["X", bytes(32)], ["ROOT", bytes(32)]],
+    [["R", b"short"], ["ROOT", bytes(32)]],
+    [["R", bytes(32)], ["ROOT", b"short"]],
+))
+def test_verify_malformed_proof(proof):
+    assert mercle.util.verify_proof(proof, digest(0)) is False
+
+
+def test_verify_proof_wrong_leaf_length(tree):
+    assert mercle.util.verify_proof(tree.get_proof(0), b"short") is False
+
+
+def test_verify_proofs(tree, leaves):
+    proofs = [tree.get_proof(index) for index in range(len(leaves))]
+
+    assert mercle.util.verify_proofs(proofs, leaves) == [True] * len(leaves)
+
+
+def test_verify_proofs_from_get_proofs(tree, leaves):
+    proofs = tree.get_proofs([3, 10, 0])
+
+    assert mercle.util.verify_proofs(proofs, [leaves[3], leaves[10], leaves[0]]) == [True] * 3
+    assert mercle.util.verify_proofs(proofs, [leaves[3], leaves[0], leaves[0]]) == [True, False, True]
+
+
+def test_verify_proofs_mixed(tree, leaves):
+    other = mercle.tree.MerkleTree.new(leaves[:3])
+    proofs = [tree.get_proof(1), [["X", bytes(32)], ["ROOT", bytes(32)]], other.get_proof(2), tree.get_proof(4)]
+
+    assert mercle.util.verify_proofs(proofs, [leaves[1], leaves[0], leaves[2], digest("z")]) == [
+        True,
+        False,
+        True,
+        False,
+    ]
+
+
+def test_verify_proofs_empty():
+    assert mercle.util.verify_proofs([], []) == []
+
+
+def test_verify_proofs_leaf_count_mismatch(tree, leaves):
+    with pytest.raises(ValueError):
+        mercle.util.verify_proofs([tree.get_proof(0)], [])
+
+
+def test_combine_many_proofs(leaves):
+    inner = mercle.tree.MerkleTree.new(leaves[:2])
+    middle = mercle.tree.MerkleTree.new([digest("a"), inner.root])
+    outer = mercle.tree.MerkleTree.new([middle.root, digest("b"), digest("c")])
+
+    proof = mercle.util.combine_proofs(inner.get_proof(0), middle.get_proof(1), outer.get_proof(0))
+
+    assert proof[-1] == ["ROOT", outer.root]
+    assert mercle.util.verify_proof(proof, leaves[0]) is True